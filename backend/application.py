@@ -1,4 +1,6 @@
 import tornado.gen
+import tornado.iostream
+from tornado.ioloop import IOLoop
 import json
 import logging
 import ast
@@ -8,18 +10,22 @@ import os, random, string
 import re
 import util
 import codecs
+import tempfile
+import threading
 from auth import jwtauth
-from rdkit import Chem
-from rdkit.Chem import Draw
-from rdkit.Chem import AllChem
 import mydb
+import idsequence
+import depict
+import loctree
+import occupancy
+import refdata
+import sdf
 import config
 import pandas as pd
-from os.path import exists
 from collections import OrderedDict
 
-db = mydb.disconnectSafeConnect()
-cur = db.cursor()
+# Per-request cursor on a pooled connection, see mydb.pooled
+cur = mydb.pooledCursor()
 
 
 def vialPresentInDDD(sVial):
@@ -77,84 +83,14 @@ def res_to_json(response, cursor):
               column in enumerate(value)} for value in response]
     return to_js
 
-def createPngFromMolfile(regno, molfile):
-    sSql = f'''select bin2mol(moldepict(%s))
-    '''
-    cur.execute(sSql, (molfile, ))
-    try:
-        molfile = cur.fetchall()[0][0]
-        m = Chem.MolFromMolBlock(molfile)
-    except:
-        pass
-    try:
-        Draw.MolToFile(m, f'mols/{regno}.png', size=(300, 300))
-    except:
-        logging.error(f"regno {regno} is nostruct")
-
-
 def getNewLocId(loctreeDB):
-    sSql = f"select pkey from {loctreeDB}.location_id_sequence"
-    cur.execute(sSql)
-    pkey = cur.fetchall()[0][0] +1
-    sSql = f"update {loctreeDB}.location_id_sequence set pkey={pkey}"
-    cur.execute(sSql)
-    return 'SL' + str(pkey)
+    return idsequence.locIds.allocate(1, loctreeDB)[0]
 
 def getNewPlateId(coolDB):
-    def nextPossiblePlate():
-        # Use cool sequence to get unique sequence over both glass and ddd_cool
-        #sSql = f"select pkey from {coolDB}.plate_sequence"
-        sSql = f"select pkey from cool.plate_sequence"
-        cur.execute(sSql)
-        pkey = cur.fetchall()[0][0] +1
-        # Use cool sequence to get unique sequence over both glass and ddd_cool
-        #sSql = f"update {coolDB}.plate_sequence set pkey={pkey}"
-        sSql = f"update cool.plate_sequence set pkey={pkey}"
-        cur.execute(sSql)
-        return pkey
-
-    sPlate = ''
-    pkey = 0
-    while(True):
-        pkey = nextPossiblePlate()
-        sPlate = 'P' + str(pkey)
-        sSql = f"select plate_id from {coolDB}.plate where plate_id = '{sPlate}'"
-        cur.execute(sSql)
-        res = cur.fetchall()
-        if len(res) > 0:
-            pass
-        else:
-            break
-
-    return sPlate
+    return idsequence.plateIds.allocate(1, coolDB)[0]
 
 def getNewRackId(microtubeDB):
-    def nextPossibleRack():
-        # Use microtube sequence to get unique sequence over both glass and ddd_microtube
-        #sSql = f"select pkey from {microtubeDB}.matrix_sequence"
-        sSql = f"select pkey from microtube.matrix_sequence"
-        cur.execute(sSql)
-        pkey = cur.fetchall()[0][0] +1
-        # Use microtube sequence to get unique sequence over both glass and ddd_microtube
-        #sSql = f"update {microtubeDB}.matrix_sequence set pkey={pkey}"
-        sSql = f"update microtube.matrix_sequence set pkey={pkey}"
-        cur.execute(sSql)
-        return pkey
-
-    sPlate = ''
-    pkey = 0
-    while(True):
-        pkey = nextPossibleRack()
-        sRack = 'MX' + str(pkey).zfill(4)
-        sSql = f"select matrix_id from {microtubeDB}.matrix where matrix_id = '{sRack}'"
-        cur.execute(sSql)
-        res = cur.fetchall()
-        if len(res) > 0:
-            pass
-        else:
-            break
-
-    return sRack
+    return idsequence.rackIds.allocate(1, microtubeDB)[0]
 
 
 def copyPlateImpl(self, sPlateId, iPlateType, sLocation, sOldPlateComment):
@@ -181,59 +117,13 @@ def copyPlateImpl(self, sPlateId, iPlateType, sLocation, sOldPlateComment):
     cur.execute(sSql)
 
 
-def copyWell(self, sPlate, sWell, sCompound, sBatch, sForm, sConc, sVolume):
-    glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-    
-    sSql = f'''insert into {coolDB}.config
-    (config_id, well, compound_id, notebook_ref, form, conc, volume)
-    values
-    ('{sPlate}', '{sWell}', '{sCompound}', '{sBatch}', '{sForm}', {sConc}, '{sVolume}')
-    '''
-    try:
-        cur.execute(sSql)
-        return True
-    except:
-        logging.info(sSql)
-        return False
-
-def decreseVolumeInWell(self, sPlate, sWell, sOldVolume, sVolumeToSubtract):
-    glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-    try:
-        fNewVolume = float(sOldVolume) - float(sVolumeToSubtract)
-    except:
-        # The source volume is NULL so we fail to calculate the new volume
-        return
-    sSql = f'''
-    update {coolDB}.config set volume = '{fNewVolume}'
-    where config_id = '{sPlate}'
-    and well = '{sWell}'
-    '''
-    cur.execute(sSql)
-    
-
-def decreseVolumeInTube(self, sTube, sOldVolume, sVolumeToSubtract):
-    glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-    try:
-        iNewVolume = int(sOldVolume) - int(int(sVolumeToSubtract)/1000)
-    except:
-        # The source volume is NULL so we fail to calculate the new volume
-        return
-    fNewVolume = float(iNewVolume)/1000000
-    fNewVolume= f'{fNewVolume:.8f}'
-    sSql = f'''
-    update {microtubeDB}.tube
-    set volume = {fNewVolume}
-    where tube_id = '{sTube}'
-    '''
-    cur.execute(sSql)
-
-
 class home(tornado.web.RequestHandler):
     def get(self, *args, **kwargs):
         self.redirect('/vialdb/listFiles')
 
 
 class ListDownloadFiles(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self):
         sSql = f'''select name, description, type, path,
                    level, comment, date(update_date) update_date
@@ -249,12 +139,14 @@ class ListDownloadFiles(tornado.web.RequestHandler):
 
 
 class PingDB(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self):
         sSql = "SELECT * FROM glass.box_sequence"
         ret = cur.ping(sSql)
         if ret == 'error':
             self.set_status(400)
 
+    @mydb.threaded
     def head(self):
         sSql = "SELECT * FROM glass.box_sequence"
         ret = cur.ping(sSql)
@@ -263,6 +155,7 @@ class PingDB(tornado.web.RequestHandler):
 
 
 class GetListById(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, listId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f'''select element, 'Ok' from {coolDB}.list_content where list_id = %s
@@ -278,68 +171,42 @@ class GetListById(tornado.web.RequestHandler):
 
 
 class GetSDFForElements(tornado.web.RequestHandler):
-    def get(self, joinedIds):
-        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        saIds = joinedIds.split(',')
-        
-        # 1. Determine the ID type and set up the corresponding SQL query
-        if saIds[0].startswith('CBK'):
-            sType = 'compound_id'
-            sql = "SELECT smiles_std FROM bcpvs.compound WHERE compound_id = %s"
-        else:
-            sType = 'batch_id'
-            sql = """
-                SELECT c.smiles_std, c.compound_id
-                FROM bcpvs.compound c
-                JOIN bcpvs.batch b ON c.compound_id = b.compound_id
-                WHERE b.notebook_ref = %s
-            """
-            
-        sRes = ''
-        
-        # 3. Loop through each ID
-        for sId in saIds:
-            sId = sId.strip() # Clean up any accidental whitespace
-            if not sId:
-                continue
-                
-            # Execute the query securely using parameterization to prevent SQL injection
-            cur.execute(sql, (sId,))
-            row = cur.fetchone()
-            
-            # If we found a SMILES string in the database
-            if row and row[0]:
-                smiles = row[0]
-                
-                # Convert SMILES to RDKit Mol object
-                mol = Chem.MolFromSmiles(smiles)
-                
-                if mol is not None:
-                    mol.SetProp("_Name", sId)
-                    AllChem.Compute2DCoords(mol)
-                    
-                    # Start with the structure block
-                    sdf_entry = Chem.MolToMolBlock(mol)
-                    
-                    # 3. Append the correct data tags based on the requested type
-                    if sType == 'compound_id':
-                        sdf_entry += f"> <Compound id>\n{sId}\n\n"
-                    else:
-                        fetched_compound_id = row[1]
-                        sdf_entry += f"> <Compound id>\n{fetched_compound_id}\n\n"
-                        sdf_entry += f"> <Batch id>\n{sId}\n\n"
-                        
-                    # 4. Append the record separator
-                    sdf_entry += "$$$$\n"
-                    
-                    # Add to our final result string
-                    sRes += sdf_entry
-
-        # Return the concatenated SDF string wrapped in JSON
-        self.write(json.dumps(sRes))
+    # SDF of compound or batch ids, written to the client one chunk at a
+    # time. Ids come in the url (GET) or as a JSON body {"ids": [...]}
+    # (POST) for lists too long for a url.
+    async def streamSdf(self, saIds):
+        laItems = [(sId,) for sId in (s.strip() for s in saIds) if sId]
+        self.set_header('Content-Type', 'chemical/x-mdl-sdfile; charset=utf-8')
+        # Structures are always read from bcpvs, also for DDD users
+        chunks = sdf.sdfChunks(laItems, sdf.smilesTags, bcpvsDB='bcpvs', bSmiles=True)
+        while True:
+            sText = await mydb.runThreaded(next, chunks, None)
+            if sText is None:
+                break
+            self.write(sText)
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                logging.info('SDF client went away')
+                return
+        self.finish()
+
+    async def get(self, joinedIds):
+        await self.streamSdf(joinedIds.split(','))
+
+    async def post(self):
+        try:
+            saIds = json.loads(self.request.body)['ids']
+        except Exception as e:
+            logging.error(f'Bad SDF request: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
+            return
+        await self.streamSdf(saIds)
         
         
 class GetListInfoById(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, listId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f'''select pk, list_name, list_owner, list_type
@@ -357,6 +224,7 @@ class GetListInfoById(tornado.web.RequestHandler):
 
 
 class SaveListElements(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, accuList, listId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         saElements = accuList.split()
@@ -373,37 +241,97 @@ class SaveListElements(tornado.web.RequestHandler):
             except:
                 logging.error(sSql)
 
+    @mydb.threaded
+    def post(self, listId):
+        # Body: {"elements": [...], "dedup": true}, dedup skips elements
+        # already in the list
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            dBody = json.loads(self.request.body)
+            saElements = dBody['elements']
+            if isinstance(saElements, str):
+                saElements = saElements.split()
+            lDedup = dBody.get('dedup', False)
+        except Exception as e:
+            logging.error(f'Bad list elements body: {str(e)}')
+            self.set_status(400)
+            self.finish(json.dumps({'msg': 'NotOk'}))
+            return
+
+        if lDedup:
+            saElements = list(OrderedDict.fromkeys(saElements))
+            sSql = f"""select element from {coolDB}.list_content
+            where list_id = %s and element in ({{ids}})"""
+            setExisting = set(row[0] for row in cur.fetchallIn(sSql, saElements, (listId, )))
+            saElements = [sElement for sElement in saElements if sElement not in setExisting]
+
+        try:
+            with cur.transaction():
+                for saChunk in mydb.chunks(saElements):
+                    sSql = f"""insert into {coolDB}.list_content
+                    (list_id, element)
+                    values
+                    {', '.join(['(%s, %s)'] * len(saChunk))}
+                    """
+                    tArgs = tuple(v for sElement in saChunk for v in (listId, sElement))
+                    cur.execute(sSql, tArgs)
+        except Exception as e:
+            logging.error(f'Failed to save list {listId}: {str(e)}')
+            self.set_status(400)
+            self.finish(json.dumps({'msg': 'NotOk'}))
+            return
+        self.finish(json.dumps({'msg': 'Ok', 'inserted': len(saElements)}))
+
 
 class ValidateBatches(tornado.web.RequestHandler):
+    # Table and id column checked for every list type
+    dListTables = {'Batch Id': ('bcpvsDB', 'batch', 'notebook_ref'),
+                   'Compound Id': ('bcpvsDB', 'compound', 'compound_id'),
+                   'Plate Id': ('coolDB', 'plate', 'plate_id')}
+
+    @mydb.threaded
     def get(self, batches, listType):
-        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        saBatches = batches.split()
+        self.validate(batches.split(), listType)
 
-        if listType == 'Batch Id':
-            sSql = f'''select notebook_ref from {bcpvsDB}.batch where notebook_ref='''
-        elif listType == 'Compound Id':
-            sSql = f'''select compound_id from {bcpvsDB}.compound where compound_id='''
-        elif listType == 'Plate Id':
-            sSql = f'''select plate_id from {coolDB}.plate where plate_id='''
+    @mydb.threaded
+    def post(self, listType):
+        # Body: {"batches": [...]}, for lists too long for a url
+        try:
+            saBatches = json.loads(self.request.body)['batches']
+            if isinstance(saBatches, str):
+                saBatches = saBatches.split()
+        except Exception as e:
+            logging.error(f'Bad validate body: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
+            return
+        self.validate(saBatches, listType)
 
-            
-        status = 200
+    def validate(self, saBatches, listType):
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        if listType not in self.dListTables:
+            self.set_status(400)
+            self.finish(f'Unknown list type {listType}')
+            return
+        sDB, sTable, sColumn = self.dListTables[listType]
+        sDB = {'bcpvsDB': bcpvsDB, 'coolDB': coolDB}[sDB]
+        sSql = f"select {sColumn} from {sDB}.{sTable} where {sColumn} in ({{ids}})"
+
+        # Matching in MySQL is case insensitive so compare lower case keys
+        setFound = set(str(row[0]).lower() for row in
+                       cur.fetchallIn(sSql, list(set(saBatches))))
         result = []
         for sBatch in saBatches:
-            sSqlNew = sSql + ' %s  '
-            cur.execute(sSqlNew, (sBatch,))
-            res = cur.fetchall()
-            if len(res) == 0:
-                result.append([sBatch, 'Not found'])
-                status = 400
-            else:
+            if sBatch.lower() in setFound:
                 result.append([sBatch, 'Ok'])
-                #logging.info(res)
+            else:
+                result.append([sBatch, 'Not found'])
         self.finish(json.dumps(result))
 
 
 @jwtauth
 class GetLists(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, listType):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         if listType != 'Plate Id':
@@ -463,6 +391,7 @@ GROUP BY
 
 @jwtauth
 class SearchLists(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, plateListId, batchListId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f'''select list_type from {coolDB}.list_table where pk = %s  '''
@@ -525,6 +454,7 @@ class SearchLists(tornado.web.RequestHandler):
 
 @jwtauth
 class CheckListName(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, userName, listName):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
@@ -550,6 +480,7 @@ class CheckListName(tornado.web.RequestHandler):
 
 @jwtauth
 class CreateList(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, userName, listName, listType):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f'''insert into {coolDB}.list_table
@@ -574,6 +505,7 @@ class CreateList(tornado.web.RequestHandler):
 
 @jwtauth
 class DeleteList(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, userName, listId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
@@ -615,6 +547,7 @@ class DeleteList(tornado.web.RequestHandler):
 
 @jwtauth
 class DeleteListElements(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, userName, listId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
@@ -655,6 +588,7 @@ class DeleteListElements(tornado.web.RequestHandler):
 
 @jwtauth
 class AddMicrotube(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sTubeId, sBatchId, sVolume, sConc):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         volume = -1
@@ -702,125 +636,17 @@ class AddMicrotube(tornado.web.RequestHandler):
             return
 
 
-@jwtauth
-class GetMicroTubesFromFile(tornado.web.RequestHandler):
-    def post(self):
-        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-
-        try:
-            file1 = self.request.files['file'][0]
-            sIds = tornado.escape.xhtml_unescape(file1.body)
-        except:
-            logging.error("Error cant find file1 in the argument list")
-            return
-        saBatches = list(sIds.split())
-        jResTot = list()
-
-        def makeJson(tData, jRes, sId):
-            if len(tData) == 0:
-                return jRes
-            for row in tData:
-                try:
-                    jRes.append({"batchId":row[0],
-                                 "tubeId":row[1],
-                                 "volume": row[2],
-                                 "matrixId": row[3],
-                                 "position": str(row[4]),
-                                 "location": str(row[5]),
-                                 "compoundId": str(row[6])
-                    })
-                except:
-                    logging.error('Failed at appending ' + sId)
-            return jRes
-
-        jRes = list()
-        for sId in saBatches:
-            sSql = f"""
-SELECT 
- t.notebook_ref AS batchId,
- t.tube_id AS tubeId,
- t.volume * 1000000 AS volume,
- m.matrix_id AS matrixId,
- mt.position AS position,
- m.location AS location,
- b.compound_id as compoundId
-FROM
- {microtubeDB}.tube t
- join {bcpvsDB}.batch b on t.notebook_ref = b.notebook_ref
- left join {microtubeDB}.v_matrix_tube mt on t.tube_id = mt.tube_id
- left join {microtubeDB}.v_matrix m on m.matrix_id = mt.matrix_id
-where
-t.notebook_ref = '{sId}'
-or b.compound_id = '{sId}'
-            """
-
-            try:
-                sSlask = cur.execute(sSql)
-                tRes = cur.fetchall()
-            except Exception as e:
-                logging.error("Error: " + str(e) + ' problem with batch:' + sId)
-                return
-            if len(tRes) == 0:
-                sSql = f"""select
-                t.notebook_ref as batchId,
-                t.tube_id as tubeId,
-                t.volume*1000000 as volume,
-                m.matrix_id as matrixId,
-                mt.position as position,
-                m.location as location,
-                b.compound_id as compoundId
-                from {microtubeDB}.tube t,
-                {microtubeDB}.v_matrix_tube mt,
-                {microtubeDB}.v_matrix m,
-                {bcpvsDB}.batch b
-                where
-                b.notebook_ref = t.notebook_ref and
-                t.tube_id = mt.tube_id and
-                m.matrix_id = mt.matrix_id and
-                t.tube_id = '{sId}'
-                """
-                try:
-                    sSlask = cur.execute(sSql)
-                    tRes = cur.fetchall()
-                except Exception as e:
-                    logging.error("Error: " + str(e) + ' problem with batch:' + sId)
-                    return
-
-            jRes = makeJson(tRes, jRes, sId)
-        self.write(json.dumps(jRes, indent=4))
-
-
-@jwtauth
-class getMicroTubes(tornado.web.RequestHandler):
-    def get(self, sBatches):
-        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        if len(sBatches) < 1:
-            logging.error("no batch")
-            self.write(json.dumps({}))
-            return
-        saBatches = list(sBatches.split())
-        jResTot = list()
-        def makeJson(tData, jRes, sId):
-            if len(tData) == 0:
-                return jRes
-            for row in tData:
-                try:
-                    jRes.append({"batchId":row[0],
-                                 "tubeId":row[1],
-                                 "volume": row[2],
-                                 "matrixId": row[3],
-                                 "position": str(row[4]),
-                                 "location": str(row[5]),
-                                 "compoundId": str(row[6])
-                    })
-                except:
-                    logging.error('Failed at appending ' + sId)
-            return jRes
+def lookupMicroTubes(self, saIds):
+    '''Find the microtubes for a list of batch, compound and tube ids.
 
-        jRes = list()
-        for sId in saBatches:
+    Ids are first matched on notebook_ref/compound_id in one set query,
+    the ids without hits are then matched on tube_id. Rows come out per
+    id in input order.
+    '''
+    glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+    saUnique = list(OrderedDict.fromkeys(saIds))
 
-            sSql = f"""
+    sSql = f"""
 SELECT
  t.notebook_ref AS batchId,
  t.tube_id AS tubeId,
@@ -835,18 +661,19 @@ FROM
  left join {microtubeDB}.v_matrix_tube mt on t.tube_id = mt.tube_id
  left join {microtubeDB}.v_matrix m on m.matrix_id = mt.matrix_id
 where
-t.notebook_ref = %s
-or b.compound_id = %s
-            """
-            try:
-                sSlask = cur.execute(sSql, (sId, sId, ))
-                tRes = cur.fetchall()
-            except Exception as e:
-                logging.error("Error: " + str(e) + ' problem with batch:' + sId)
-                return
-            if len(tRes) == 0:
-
-                sSql = f"""select
+t.notebook_ref in ({{ids}})
+or b.compound_id in ({{ids}})
+    """
+    # Matching in MySQL is case insensitive so group on lower case keys
+    dRows = dict()
+    for row in cur.fetchallIn(sSql, saUnique):
+        dRows.setdefault(str(row[0]).lower(), []).append(row)
+        if str(row[6]).lower() != str(row[0]).lower():
+            dRows.setdefault(str(row[6]).lower(), []).append(row)
+
+    saMissing = [sId for sId in saUnique if sId.lower() not in dRows]
+    if len(saMissing) > 0:
+        sSql = f"""select
 t.notebook_ref as batchId,
 t.tube_id as tubeId,
 t.volume*1000000 as volume,
@@ -857,31 +684,71 @@ b.compound_id as compoundId
 from {microtubeDB}.tube t
 left outer join {microtubeDB}.v_matrix_tube mt on t.tube_id = mt.tube_id
 left outer join {microtubeDB}.v_matrix m on m.matrix_id = mt.matrix_id
-join {bcpvsDB}.batch b on b.notebook_ref = t.notebook_ref and
-t.tube_id = %s
-                """
+join {bcpvsDB}.batch b on b.notebook_ref = t.notebook_ref
+where t.tube_id in ({{ids}})
+        """
+        for row in cur.fetchallIn(sSql, saMissing):
+            dRows.setdefault(str(row[1]).lower(), []).append(row)
+
+    jRes = list()
+    for sId in saIds:
+        for row in dRows.get(sId.lower(), []):
+            jRes.append({"batchId":row[0],
+                         "tubeId":row[1],
+                         "volume": row[2],
+                         "matrixId": row[3],
+                         "position": str(row[4]),
+                         "location": str(row[5]),
+                         "compoundId": str(row[6])
+            })
+    return jRes
+
+
+@jwtauth
+class GetMicroTubesFromFile(tornado.web.RequestHandler):
+    @mydb.threaded
+    def post(self):
+        try:
+            file1 = self.request.files['file'][0]
+            sIds = tornado.escape.xhtml_unescape(file1.body)
+        except:
+            logging.error("Error cant find file1 in the argument list")
+            return
+        try:
+            jRes = lookupMicroTubes(self, sIds.split())
+        except Exception as e:
+            logging.error("Error: " + str(e) + ' problem with microtube search')
+            return
+        self.write(json.dumps(jRes, indent=4))
 
-                try:
-                    sSlask = cur.execute(sSql, (sId, ))
-                    tRes = cur.fetchall()
-                except Exception as e:
-                    logging.error("Error: " + str(e) + ' problem with batch:' + sId)
-                    return
 
-            jRes = makeJson(tRes, jRes, sId)
+@jwtauth
+class getMicroTubes(tornado.web.RequestHandler):
+    @mydb.threaded
+    def get(self, sBatches):
+        if len(sBatches) < 1:
+            logging.error("no batch")
+            self.write(json.dumps({}))
+            return
+        try:
+            jRes = lookupMicroTubes(self, sBatches.split())
+        except Exception as e:
+            logging.error("Error: " + str(e) + ' problem with microtube search')
+            return
         self.write(json.dumps(jRes, indent=4))
 
 
 @jwtauth
 class CreateRacks(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sNumberOfRacks):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         saNewRacks = []
         #rackKeys = []
         #rackValues = []
         iNumberOfRacks = int(sNumberOfRacks)
-        for i in range(iNumberOfRacks):
-            sNewRack = getNewRackId(microtubeDB)
+        saRackIds = idsequence.rackIds.allocate(iNumberOfRacks, microtubeDB)
+        for sNewRack in saRackIds:
             sSql = f"""
             insert into {microtubeDB}.matrix
             (matrix_id, created_date)
@@ -899,26 +766,18 @@ class CreateRacks(tornado.web.RequestHandler):
 @jwtauth
 class CreatePlatesFromLabel(tornado.web.RequestHandler):
 
+    @mydb.threaded
     def put(self, sStartPlate, sPlateType, sPlateName, sNumberOfPlates):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
-        def checkIfPlatesAreFree(iStart, iNumberOfPlates):
-            lRetVal = True
-            for i in range(iStart,iStart + iNumberOfPlates):
-                sSql = f'''
-                select plate_id from {coolDB}.plate where plate_id = 'p{str(i).zfill(6)}'
-                '''
-                sSlask = cur.execute(sSql)
-                tRes = cur.fetchall()
-                if len(tRes) > 0:
-                    lRetVal = False
-                    break
-            return lRetVal
+        def checkIfPlatesAreFree(saPlateIds):
+            sSql = f'''
+            select plate_id from {coolDB}.plate where plate_id in ({{ids}})
+            '''
+            return len(cur.fetchallIn(sSql, saPlateIds)) == 0
 
 
         saNewPlates = dict()
-        plateKeys = []
-        plateValues = []
         iNumberOfPlates = int(sNumberOfPlates)
 
         pattern = '([0-9]{6})$'
@@ -932,80 +791,97 @@ class CreatePlatesFromLabel(tornado.web.RequestHandler):
             logging.error(sError)
             return
 
-        if checkIfPlatesAreFree(iStart, iNumberOfPlates):
-            pass
-        else:
-            sError = f'Error plate already registered'
+        iPlateType = refdata.plateTypeId(sPlateType)
+        if iPlateType is None:
+            sError = f'Wrong plate size {sPlateType}'
+            logging.error(sError)
             self.set_status(400)
             self.finish(sError)
+            return
+        for i in range(iNumberOfPlates):
+            sNewplateName = f"{str(i + 1).zfill(3)}: {sPlateName}"
+            saNewPlates[f"P{str(iStart + i).zfill(6)}"] = sNewplateName
+
+        saPlateIds = list(saNewPlates.keys())
+        try:
+            with cur.transaction():
+                if not checkIfPlatesAreFree(saPlateIds):
+                    sError = f'Error plate already registered'
+                    self.set_status(400)
+                    self.finish(sError)
+                    logging.error(sError)
+                    return
+                for saChunk in mydb.chunks(saPlateIds):
+                    sSql = f"""
+                    insert into {coolDB}.plate (plate_id,
+                    config_id,
+                    type_id,
+                    comments,
+                    created_date,
+                    updated_date)
+                    values
+                    {', '.join(['(%s, %s, %s, %s, now(), now())'] * len(saChunk))}"""
+                    tArgs = tuple(v for sPlateId in saChunk
+                                  for v in (sPlateId, sPlateId, iPlateType, saNewPlates[sPlateId]))
+                    cur.execute(sSql, tArgs)
+        except Exception as e:
+            sError = f'Failed to register plates: {str(e)}'
             logging.error(sError)
+            self.set_status(400)
+            self.finish(sError)
             return
-
-        if sPlateType == "96":
-            # This is the type_id in the db for 96 well plates
-            iPlateType = 1
-        elif sPlateType == "384":
-            # This is the type_id in the db for 384 well plates
-            iPlateType = 16
-        elif sPlateType == "1536":
-            # This is the type_id in the db for 1536 well plates
-            iPlateType = 47
-        for i in range(iNumberOfPlates):
-            ii = str(i + 1)
-            iii = ii.zfill(3)
-            sNewplateName = f"{iii}: {sPlateName}"
-            sPlateId = f"P{str(iStart + i).zfill(6)}"
-            sSql = f"""
-            insert into {coolDB}.plate (plate_id,
-            config_id,
-            type_id,
-            comments,
-            created_date,
-            updated_date)
-            values (
-            '{sPlateId}',
-            '{sPlateId}',
-            {iPlateType},
-            '{sNewplateName}',
-            now(),
-            now())"""
-            cur.execute(sSql)
-            plateKeys.append(sPlateId)
-            #doPrintPlate(sPlateId)
-            plateValues.append(sNewplateName)
-        for i in range(len(plateKeys)):
-            saNewPlates[plateKeys[i]] = plateValues[i]
-        res = json.dumps(saNewPlates, indent = 4)
-        self.write(res)
+        res = json.dumps(saNewPlates, indent = 4)
+        self.write(res)
 
 
 @jwtauth
 class CreatePlateFromRack(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sRack, sVolume):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        # This is the type_id in the db for 96 well plates
         sPlateId = getNewPlateId(coolDB)
-        iPlateType = 1
+        iPlateType = refdata.plateTypeId(96)
         sLocation = ''
         sOldPlateComment = sRack
         sForm = 'DMSO'
 
-        copyPlateImpl(self, sPlateId, iPlateType, sLocation, sOldPlateComment)
+        # Tubes with NULL volume keep it, as does a volume that is not a
+        # whole number of nl
+        try:
+            iSubtract = int(int(sVolume)/1000)
+        except:
+            iSubtract = None
 
-        sSql = f'''
-        select mt.position as well, b.compound_id, b.notebook_ref, IFNULL(t.conc*1000, 10) as conc, t.tube_id, volume*1000000
-        from {microtubeDB}.matrix_tube mt, {bcpvsDB}.batch b, {microtubeDB}.tube t
-        where mt.tube_id = t.tube_id
-        and t.notebook_ref = b.notebook_ref
-        and matrix_id = '{sRack}'
-        '''
-        cur.execute(sSql)
-        tMicrotubes = cur.fetchall()
-        for tube in tMicrotubes:
-            
-            #                           well     cmp      batch    form   conc          volume
-            if(copyWell(self, sPlateId, tube[0], tube[1], tube[2], sForm, int(tube[3]), sVolume)):
-                decreseVolumeInTube(self, tube[4], tube[5], sVolume)
+        try:
+            with cur.transaction():
+                copyPlateImpl(self, sPlateId, iPlateType, sLocation, sOldPlateComment)
+
+                sSql = f'''
+                insert into {coolDB}.config
+                (config_id, well, compound_id, notebook_ref, form, conc, volume)
+                select %s, mt.position, b.compound_id, b.notebook_ref, %s,
+                truncate(IFNULL(t.conc*1000, 10), 0), %s
+                from {microtubeDB}.matrix_tube mt, {bcpvsDB}.batch b, {microtubeDB}.tube t
+                where mt.tube_id = t.tube_id
+                and t.notebook_ref = b.notebook_ref
+                and mt.matrix_id = %s
+                '''
+                cur.execute(sSql, (sPlateId, sForm, sVolume, sRack))
+
+                if iSubtract is not None:
+                    sSql = f'''
+                    update {microtubeDB}.tube t
+                    join {microtubeDB}.matrix_tube mt on mt.tube_id = t.tube_id
+                    join {bcpvsDB}.batch b on t.notebook_ref = b.notebook_ref
+                    set t.volume = round((truncate(t.volume*1000000, 0) - %s)/1000000, 8)
+                    where mt.matrix_id = %s
+                    '''
+                    cur.execute(sSql, (iSubtract, sRack))
+        except Exception as e:
+            logging.error(f'Failed to create plate from {sRack}: {str(e)}')
+            self.set_status(400)
+            self.finish(str(e))
+            return
 
         jRes =list()
         jRes.append({"plate_id":sPlateId})
@@ -1014,6 +890,7 @@ class CreatePlateFromRack(tornado.web.RequestHandler):
 
 @jwtauth
 class DuplicatePlate(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sPlate, sVolume):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sNewPlateId = getNewPlateId(coolDB)
@@ -1029,31 +906,43 @@ class DuplicatePlate(tornado.web.RequestHandler):
         iPlateType = tPlate[0][0]
         sOldPlateComment = tPlate[0][1]
         sLocation = ''
-        copyPlateImpl(self, sNewPlateId, iPlateType, sLocation, sOldPlateComment)
+        # Wells with NULL volume keep it, as does a volume that is not a number
+        try:
+            fSubtract = float(sVolume)
+        except:
+            fSubtract = None
+
+        try:
+            with cur.transaction():
+                copyPlateImpl(self, sNewPlateId, iPlateType, sLocation, sOldPlateComment)
+
+                # Only the wells in the plating sequence of the plate type
+                saWells = refdata.get(coolDB).wellsOf(iPlateType) or [None]
+                sSql = f'''
+                insert into {coolDB}.config
+                (config_id, well, compound_id, notebook_ref, form, conc, volume)
+                select %s, c.well, c.compound_id, c.notebook_ref, c.form,
+                truncate(c.conc, 0), %s
+                FROM {coolDB}.config c, {coolDB}.plate p
+                WHERE p.CONFIG_ID = c.CONFIG_ID
+                and c.WELL in ({mydb.placeholders(saWells)}) and p.plate_id = %s
+                '''
+                cur.execute(sSql, (sNewPlateId, sVolume) + tuple(saWells) + (sPlate, ))
+
+                if fSubtract is not None:
+                    sSql = f'''
+                    update {coolDB}.config c
+                    join {coolDB}.plate p on p.CONFIG_ID = c.CONFIG_ID
+                    set c.volume = c.volume - %s
+                    where c.WELL in ({mydb.placeholders(saWells)}) and p.plate_id = %s
+                    '''
+                    cur.execute(sSql, (fSubtract, ) + tuple(saWells) + (sPlate, ))
+        except Exception as e:
+            logging.error(f'Failed to duplicate {sPlate}: {str(e)}')
+            self.set_status(400)
+            self.finish(str(e))
+            return
 
-        sSql = f'''SELECT 
-        c.well,
-        compound_id,
-        notebook_ref,
-        c.form,
-        c.conc,
-        c.volume
-        FROM {coolDB}.config c, {coolDB}.plate p, {coolDB}.plating_sequence ps
-        WHERE p.CONFIG_ID = c.CONFIG_ID
-        and p.TYPE_ID = ps.TYPE_ID
-        and c.WELL = ps.WELL and p.plate_id = '{sPlate}'
-	order by ps.seq
-        '''
-        cur.execute(sSql)
-        tPlateContent = cur.fetchall()
-        for well in tPlateContent:
-            try:
-                sConc = int(well[4])
-            except:
-                sConc = 'NULL'
-            #                              well     cmp      batch    form     conc   volume
-            if(copyWell(self, sNewPlateId, well[0], well[1], well[2], well[3], sConc, sVolume)):
-                decreseVolumeInWell(self, sPlate, well[0], well[5], sVolume)
         logging.info(sNewPlateId)
         doPrintPlate(sNewPlateId)
         jRes =list()
@@ -1063,26 +952,25 @@ class DuplicatePlate(tornado.web.RequestHandler):
 
 @jwtauth
 class CreatePlates(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sPlateType, sSubType, sPlateName, sNumberOfPlates, sLocation, sDuplicate):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         saNewPlates = dict()
         plateKeys = []
         plateValues = []
         iNumberOfPlates = int(sNumberOfPlates)
-        if sPlateType == "96":
-            # This is the type_id in the db for 96 well plates
-            iPlateType = 1
-        elif sPlateType == "384":
-            # This is the type_id in the db for 384 well plates
-            iPlateType = 16
-        elif sPlateType == "1536":
-            # This is the type_id in the db for 1536 well plates
-            iPlateType = 47
-        for i in range(iNumberOfPlates):
+        iPlateType = refdata.plateTypeId(sPlateType)
+        if iPlateType is None:
+            sError = f'Wrong plate size {sPlateType}'
+            logging.error(sError)
+            self.set_status(400)
+            self.finish(sError)
+            return
+        saPlateIds = idsequence.plateIds.allocate(iNumberOfPlates, coolDB)
+        for i, sPlateId in enumerate(saPlateIds):
             ii = str(i + 1)
             iii = ii.zfill(3)
             sNewplateName = f"{iii}: {sPlateName}"
-            sPlateId = getNewPlateId(coolDB)
             sSql = f"""
             insert into {coolDB}.plate (plate_id,
             config_id,
@@ -1115,6 +1003,7 @@ class CreatePlates(tornado.web.RequestHandler):
 
 @jwtauth
 class UpdatePlateName(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sPlate, sPlateName, sPlateLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f"""
@@ -1127,40 +1016,16 @@ class UpdatePlateName(tornado.web.RequestHandler):
 
 @jwtauth
 class MergePlates(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
+        refData = refdata.get(coolDB)
+
         def getPlateSize(sPlate):
             sSql = f"""select type_id from {coolDB}.plate where plate_id = '{sPlate}' """
             cur.execute(sSql)
-            iType = cur.fetchall()[0][0]
-
-            if iType == 16:
-                iType = 384
-            elif iType == 47:
-                iType = 1536
-            return iType
-
-        def getQuadrant(quadrant, iPlateSize = 384):
-            sSql = ''
-            if iPlateSize == 384:
-                sSql = f"""
-                select quadrant, well96, well384
-                from {coolDB}.map96to384
-                where quadrant = {quadrant}
-                order by well96
-                """
-            elif iPlateSize == 1536:
-                sSql = f"""
-                select quadrant, well384, well1536
-                from {coolDB}.map384to1536
-                where quadrant = {quadrant}
-                order by well384
-                """
-
-            cur.execute(sSql)
-            df = pd.DataFrame(cur.fetchall())
-            return df
+            return refData.plateSize(cur.fetchall()[0][0])
 
         def getPlate(sPlate):
             if sPlate.startswith('P'):
@@ -1172,12 +1037,16 @@ class MergePlates(tornado.web.RequestHandler):
                 notebook_ref,
                 c.form,
                 c.conc,
-                c.volume
-                FROM {coolDB}.config c, {coolDB}.plate p, {coolDB}.plating_sequence ps
+                c.volume,
+                p.TYPE_ID
+                FROM {coolDB}.config c, {coolDB}.plate p
                 WHERE p.CONFIG_ID = c.CONFIG_ID
-                and p.TYPE_ID = ps.TYPE_ID
-                and c.WELL = ps.WELL and p.plate_id = '{sPlate}'
-	        order by ps.seq"""
+                and p.plate_id = '{sPlate}'"""
+                cur.execute(sSql)
+                tRes = cur.fetchall()
+                if len(tRes) == 0:
+                    return tRes
+                return [row[:7] for row in refData.sortWells(tRes[0][7], tRes, 1)]
             elif sPlate.startswith('MX'):
                 sSql = f"""
                 select
@@ -1198,35 +1067,15 @@ class MergePlates(tornado.web.RequestHandler):
             tRes = cur.fetchall()
             return tRes
 
-        def transferWells(quadrant, sourcePlate, targetPlate):
-            ii = 0
+        def mapWells(dQuadrant, sourcePlate, targetPlate):
+            tValues = []
             for i in sourcePlate:
-                ii += 1
-                sPlate = i[0]
                 sWell = i[1]
-                sCmpId = i[2]
-                sBatch = i[3]
-                sForm = i[4]
-                sConc = i[5]
-                if sConc == None:
-                    sConc = 'NULL'
-                dfTargetWell = quadrant.loc[quadrant[1] == sWell][2]
-                sTargetWell = list(dfTargetWell)[0]
-                sSql = f"""
-                insert into {coolDB}.config
-                (config_id, well, compound_id, notebook_ref, form, conc, volume)
-                values
-                (
-                '{targetPlate}',
-                '{sTargetWell}',
-                '{sCmpId}',
-                '{sBatch}',
-                '{sForm}',
-                {sConc},
-                '{sVolume}'
-                )
-                """
-                cur.execute(sSql)
+                if sWell not in dQuadrant:
+                    raise KeyError(f'Well {sWell} of {i[0]} is not in the quadrant map')
+                # conc may be NULL, volume is the merge volume for all wells
+                tValues.append((targetPlate, dQuadrant[sWell], i[2], i[3], i[4], i[5], sVolume))
+            return tValues
 
 
         sVolume = self.get_argument("volume")
@@ -1251,37 +1100,59 @@ class MergePlates(tornado.web.RequestHandler):
             self.finish(sError)
             return
 
-        if q1 != "":
-            quadrant = getQuadrant(1, iTargetSize)
-            plate = getPlate(q1)
-            transferWells(quadrant, plate, targetPlate)
-        if q2 != "":
-            quadrant = getQuadrant(2, iTargetSize)
-            plate = getPlate(q2)
-            transferWells(quadrant, plate, targetPlate)
-        if q3 != "":
-            quadrant = getQuadrant(3, iTargetSize)
-            plate = getPlate(q3)
-            transferWells(quadrant, plate, targetPlate)
-        if q4 != "":
-            quadrant = getQuadrant(4, iTargetSize)
-            plate = getPlate(q4)
-            transferWells(quadrant, plate, targetPlate)
+        dQuadrants = refData.quadrantMaps(iTargetSize)
+        tValues = []
+        try:
+            for iQuadrant, sSource in enumerate((q1, q2, q3, q4), start=1):
+                if sSource != "":
+                    tValues += mapWells(dQuadrants.get(iQuadrant, dict()),
+                                        getPlate(sSource), targetPlate)
+        except KeyError as e:
+            logging.error(str(e))
+            self.set_status(400)
+            self.finish(str(e))
+            return
+
+        try:
+            with cur.transaction():
+                for tChunk in mydb.chunks(tValues):
+                    sSql = f"""
+                    insert into {coolDB}.config
+                    (config_id, well, compound_id, notebook_ref, form, conc, volume)
+                    values
+                    {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(tChunk))}
+                    """
+                    cur.execute(sSql, tuple(v for row in tChunk for v in row))
+        except Exception as e:
+            logging.error(f'Merge into {targetPlate} failed: {str(e)}')
+            self.set_status(400)
+            self.finish(str(e))
+            return
+
+@jwtauth
+class RefreshReferenceData(tornado.web.RequestHandler):
+    # Reread plate_type, plating_sequence and the quadrant maps after they
+    # were changed in the database
+    @mydb.threaded
+    def put(self):
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            refdata.refresh(coolDB)
+        except Exception as e:
+            logging.error(f'Reference data refresh failed: {str(e)}')
+            self.set_status(400)
+            self.finish(str(e))
+            return
+        self.finish()
+
 
 @jwtauth
 class SetPlateType(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sPlate, sPlateType):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        if sPlateType == "96":
-            # This is the type_id in the db for 96 well plates
-            iPlateType = 1
-        elif sPlateType == "384":
-            # This is the type_id in the db for 384 well plates
-            iPlateType = 16
-        elif sPlateType == "1536":
-            # This is the type_id in the db for 1536 well plates
-            iPlateType = 47
-        else:
+        iPlateType = refdata.plateTypeId(sPlateType)
+        if iPlateType is None:
             sError = 'Wrong plate size'
             logging.error(f'Wrong plate size {sPlateType}')
             self.set_status(400)
@@ -1308,15 +1179,14 @@ class SetPlateType(tornado.web.RequestHandler):
 
 @jwtauth
 class UploadAccumulatedRows(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self):
         saRows = self.get_argument("rows")
         saRows = ast.literal_eval(saRows)
-        saError = []
-        for row in saRows:
-            status, sMessage = implUploadWellInformation(self, row)
-            if status != 200:
-                saError.append(row)
-                
+        saErrors = uploadWellRows(self, saRows)
+        # Failed rows are returned with the error message as an extra column
+        saError = [list(saRows[i]) + [sMessage] for i, sMessage in saErrors]
+
         self.set_header("Content-Type", "application/json")
         if len(saError) != 0:
             self.set_status(400)
@@ -1326,96 +1196,150 @@ class UploadAccumulatedRows(tornado.web.RequestHandler):
         self.finish(json.dumps(saError))
 
 
-def implUploadWellInformation(self, row = None):
-    def zfillWell(sWell):
-        alphabet = sWell.rstrip('0123456789')
-        numbers = sWell[len(alphabet):]
-        numbers = str(numbers).zfill(2)
-        return alphabet + numbers
-
-    def checkCmpId(notebook_ref, compound_id):
-        if compound_id.upper() == 'BACKFILL':
-            return True
-        sSql = f'''
-        select compound_id from {bcpvsDB}.batch
-        where notebook_ref = '{notebook_ref}'
-        '''
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) == 0:
-            return False
-        if tRes[0][0] != compound_id:
-            return False
-        else:
-            return True
+def zfillWell(sWell):
+    alphabet = sWell.rstrip('0123456789')
+    numbers = sWell[len(alphabet):]
+    numbers = str(numbers).zfill(2)
+    return alphabet + numbers
+
 
+def uploadWellRows(self, saRows):
+    '''Load plate config rows [plate, well, compound, batch, form, conc, volume].
 
+    All batch/compound pairs are checked with one query and the wells
+    BACKFILL rows add to are read with one query. Inserts and backfill
+    updates are then written with executemany in one transaction. If the
+    transaction fails the rows are written one by one so that only the
+    offending rows fail. Returns a list of (row index, error message).
+    '''
     glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-    if row == None:
-        sPlate = self.get_argument("plate_id")
-        sWell = self.get_argument("well")
-        sWell = zfillWell(sWell)
-        sCompound = self.get_argument("compound_id")
-        sBatch = self.get_argument("batch")
-        sForm = self.get_argument("form")
-        sConc = self.get_argument("conc")
-        sVolume = self.get_argument("volume")
-    else:
-        sPlate = row[0].strip()
-        sWell = row[1].strip()
-        sWell = zfillWell(sWell)
-        sCompound = row[2].strip()
-        sBatch = row[3].strip()
-        sForm = row[4]
-        sConc = row[5]
-        sVolume = row[6]
-
-    if checkCmpId(sBatch, sCompound) == False:
-        self.set_status(400)
-        logging.error(f'CompoundId not found: {sCompound}')
-        return 400, 'Compound id not found'
+    saErrors = []
 
+    tRows = []
+    for i, row in enumerate(saRows):
+        try:
+            tRows.append((i, row[0].strip(), zfillWell(row[1].strip()),
+                          row[2].strip(), row[3].strip(), row[4], row[5], row[6]))
+        except Exception as e:
+            saErrors.append((i, f'Bad row: {str(e)}'))
+
+    # batch -> compound for all non backfill rows
+    saBatches = list(set(r[4] for r in tRows if r[3].upper() != 'BACKFILL'))
+    sSql = f'''select notebook_ref, compound_id from {bcpvsDB}.batch
+    where notebook_ref in ({{ids}})'''
+    dCompounds = dict()
+    for row in cur.fetchallIn(sSql, saBatches):
+        dCompounds.setdefault(str(row[0]).lower(), row[1])
+
+    # Existing wells of the plates that are backfilled
+    saPlates = list(set(r[1] for r in tRows if r[3].upper() == 'BACKFILL'))
+    sSql = f'''select config_id, well, conc, volume from {coolDB}.config
+    where config_id in ({{ids}})'''
+    dWells = dict()
+    for row in cur.fetchallIn(sSql, saPlates):
+        sKey = (str(row[0]).lower(), str(row[1]).lower())
+        dWells.setdefault(sKey, []).append((row[2], row[3]))
+
+    saInserts = []
+    dUpdates = dict()
+    # well -> row index of the insert in this upload that created it
+    dInserted = dict()
+    for i, sPlate, sWell, sCompound, sBatch, sForm, sConc, sVolume in tRows:
+        sKey = (sPlate.lower(), sWell.lower())
+        if sCompound.upper() != 'BACKFILL':
+            if dCompounds.get(sBatch.lower()) != sCompound:
+                logging.error(f'CompoundId not found: {sCompound}')
+                saErrors.append((i, 'Compound id not found'))
+                continue
+            saInserts.append((i, (sPlate, sWell, sCompound, sBatch, sForm, sConc, sVolume)))
+            # A later backfill of this well sees the inserted values
+            dWells.setdefault(sKey, []).append((sConc, sVolume))
+            dInserted[sKey] = i
+            continue
 
-    if sCompound == 'BACKFILL':
-        sSql = f'''select conc, volume from {coolDB}.config
-        where config_id = '{sPlate}' and well = '{sWell}'
-        '''
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) != 1:
-            self.set_status(400)
+        if len(dWells.get(sKey, [])) != 1:
             logging.error(f'Backfill values requires an existing CONC value in the well {sPlate} {sWell}')
-            return 400, str('Backfill values requires an existing CONC value in the well')
-
-        preConc = float(tRes[0][0])
-        preVolume = float(tRes[0][1])
-        sVolume = float(sVolume)
-        sSql = f'''update {coolDB}.config
-        set conc = '{(preConc * float(preVolume))/(preVolume + float(sVolume))}',
-        volume = '{preVolume + float(sVolume)}'
-        where config_id = '{sPlate}' and well = '{sWell}'
-        '''
+            saErrors.append((i, 'Backfill values requires an existing CONC value in the well'))
+            continue
         try:
-            cur.execute(sSql)
+            preConc = float(dWells[sKey][0][0])
+            preVolume = float(dWells[sKey][0][1])
+            fVolume = float(sVolume)
+            fConc = (preConc * preVolume)/(preVolume + fVolume)
         except Exception as e:
             logging.error(f'Backfill error {str(e)}')
-            return 400, str(e)
-    else:
-        sSql = f'''insert into {coolDB}.config
-        (config_id, well, compound_id, notebook_ref, form, conc, volume)
-        values
-        ('{sPlate}', '{sWell}', '{sCompound}', '{sBatch}', '{sForm}', '{sConc}', '{sVolume}')
-        '''
-        try:
-            cur.execute(sSql)
-        except Exception as e:
-            logging.error(f'Insert well failed: {str(e)} {sSql}')
-            return 400, str(e)
+            saErrors.append((i, str(e)))
+            continue
+        dWells[sKey] = [(fConc, preVolume + fVolume)]
+        # Only the final values of a well that is backfilled more than
+        # once are written
+        iaRows = dUpdates.get(sKey, ([], None))[0] + [i]
+        dUpdates[sKey] = (iaRows, (str(fConc), str(preVolume + fVolume), sPlate, sWell),
+                          dInserted.get(sKey))
+
+    sInsertSql = f'''insert into {coolDB}.config
+    (config_id, well, compound_id, notebook_ref, form, conc, volume)
+    values
+    (%s, %s, %s, %s, %s, %s, %s)
+    '''
+    sUpdateSql = f'''update {coolDB}.config
+    set conc = %s, volume = %s
+    where config_id = %s and well = %s
+    '''
+    saUpdates = list(dUpdates.values())
+
+    try:
+        with cur.transaction():
+            if len(saInserts) > 0:
+                cur.executemany(sInsertSql, [tValues for i, tValues in saInserts])
+            if len(saUpdates) > 0:
+                cur.executemany(sUpdateSql, [tValues for iaRows, tValues, iInsert in saUpdates])
+    except Exception as e:
+        logging.error(f'Bulk well upload failed, retrying row by row: {str(e)}')
+        setFailed = set()
+        for i, tValues in saInserts:
+            try:
+                cur.execute(sInsertSql, tValues)
+            except Exception as e:
+                logging.error(f'Insert well failed: {str(e)} {tValues}')
+                saErrors.append((i, str(e)))
+                setFailed.add(i)
+        for iaRows, tValues, iInsert in saUpdates:
+            if iInsert is not None and iInsert in setFailed:
+                # Computed from a well that was not written
+                logging.error(f'Backfill values requires an existing CONC value in the well {tValues[2]} {tValues[3]}')
+                saErrors += [(i, 'Backfill values requires an existing CONC value in the well')
+                             for i in iaRows]
+                continue
+            try:
+                cur.execute(sUpdateSql, tValues)
+            except Exception as e:
+                logging.error(f'Backfill error {str(e)}')
+                saErrors += [(i, str(e)) for i in iaRows]
+
+    return sorted(saErrors)
+
+
+def implUploadWellInformation(self, row = None):
+    if row == None:
+        row = [self.get_argument("plate_id"),
+               self.get_argument("well"),
+               self.get_argument("compound_id"),
+               self.get_argument("batch"),
+               self.get_argument("form"),
+               self.get_argument("conc"),
+               self.get_argument("volume")]
+
+    saErrors = uploadWellRows(self, [row])
+    if len(saErrors) > 0:
+        self.set_status(400)
+        return 400, saErrors[0][1]
     return 200, ''
         
 
 @jwtauth
 class UploadWellInformation(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self, internalCall = False):
         if internalCall == True:
             return
@@ -1426,6 +1350,7 @@ class UploadWellInformation(tornado.web.RequestHandler):
 
 @jwtauth
 class GetEchoData(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, plateListId, sCtrlPlate, sDMSOplate):
         logging.info(f'{sCtrlPlate} {plateListId}')
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -1454,44 +1379,56 @@ AND c.CONC > 0
     
 @jwtauth
 class VerifyPlate(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sPlate):
         sPlate = sPlate.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         if re.match("^[pP]{1}[0-9]{6}$", sPlate):
             sSql = f"""
-            select wells,
+            select type_id,
             comments,
             IFNULL(loc_id, " ") loc_id,
             IFNULL(discarded, 0) discarded,
-            IF(plate_subtype IS NULL, wells, plate_subtype) AS plate_type
-            from {coolDB}.plate, {coolDB}.plate_type
-            where plate.type_id = plate_type.type_id
-            and plate.plate_id ='{sPlate}'
+            plate_subtype
+            from {coolDB}.plate
+            where plate.plate_id = %s
             """
+            cur.execute(sSql, (sPlate, ))
+            # wells from the cached plate_type
+            dWells = refdata.get(coolDB).dWells
+            jRes = [{'wells': dWells[row[0]],
+                     'comments': row[1],
+                     'loc_id': row[2],
+                     'discarded': row[3],
+                     # A string, as IF(plate_subtype IS NULL, wells,
+                     # plate_subtype) gave
+                     'plate_type': str(dWells[row[0]]) if row[4] is None else row[4]}
+                    for row in cur.fetchall() if row[0] in dWells]
         elif re.match("^[mM][xX]{1}[0-9]{4}$", sPlate):
             sSql = f"""select 96 wells, comments, '0' discarded
             from {microtubeDB}.matrix
             where matrix_id = '{sPlate}'
             """
+            cur.execute(sSql)
+            jRes = res_to_json(cur.fetchall(), cur)
         else:
             sError = 'Plate not found {sPlate}'
             self.set_status(400)
             self.finish(sError)
             return
 
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) == 0:
+        if len(jRes) == 0:
             sError = f'Plate not found {sPlate}'
             self.set_status(400)
             self.finish(sError)
             return
-        logging.info(tRes)
-        self.finish(json.dumps(res_to_json(tRes, cur), indent=4))
+        logging.info(jRes)
+        self.finish(json.dumps(jRes, indent=4))
 
 
 @jwtauth
 class GetPlateForPlatemap(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sPlate):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         # Platt ID      Well    Compound ID     Batch nr        Form    Conc (mM)       volume
@@ -1521,6 +1458,7 @@ class GetPlateForPlatemap(tornado.web.RequestHandler):
 
 @jwtauth
 class GetPlate(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sPlate):
         sPlate = sPlate.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -1536,6 +1474,8 @@ class GetPlate(tornado.web.RequestHandler):
             logging.error(sError)
             return
 
+        # Read before the plate query, res_to_json needs its cursor
+        refData = refdata.get(coolDB)
         sSql = f"""
         SELECT p.comments description,
         p.plate_id,
@@ -1546,18 +1486,19 @@ class GetPlate(tornado.web.RequestHandler):
         c.conc,
         c.volume,
         p.TYPE_ID
-        FROM {coolDB}.config c, {coolDB}.plate p, {coolDB}.plating_sequence ps
+        FROM {coolDB}.config c, {coolDB}.plate p
         WHERE p.CONFIG_ID = c.CONFIG_ID
-        and p.TYPE_ID = ps.TYPE_ID
-        and c.WELL = ps.WELL and p.plate_id = '{sPlate}'
-	order by ps.seq"""
+        and p.plate_id = '{sPlate}'"""
         sSlask = cur.execute(sSql)
         tRes = cur.fetchall()
+        if len(tRes) > 0:
+            tRes = refData.sortWells(tRes[0][8], tRes, 2)
         self.write(json.dumps(res_to_json(tRes, cur), indent=4))
 
 
 @jwtauth
 class UpdateRackLocation(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sRack, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f"""
@@ -1574,6 +1515,7 @@ class UpdateRackLocation(tornado.web.RequestHandler):
 
 @jwtauth
 class UpdateBoxName(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sBox, sNewName):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         if len(sNewName) < 2:
@@ -1586,6 +1528,7 @@ class UpdateBoxName(tornado.web.RequestHandler):
             """
             try:
                 sSlask = cur.execute(sSql)
+                loctree.invalidate(loctreeDB)
                 self.finish()
             except Exception as e:
                 self.set_status(400)
@@ -1594,6 +1537,7 @@ class UpdateBoxName(tornado.web.RequestHandler):
 
 @jwtauth
 class MoveBox(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sBox, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         if sLocation == sBox:
@@ -1605,6 +1549,7 @@ class MoveBox(tornado.web.RequestHandler):
         """
         try:
             sSlask = cur.execute(sSql)
+            loctree.invalidate(loctreeDB)
             self.finish()
         except Exception as e:
             self.set_status(400)
@@ -1613,46 +1558,36 @@ class MoveBox(tornado.web.RequestHandler):
 
 @jwtauth
 class ReadScannedRack(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self):
 
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
-        def resetPosition(sLine, sRackId):
-            m = re.search("\s+(\w\d\d);", sLine)
-            if m:
-                sPosition = m.groups()[0]
-            else:
-                logging.error(f'{sLine}')
-                return
-
-            # Reset any tube that was in the position we are about to update
-            sSql = f"""select tube_id from {microtubeDB}.matrix_tube
-            where matrix_id = '{sRackId}' and position = '{sPosition}'
-            """
-            sSlask = cur.execute(sSql)
-            tRes = cur.fetchall()
-            if len(tRes) > 0:
-                # Reset position and rack for old tube here
-                sSql = f"""update {microtubeDB}.matrix_tube
-                set matrix_id = NULL, position = NULL
-                where tube_id = '{tRes[0][0]}'"""
-                sSlask = cur.execute(sSql)
-
-
-        def createRackIfNotFound(sRack):
-            sSql = f"""
-            select matrix_id from {microtubeDB}.matrix where matrix_id = '{sRack}'
-            """
-            sSlask = cur.execute(sSql)
-            tRes = cur.fetchall()
-            if len(tRes) == 0:
-                sSql = f"""
-                insert into {microtubeDB}.matrix
-                (matrix_id, created_date)
-                values
-                ('{sRack}', now())
-                """
-                cur.execute(sSql)
+        def parseScan(sFile):
+            # position -> scanned tube, None for positions that must be empty.
+            # Lines are applied in order, a tube scanned twice ends up in
+            # the last position and leaves the earlier one empty.
+            dScan = OrderedDict()
+            dTubePosition = dict()
+            iLines = 0
+            for sLine in sFile.splitlines():
+                if "NO READ" in sLine or "Forced Stop" in sLine:
+                    m = re.search(r"\s+(\w\d\d);", sLine)
+                    if m:
+                        dScan[m.groups()[0]] = None
+                    else:
+                        logging.error(f'{sLine}')
+
+                m = re.search(r"\s+(\w\d\d);\s+(\d+)", sLine)
+                if not m:
+                    continue
+                sPosition, sTube = m.groups()
+                iLines += 1
+                if dTubePosition.get(sTube, sPosition) != sPosition:
+                    dScan[dTubePosition[sTube]] = None
+                dScan[sPosition] = sTube
+                dTubePosition[sTube] = sPosition
+            return dScan, iLines
 
         try:
             sLocation = self.get_argument("location")
@@ -1662,7 +1597,7 @@ class ReadScannedRack(tornado.web.RequestHandler):
             logging.error("Error cant find file1 in the argument list")
             return
 
-        m = re.search("Rack Base Name: (MX\d+)", str(file1['body']))
+        m = re.search(r"Rack Base Name: (MX\d+)", str(file1['body']))
         if m:
             sRackId = m.groups()[0]
         else:
@@ -1671,94 +1606,110 @@ class ReadScannedRack(tornado.web.RequestHandler):
             self.finish('No valid rack-id found in file')
             return
 
-        original_fname = file1['filename']
-        extension = os.path.splitext(original_fname)[1]
-        fname = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(6))
-        finalFilename = "uploads/" + original_fname
-        output_file = open("uploads/" + original_fname, 'w')
-        output_file.write(sFile)
-        output_file.close()
+        dScan, iLines = parseScan(sFile)
+        saTubes = [sTube for sTube in dScan.values() if sTube is not None]
 
-        fNewFile = open(finalFilename, mode='rU')
-        saFile = fNewFile.readlines()
-        iOk = 0
-        iError = 0
-        saError = []
-
-        createRackIfNotFound(sRackId)
-        logging.info(f'Updating rack {sRackId}')
-        
-        for sLine in saFile:
-            if "NO READ" in sLine or "Forced Stop" in sLine:
-                resetPosition(sLine, sRackId)
-            
-            m = re.search("\s+(\w\d\d);\s+(\d+)", sLine)
-            if m:
-                sPosition = m.groups()[0]
-                sTube = m.groups()[1]
-            else:
-                continue
-
-            # Reset any tube that was in the position we are about to update
-            sSql = f"""select tube_id from {microtubeDB}.matrix_tube
-            where matrix_id = '{sRackId}' and position = '{sPosition}'
-            """
-            sSlask = cur.execute(sSql)
-            tRes = cur.fetchall()
-            if len(tRes) > 0:
-                # Reset position and rack for old tube here
-                sSql = f"""update {microtubeDB}.matrix_tube
-                set matrix_id = NULL, position = NULL
-                where tube_id = '{tRes[0][0]}'"""
-                sSlask = cur.execute(sSql)
-
-            sSql = f"""select matrix_id from {microtubeDB}.matrix_tube
-            where tube_id = '%s'
-            """ % sTube
-            sSlask = cur.execute(sSql)
+        # Everything in the rack plus where the scanned tubes are now
+        sSql = f"""select tube_id, matrix_id, position from {microtubeDB}.matrix_tube
+        where matrix_id = %s"""
+        if len(saTubes) > 0:
+            tRes = cur.fetchallIn(sSql + " or tube_id in ({ids})", saTubes, (sRackId, ))
+        else:
+            cur.execute(sSql, (sRackId, ))
             tRes = cur.fetchall()
+        dOccupant = dict()
+        dTubeRows = dict()
+        for sTube, sMatrix, sPosition in tRes:
+            dTubeRows[str(sTube)] = (sMatrix, sPosition)
+            if sMatrix == sRackId:
+                dOccupant[sPosition] = str(sTube)
+
+        # Clear every scanned position that holds another tube, then
+        # move or add the scanned tubes
+        saClear = []
+        for sPosition, sTube in dScan.items():
+            sOld = dOccupant.get(sPosition)
+            if sOld is not None and sOld != sTube:
+                saClear.append((sOld, ))
+        setCleared = set(tArgs[0] for tArgs in saClear)
+        saUpdate = []
+        saInsert = []
+        for sPosition, sTube in dScan.items():
+            if sTube is None:
+                continue
+            if sTube not in dTubeRows:
+                saInsert.append((sPosition, sRackId, sTube))
+            elif dTubeRows[sTube] != (sRackId, sPosition) or sTube in setCleared:
+                saUpdate.append((sPosition, sRackId, sTube))
+
+        sRackSql = f"""
+        insert into {microtubeDB}.matrix
+        (matrix_id, created_date)
+        select %s, now() from dual
+        where not exists (select 1 from {microtubeDB}.matrix where matrix_id = %s)
+        """
+        sClearSql = f"""update {microtubeDB}.matrix_tube
+        set matrix_id = NULL, position = NULL
+        where tube_id = %s"""
+        sUpdateSql = f"""update {microtubeDB}.matrix_tube set position = %s, matrix_id = %s
+        where tube_id = %s
+        """
+        sInsertSql = f"""insert into {microtubeDB}.matrix_tube
+        (position, matrix_id, tube_id)
+        values
+        (%s, %s, %s)
+        """
+        sLocationSql = f"""
+        update {microtubeDB}.matrix set location = %s
+        where matrix_id = %s
+        """
 
-            if len(tRes) < 1:
-                sSql = f'''insert into {microtubeDB}.matrix_tube
-                (position, matrix_id, tube_id)
-                values
-                ('{sPosition}', '{sRackId}', '{sTube}')
-                '''
-                try:
-                    sSlask = cur.execute(sSql)
-                except Exception as e:
-                    iError += 1
-                    iOk -= 1
-                    saError.append(sTube)
-                    err = str(e)
-            else:
-                sSql = f"""update {microtubeDB}.matrix_tube set position = '%s', matrix_id = '%s'
-                where tube_id = '%s'
-                """ % (sPosition, sRackId, sTube)
+        logging.info(f'Updating rack {sRackId}')
+        saError = []
+        try:
+            with cur.transaction():
+                cur.execute(sRackSql, (sRackId, sRackId))
+                if len(saClear) > 0:
+                    cur.executemany(sClearSql, saClear)
+                if len(saUpdate) > 0:
+                    cur.executemany(sUpdateSql, saUpdate)
+                if len(saInsert) > 0:
+                    cur.executemany(sInsertSql, saInsert)
+                cur.execute(sLocationSql, (sLocation, sRackId))
+        except Exception as e:
+            # Apply the changes one by one so that only the bad tubes fail
+            logging.error(f'Rack {sRackId} update failed, retrying tube by tube: {str(e)}')
+            try:
+                cur.execute(sRackSql, (sRackId, sRackId))
+            except Exception as e:
+                logging.error(f'Failed creating rack {sRackId} {str(e)}')
+            for tArgs in saClear:
                 try:
-                    sSlask = cur.execute(sSql)
+                    cur.execute(sClearSql, tArgs)
                 except Exception as e:
-                    iError += 1
-                    iOk -= 1
-                    saError.append(sTube)
-                    err = str(e)
-                    logging.error(f'Failed updating tube {sTube} {err}')
-            iOk += 1
+                    logging.error(f'Failed clearing tube {tArgs[0]} {str(e)}')
+            for sSql, taArgs in ((sUpdateSql, saUpdate), (sInsertSql, saInsert)):
+                for tArgs in taArgs:
+                    try:
+                        cur.execute(sSql, tArgs)
+                    except Exception as e:
+                        saError.append(tArgs[2])
+                        logging.error(f'Failed updating tube {tArgs[2]} {str(e)}')
+            try:
+                cur.execute(sLocationSql, (sLocation, sRackId))
+            except Exception as e:
+                logging.error(f'Failed setting location of rack {sRackId} {str(e)}')
 
-        sSql = f"""
-        update {microtubeDB}.matrix set location = '{sLocation}'
-        where matrix_id = '{sRackId}'
-        """
-        slask = cur.execute(sSql)
         self.finish(json.dumps({'FailedTubes': saError,
-                                'iOk': iOk,
-                                'iError': iError,
+                                'iOk': iLines - len(saError),
+                                'iError': len(saError),
                                 'sRack': sRackId
         }))
 
 
 @jwtauth
 class getRack(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sRacks):
         sRacks = sRacks.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -1902,6 +1853,7 @@ class UploadLauncher(tornado.web.RequestHandler):
 
 @jwtauth
 class UploadTaredVials(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self, *args, **kwargs):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         try:
@@ -1911,19 +1863,9 @@ class UploadTaredVials(tornado.web.RequestHandler):
         except:
             logging.error("Error cant find file1 in the argument list")
             return
-        original_fname = file1['filename']
-        extension = os.path.splitext(original_fname)[1]
-        fname = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(6))
-        finalFilename = "uploads/" + original_fname
-        output_file = open("uploads/" + original_fname, 'wb')
-        output_file.write(file1['body'])
-        output_file.close()
-
-        fNewFile = open(finalFilename, mode='rU')
-        saFile = fNewFile.readlines()
-        iOk = 0
-        iError = 0
+        saFile = tornado.escape.to_unicode(file1['body']).splitlines()
         saError = []
+        taVials = []
         for sLine in saFile:
             saLine = sLine.split('\t')
             if len(saLine) == 1:
@@ -1935,27 +1877,40 @@ class UploadTaredVials(tornado.web.RequestHandler):
                 if m:
                     sTare = ''.join(saLine[1].split())
                     try:
-                        sSql = f"""insert into {glassDB}.vial (vial_id, type_id, tare, updated_date) 
-                                   values ('{sVial}', 2, {sTare}, now())"""
-                        sSlask = cur.execute(sSql)
-                        iOk += 1
-                    except Exception as e:
-                        res = str(e).find('1062') # Duplicate key error is 1062 and it is ok
-                        if res == 1:
-                            sSql = f"""update {glassDB}.vial set
-                            tare = {sTare},
-                            updated_date = now()
-                            where vial_id = '{sVial}'
-                            """
-                            sSlask = cur.execute(sSql)
-                            logging.info("Upload vial: " + sVial + ' Tare: ' + sTare)
-                            iOk += 1
-                        else:
-                            logging.error(str(e))
-                            saError.append(sVial)
-                            iError += 1
-
-        self.finish(json.dumps({'FailedVials':saError, 'iOk':iOk, 'iError':iError}))
+                        float(sTare)
+                    except ValueError:
+                        logging.error(f'Bad tare {sTare} for vial {sVial}')
+                        saError.append(sVial)
+                        continue
+                    taVials.append((sVial, sTare))
+
+        # New vials are created, known vials get the new tare
+        def upsertSql(iRows):
+            return f"""insert into {glassDB}.vial (vial_id, type_id, tare, updated_date)
+                   values {', '.join(['(%s, 2, %s, now())'] * iRows)} as new
+                   on duplicate key update tare = new.tare, updated_date = now()"""
+        sSql = upsertSql(1)
+        iFailed = 0
+        try:
+            # One multi-row statement per chunk, executemany only batches
+            # rows whose values are all placeholders
+            with cur.transaction():
+                for taChunk in mydb.chunks(taVials):
+                    cur.execute(upsertSql(len(taChunk)),
+                                tuple(v for tRow in taChunk for v in tRow))
+        except Exception as e:
+            # Apply the vials one by one so that only the bad ones fail
+            logging.error(f'Tare upload failed, retrying vial by vial: {str(e)}')
+            for sVial, sTare in taVials:
+                try:
+                    cur.execute(sSql, (sVial, sTare))
+                except Exception as e:
+                    logging.error(f'Upload of vial {sVial} failed: {str(e)}')
+                    saError.append(sVial)
+                    iFailed += 1
+        logging.info(f'Uploaded tare for {len(taVials) - iFailed} vials')
+
+        self.finish(json.dumps({'FailedVials':saError, 'iOk':len(taVials) - iFailed, 'iError':len(saError)}))
 
 def logVialChange(glassDB, sVialId, sLogMessage, sNewPos=None):
     sSql = f"""
@@ -1967,57 +1922,111 @@ def logVialChange(glassDB, sVialId, sLogMessage, sNewPos=None):
     except Exception as e:
         logging.error(f"Vial_log error {str(e)}")
 
-def getVialPosition(sVialId, glassDB, loctreeDB, bcpvsDB):
-    sSql = f"""select IFNULL(v.location, '') location, l.name, IFNULL(v.pos, '') coordinate
+def getVialPositions(saVials, glassDB, loctreeDB):
+    '''Return {vial: (box, box name, coordinate)} for saVials, one query.'''
+    sSql = f"""select v.vial_id, IFNULL(v.location, '') location, l.name, IFNULL(v.pos, '') coordinate
                from {glassDB}.vial v
                left join {loctreeDB}.locations l on v.location = l.loc_id
-               where v.vial_id='{sVialId}'"""
+               where v.vial_id in ({{ids}})"""
+    dPositions = dict()
+    for row in cur.fetchallIn(sSql, saVials):
+        dPositions[str(row[0]).upper()] = (str(row[1]).upper(), str(row[2]), row[3])
+    return dPositions
+
+def moveVials(saVials, sBox, sPos, sTarget, glassDB, loctreeDB, lEmptyPos=False):
+    '''Move saVials to sPos in sBox and log the moves in vial_log.
+
+    All old positions are read with one query, the vials are moved with
+    one update in one transaction and the log rows are written with one
+    multi-row insert. sTarget describes the new position in the log.
+    With lEmptyPos nothing is moved if a vial already is at sPos, checked
+    with a locking read in the move's transaction. Returns False then,
+    True when the vials were moved.
+    '''
+    dPositions = getVialPositions(saVials, glassDB, loctreeDB)
+    taLog = []
+    for sVialId in saVials:
+        sOldBox, sOldName, sOldCoordinate = dPositions.get(sVialId.upper(), ('', '', ''))
+        sLogString = f"""location from {sOldBox} {sOldName}:{sOldCoordinate}\
+ to {sTarget}"""
+        taLog.append((sVialId, sLogString))
+
+    with cur.transaction():
+        if lEmptyPos:
+            sSql = f"""select vial_id from {glassDB}.vial
+                      where location = %s and pos = %s
+                      for update"""
+            cur.execute(sSql, (sBox, sPos, ))
+            if len(cur.fetchall()) != 0:
+                return False
+        for saChunk in mydb.chunks(saVials):
+            sSql = f"""update {glassDB}.vial
+                       set location = %s, pos = %s, updated_date = now()
+                       where vial_id in ({mydb.placeholders(saChunk)})"""
+            cur.execute(sSql, (sBox, sPos) + tuple(saChunk))
+    occupancy.moved(glassDB, [(sVialId, dPositions[sVialId][0], sBox, sPos)
+                              for sVialId in dPositions])
 
-    sSlask = cur.execute(sSql)
-    tRes = cur.fetchall()
-    logging.info(tRes)
-    if len(tRes) == 0:
-        return '', '', ''
-    return str(tRes[0][0]).upper(), str(tRes[0][1]), tRes[0][2]
+    # As in logVialChange a failed log insert is logged, the move stands
+    try:
+        for taChunk in mydb.chunks(taLog):
+            sSql = f"""
+            insert into {glassDB}.vial_log (vial_id, updated_date, changes)
+            values {', '.join(['(%s, now(), %s)'] * len(taChunk))}
+            """
+            cur.execute(sSql, tuple(v for tRow in taChunk for v in tRow))
+    except Exception as e:
+        logging.error(f"Vial_log error {str(e)}")
+    return True
 
-def getBoxFromDb(sBox, glassDB, loctreeDB, bcpvsDB):
+def getBoxMap(sBox, glassDB, loctreeDB, bcpvsDB):
+    '''The occupancy map of sBox, None if there is no such location.'''
     positions = 0
-    sSql = f"""select subpos from {loctreeDB}.locations, {loctreeDB}.location_type
-    where {loctreeDB}.locations.loc_id = '{sBox}'
-    and {loctreeDB}.locations.type_id = {loctreeDB}.location_type.type_id"""
-    sSlask = cur.execute(sSql)
-    tRes = cur.fetchall()
-    if len(tRes) != 1:
-        return
+    tree = loctree.tree(loctreeDB)
+    loc = tree.get(sBox)
+    if loc is None:
+        return None
 
     try:
-        positions = int(tRes[0][0])
+        positions = int(tree.subpos(loc))
     except:
         pass
+    return occupancy.box(glassDB, bcpvsDB, sBox, positions)
 
-    sSlask = cur.execute(f"""select a.coordinate, tt.vial_id,
- tt.compound_id, tt.notebook_ref batch_id
- from
- (SELECT v.pos, v.vial_id, c.compound_id, v.location, v.notebook_ref
- from {glassDB}.vial v
- left join {bcpvsDB}.batch c on v.notebook_ref = c.notebook_ref
- where v.location = '{sBox}') tt
- right outer join
- (select coordinate from {glassDB}.box_sequence order by coordinate limit {positions}) a
- on tt.pos = a.coordinate
- order by a.coordinate asc""")
-
-    tRes = cur.fetchall()
-
-    #jRes = []
-    #for row in tRes:
-    #    jRes.append({"vialId":row.vial_id,
-    #                 "coordinate":row.coordinate,
-    #                 "batchId":row.batch_id,
-    #                 "compoundId":row.compound_id,
-    #                 "boxId":row.box_id,
-    #                 "boxDescription":row.box_description})
-    return res_to_json(tRes, cur)#jRes
+def getBoxFromDb(sBox, glassDB, loctreeDB, bcpvsDB):
+    boxMap = getBoxMap(sBox, glassDB, loctreeDB, bcpvsDB)
+    if boxMap is None:
+        return
+
+    # Batch and compound are only read for vials moved in since the box
+    # was loaded
+    saMissing = [sVial for sVial in boxMap.saVials
+                 if sVial is not None and sVial.upper() not in boxMap.dInfo]
+    if len(saMissing) > 0:
+        sSql = f"""SELECT v.vial_id, v.notebook_ref, c.compound_id
+        from {glassDB}.vial v
+        left join {bcpvsDB}.batch c on v.notebook_ref = c.notebook_ref
+        where v.vial_id in ({{ids}})"""
+        for row in cur.fetchallIn(sSql, saMissing):
+            boxMap.dInfo[str(row[0]).upper()] = (row[1], row[2])
+
+    jRes = []
+    for sCoordinate, sVial in zip(boxMap.saCoordinates, boxMap.saVials):
+        sBatch, sCompound = None, None
+        if sVial is not None:
+            sBatch, sCompound = boxMap.dInfo.get(sVial.upper(), (None, None))
+        jRes.append({'coordinate': sCoordinate,
+                     'vial_id': sVial,
+                     'compound_id': sCompound,
+                     'batch_id': sBatch})
+    return jRes
+
+def sendToPrinter(sLabel, sPrinter):
+    # Each label gets its own spool file, handlers print concurrently
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write(sLabel)
+    os.system(f"lp -h homer.scilifelab.se:631 -d {sPrinter} {f.name}")
+    os.remove(f.name)
 
 def doPrint(sCmp, sBatch, sType, sDate, sVial):
     if sType != 'Solid':
@@ -2072,14 +2081,12 @@ def doPrint(sCmp, sBatch, sType, sDate, sVial):
 ^XZ
 """ % (sCmp, sBatch, sType, sDate, sVial, sVial)
     
-    f = open('/tmp/file.txt','w')
-    f.write(zplVial)
-    f.close()
-    #os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t /tmp/file.txt")
-    os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t_plates  /tmp/file.txt")
+    #sendToPrinter(zplVial, 'CBCS-GK420t')
+    sendToPrinter(zplVial, 'CBCS-GK420t_plates')
 
 @jwtauth
 class verifyVial(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sVial):
         sVial = sVial.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -2137,6 +2144,7 @@ class verifyVial(tornado.web.RequestHandler):
 
 @jwtauth
 class batchInfo(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sBatch):
         sBatch = sBatch.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -2158,6 +2166,7 @@ class batchInfo(tornado.web.RequestHandler):
 
 @jwtauth
 class EditVial(tornado.web.RequestHandler):
+    @mydb.threaded
     def post(self, *args, **kwargs):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sVial = self.get_argument("sVial")
@@ -2227,6 +2236,7 @@ class EditVial(tornado.web.RequestHandler):
             self.set_status(400)
             self.finish(sError)
             return
+        occupancy.edited(glassDB, sVial)
         logging.info("Done editing vial: " + str(sVial))
 
         sSql = f"""
@@ -2257,11 +2267,8 @@ def doPrintPlate(sPlate):
 ^XZ
 '''
 
-    f = open('/tmp/file.txt','w')
-    f.write(s)
-    f.close()
-    #os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t_plates  /tmp/file.txt")
-    os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t /tmp/file.txt")
+    #sendToPrinter(s, 'CBCS-GK420t_plates')
+    sendToPrinter(s, 'CBCS-GK420t')
 
 
 def doPrintRack(sRack):
@@ -2281,11 +2288,8 @@ def doPrintRack(sRack):
 ^FT250,48^A0N,28,31^FH\^FD{sRack}^FS
 ^PQ1,0,1,Y^XZ
 '''
-    f = open('/tmp/file.txt','w')
-    f.write(s)
-    f.close()
-    #os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t_plates /tmp/file.txt")
-    os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t /tmp/file.txt")
+    #sendToPrinter(s, 'CBCS-GK420t_plates')
+    sendToPrinter(s, 'CBCS-GK420t')
 
 
 @jwtauth
@@ -2297,6 +2301,7 @@ class PrintRack(tornado.web.RequestHandler):
 
 @jwtauth
 class PrintRackList(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sRack):
         logging.info("Printing labels for all contents in rack " + sRack)
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -2327,6 +2332,7 @@ class PrintRackList(tornado.web.RequestHandler):
 
 @jwtauth
 class printVial(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sVial):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sVial = sVial.strip()
@@ -2345,48 +2351,18 @@ class printVial(tornado.web.RequestHandler):
             self.finish("Printed")
             return
 
-def getNextVialId(glassDB):
-    sTmp = "V[0-9]+"
-    # Use glass sequence to get unique sequence over both glass and ddd_glass
-    #sSql = f'select pkey from {glassDB}.vial_id_sequence'
-    sSql = f'select pkey from glass.vial_id_sequence'
-    sSlask =  cur.execute(sSql)
-    iVialPkey = cur.fetchall()[0][0]
-    sNewVial = 'V' + str(iVialPkey).zfill(6)
-
-    while True:
-        sSql = f"""select vial_id from glass.vial where vial_id = '{sNewVial}'"""
-        sSlask =  cur.execute(sSql)
-        resLive = cur.fetchall()
-
-        sSql = f"""select vial_id from ddd_glass.vial where vial_id = '{sNewVial}'"""
-        sSlask =  cur.execute(sSql)
-        resDDD = cur.fetchall()
-
-        if len(resLive) == 1 or len(resDDD) == 1:
-            iVialPkey += 1
-            sNewVial = 'V' + str(iVialPkey).zfill(6)
-        else:
-            break
-
-    # Use glass sequence to get unique sequence over both glass and ddd_glass
-    #sSql = f"""update {glassDB}.vial_id_sequence set pkey = {iVialPkey}"""
-    sSql = f"""update glass.vial_id_sequence set pkey = {iVialPkey}"""
-    sSlask =  cur.execute(sSql)
-
-    return sNewVial
-
 @jwtauth
 class CreateEmptyVials(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sNrOfVials):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         iNrOfVials = int(sNrOfVials)
         saResultingVials = []
-        for i in range(iNrOfVials):
+        saVialIds = idsequence.vialIds.allocate(iNrOfVials, glassDB)
+        for sVial in saVialIds:
             sDate = (time.strftime("%Y-%m-%d"))
             sCmp = ""
             sBatch = ""
-            sVial = getNextVialId(glassDB)
             sType = '2'
 
             sSql = f"""insert into {glassDB}.vial
@@ -2397,9 +2373,11 @@ class CreateEmptyVials(tornado.web.RequestHandler):
             """
             try:
                 sSlask = cur.execute(sSql)
-                logVialChange(glassDB, sVial, '', 'Created')
-            except:
-                sError = 'Vial already in database'
+            except Exception as e:
+                # Not created, so neither printed nor returned
+                logging.error(f'Failed creating vial {sVial} {str(e)}')
+                continue
+            logVialChange(glassDB, sVial, '', 'Created')
             doPrint(sCmp, sBatch, '', sDate, sVial)
             saResultingVials.append(sVial)
         self.write(json.dumps(saResultingVials))
@@ -2407,6 +2385,7 @@ class CreateEmptyVials(tornado.web.RequestHandler):
 
 @jwtauth
 class DiscardPlate(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sPlate):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sSql = f"""update {coolDB}.plate set discarded = 1 where plate_id = '{sPlate}'"""
@@ -2416,18 +2395,24 @@ class DiscardPlate(tornado.web.RequestHandler):
 
 @jwtauth
 class DiscardVial(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sVial):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sNull = 'NULL'
+        dPositions = getVialPositions([sVial], glassDB, loctreeDB)
         sSql = f"""update {glassDB}.vial set location = 'SL11008', pos = {sNull}
         where vial_id = '{sVial}'"""
-        sSlask = cur.execute(sSql)
+        with cur.transaction():
+            sSlask = cur.execute(sSql)
         logVialChange(glassDB, sVial, 'Discarding vial', 'Discarded')
+        occupancy.moved(glassDB, [(sVialId, dPositions[sVialId][0], 'SL11008', None)
+                                  for sVialId in dPositions])
         self.finish()
 
 
 @jwtauth
 class vialInfo(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sVial):
         sVial = sVial.rstrip()
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
@@ -2462,35 +2447,28 @@ class vialInfo(tornado.web.RequestHandler):
 
 @jwtauth
 class GetBoxLocation(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sBox):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sSlask = cur.execute(f"""SELECT name, path
-                               FROM {loctreeDB}.v_all_locations
-                               where loc_id = '{sBox}'""")
-        tRes = cur.fetchall()
-        self.write(json.dumps(res_to_json(tRes, cur)))
+        loc = loctree.tree(loctreeDB).get(sBox)
+        jRes = [] if loc is None else [{'NAME': loc.name, 'path': loc.path}]
+        self.write(json.dumps(jRes))
 
 
 @jwtauth
 class TransitVials(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sVials):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sIds = set(sVials.split())
-        for sVialId in sIds:
-            sOldBox, sOldName, sOldCoordinate = getVialPosition(sVialId, glassDB, loctreeDB, bcpvsDB)
-            sLogString = f"""location from {sOldBox} {sOldName}:{sOldCoordinate}\
- to Compound collection"""
-            logVialChange(glassDB, sVialId, sLogString)
-            logging.info(f'Placed {sVialId} in Compound collection')
-            # Update the new location of the vial, SL11013 is 'Compound collection'
-            sSql = f"""update {glassDB}.vial
-                       set location = 'SL34040', pos = '', updated_date = now()
-                       where vial_id = '{sVialId}'"""
-            sSlask = cur.execute(sSql)
+        saIds = list(OrderedDict.fromkeys(sVials.split()))
+        # SL34040 is 'Compound collection'
+        moveVials(saIds, 'SL34040', '', 'Compound collection', glassDB, loctreeDB)
+        logging.info(f'Placed {len(saIds)} vials in Compound collection')
 
 
 @jwtauth
 class UpdateVialPosition(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sVialId, sBoxId, sPos):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sMessage = 'All ok'
@@ -2504,35 +2482,45 @@ class UpdateVialPosition(tornado.web.RequestHandler):
             self.finish(json.dumps(jResult))
             return
 
-        # Check if the position already is occupied by another compound
-        sSql = f"""select vial_id from {glassDB}.vial
-                  where location='{sBoxId}' and pos='{sPos}'
-               """
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) != 0:
+        loc = loctree.tree(loctreeDB).get(sBoxId)
+        if loc is None:
+            self.set_status(400)
+            self.finish(json.dumps([{'message': 'Unknown box'}]))
+            return
+
+        # The position must be empty, checked in the move's transaction so
+        # two placements on one position can not both pass
+        if not moveVials([sVialId], sBoxId, sPos, f'{sBoxId} {loc.name}:{sPos}',
+                         glassDB, loctreeDB, lEmptyPos=True):
             self.set_status(400)
             logging.error('this position is occupied ' + sBoxId + ' ' + sPos)
             sMessage = 'Position not empty'
             jResult = [{'message':sMessage}]
             self.finish(json.dumps(jResult))
             return
-        sSql = f"""select name from {loctreeDB}.locations where loc_id = '{sBoxId}'"""
-        sSlask = cur.execute(sSql)
-        tLoc = cur.fetchall()
-
-        sOldBox, sOldName, sOldCoordinate = getVialPosition(sVialId, glassDB, loctreeDB, bcpvsDB)
-        sLogString = f"""location from {sOldBox} {sOldName}:{sOldCoordinate}\
- to {sBoxId} {tLoc[0][0]}:{sPos}"""
-
-        logVialChange(glassDB, sVialId, sLogString)
         logging.info('Placed ' + sVialId + ' in ' + sBoxId)
 
-        # Update the new location of the vial
-        sSql = f"""update {glassDB}.vial
-                   set location = '{sBoxId}', pos = '{sPos}', updated_date = now()
-                   where vial_id = '{sVialId}'"""
-        sSlask = cur.execute(sSql)
+@jwtauth
+class GetFreePositions(tornado.web.RequestHandler):
+    # Suggest where to put vials in a box: the first ?count=N free
+    # coordinates, after ?after=<coordinate> if given
+    @mydb.threaded
+    def get(self, sBox):
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            iCount = max(int(self.get_argument('count', '1')), 1)
+        except ValueError:
+            self.set_status(400)
+            self.finish('Bad count')
+            return
+        boxMap = getBoxMap(sBox, glassDB, loctreeDB, bcpvsDB)
+        if boxMap is None:
+            self.set_status(400)
+            self.finish('Unknown box')
+            return
+        saFree = boxMap.freePositions(iCount, self.get_argument('after', None))
+        self.finish(json.dumps({'box': sBox, 'positions': saFree}))
+
 
 @jwtauth
 class PrintPlate(tornado.web.RequestHandler):
@@ -2543,22 +2531,18 @@ class PrintPlate(tornado.web.RequestHandler):
 
 @jwtauth
 class printBox(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sBox):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
-        sSql = f"""select v.name box_description, l.name vial_type_desc
-        from {loctreeDB}.v_all_locations v, {loctreeDB}.location_type l
-        where v.type_id = l.type_id and
-        v.loc_id = '{sBox}'
-        """
-        #sSlask = cur.execute("""select box_description, vial_type_desc
-        #                        from vialdb.box b, vialdb.vial_type v
-        #                        where b.vial_type=v.vial_type
-        #                        and box_id = '%s'""" % (sBox))
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        sType = tRes[0][1]
-        sDescription = tRes[0][0]
+        tree = loctree.tree(loctreeDB)
+        loc = tree.get(sBox)
+        if loc is None:
+            self.set_status(400)
+            self.finish('Unknown box')
+            return
+        sType = tree.typeName(loc)
+        sDescription = loc.name
 
         zplVial = """^XA
 ^PR1
@@ -2604,16 +2588,14 @@ class printBox(tornado.web.RequestHandler):
 
 
         
-        f = open('/tmp/file.txt','w')
-        f.write(zplVial)
-        f.close()
-        #os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t /tmp/file.txt")
-        os.system("lp -h homer.scilifelab.se:631 -d CBCS-GK420t_plates /tmp/file.txt")
+        #sendToPrinter(zplVial, 'CBCS-GK420t')
+        sendToPrinter(zplVial, 'CBCS-GK420t_plates')
         self.finish("Printed")
 
 
 @jwtauth
 class GetBox(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sBox):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         jRes = getBoxFromDb(sBox, glassDB, loctreeDB, bcpvsDB)
@@ -2630,42 +2612,45 @@ class GetBox(tornado.web.RequestHandler):
 
 @jwtauth
 class searchVials(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sVials):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sIds = set(sVials.split())
-        tmpIds = ""
-        jRes = []
-        lNotFound = list()
-        for sId in sIds:
-            sSql = f"""
-            SELECT
-            v.vial_id AS vialId,
-            v.notebook_ref AS batchId,
-            c.compound_id AS compoundId,
-            v.location AS boxId,
-            l.name AS boxDescription,
-            '' as path,
-            v.pos,
-            c.biological_mw AS batchMolWeight,
-            ROUND(((v.net*1000/c.biological_mw)/v.conc)*1000000) AS dilution
-            FROM
-	    {glassDB}.vial v
-            left join {bcpvsDB}.batch c ON v.notebook_ref = c.notebook_ref
-            LEFT OUTER JOIN {loctreeDB}.locations l on v.location = l.loc_id
-            WHERE v.vial_id = '{sId}'
-            """
+        saIds = list(OrderedDict.fromkeys(sVials.split()))
+        sSql = f"""
+        SELECT
+        v.vial_id AS vialId,
+        v.notebook_ref AS batchId,
+        c.compound_id AS compoundId,
+        v.location AS boxId,
+        l.name AS boxDescription,
+        '' as path,
+        v.pos,
+        c.biological_mw AS batchMolWeight,
+        ROUND(((v.net*1000/c.biological_mw)/v.conc)*1000000) AS dilution
+        FROM
+        {glassDB}.vial v
+        left join {bcpvsDB}.batch c ON v.notebook_ref = c.notebook_ref
+        LEFT OUTER JOIN {loctreeDB}.locations l on v.location = l.loc_id
+        WHERE v.vial_id in ({{ids}})
+        """
+        try:
+            tRes = cur.fetchallIn(sSql, saIds)
+        except Exception as e:
+            logging.error("Error: " + str(e))
+            self.set_status(400)
+            self.finish()
+            return
 
-            try:
-                sSlask = cur.execute(sSql)
-            except Exception as e:
-                logging.error("Error: " + str(e))
+        dVials = dict()
+        if len(tRes) > 0:
+            for row in res_to_json(tRes, cur):
+                dVials[str(row['vialId']).lower()] = row
 
-                self.set_status(400)
-                self.finish()
-                return
-            tRes = cur.fetchall()
-            if len(tRes) != 1:
-                lNotFound.append(sId)
+        jRes = []
+        for sId in saIds:
+            if sId.lower() in dVials:
+                jRes.append(dVials[sId.lower()])
+            else:
                 jRes.append({"vialId":sId,
                              "pos":'',
                              "path":'',
@@ -2676,374 +2661,233 @@ class searchVials(tornado.web.RequestHandler):
                              "boxDescription":'Vial not in DB',
                              "batchMolWeight":'',
                              "dilution":''})
-                continue
-            #for row in tRes:
-            #    jRes.append({"vialId":row.vial_id,
-            #                 "coordinate":row.coordinate,
-            #                 "batchId":row.batch_id,
-            #                 "compoundId":row.compound_id,
-            #                 "cbkId":row.cbk_id,
-            #                 "boxId":row.box_id,
-            #                 "batchMolWeight":row.batch_formula_weight,
-            #                 "dilution":row.dilution})
-            jRes.append(res_to_json(tRes, cur)[0])
         self.finish(json.dumps(jRes))
 
 
 @jwtauth
 class VerifyLocation(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sSql = f"""
-        select * from {loctreeDB}.locations where loc_id = '{sLocation}'
-        """
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) != 1:
+        if loctree.tree(loctreeDB).get(sLocation) is None:
             self.set_status(400)
             self.finish('Unknown location')
         else:
             self.finish()
 
 
-@jwtauth
-class searchBatches(tornado.web.RequestHandler):
-
-    def getVials(self, sId):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            SELECT c.compound_id as compoundId,
-            v.notebook_ref as batchId,
-            v.vial_id vialId,
-            v.pos,
-            l.name as boxDescription,
-            l.path,
-            v.location as boxId,
-            'Vial' loctype
-            FROM {self.glassDB}.vial v,
-            {self.bcpvsDB}.batch c,
-            loctree.v_all_locations l
-            where
-            v.notebook_ref = c.notebook_ref and
-            l.loc_id = v.location and
-            l.name != 'Discarded' and
-            c.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            SELECT c.compound_id as compoundId,
-            v.notebook_ref as batchId,
-            v.vial_id vialId,
-            v.pos,
-            v.conc,
-            l.path,
-            l.name as boxDescription,
-            'Vial' loctype
-            FROM {self.glassDB}.vial v,
-            {self.bcpvsDB}.batch c,
-            loctree.v_all_locations l
-            where
-            v.notebook_ref = c.notebook_ref and
-            l.loc_id = v.location and
-            l.name != 'Discarded' and
-            v.notebook_ref = '{sId}'
-            '''
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        return tRes
-        
-        
-    def getMicrotubes(self, sId):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            select b.compound_id,
-            t.notebook_ref,
-            t.tube_id,
-            mt.position,
-            t.conc,
-            m.location,
-            l.name,
-            CONCAT('Microtube ', mt.matrix_id) loctype
-            from {self.microtubeDB}.matrix_tube mt, {self.microtubeDB}.tube t,
-            {self.microtubeDB}.matrix m, {self.bcpvsDB}.batch b, loctree.locations l
-            where mt.matrix_id = m.matrix_id and t.tube_id = mt.tube_id
-            and l.loc_id = m.location
-            and t.notebook_ref = b.notebook_ref and b.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            select b.compound_id,
-            t.notebook_ref,
-            t.tube_id,
-            mt.position,
-            t.conc,
-            m.location,
-            l.name,
-            CONCAT('Microtube ', mt.matrix_id) loctype
-            from {self.microtubeDB}.matrix_tube mt, {self.microtubeDB}.tube t,
-            {self.microtubeDB}.matrix m, {self.bcpvsDB}.batch b, loctree.locations l
-            where mt.matrix_id = m.matrix_id and t.tube_id = mt.tube_id
-            and l.loc_id = m.location
-            and t.notebook_ref = b.notebook_ref and t.notebook_ref = '{sId}'
-            '''
-            
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        return tRes
-        
-        
-    def getPlates(self, sId):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            select b.compound_id as compoundId,
-            cc.notebook_ref as batchId,
-            p.plate_id,
-            cc.well,
-            cc.conc,
-            p.comments,
-            p.loc_id,
-            "Plate" loctype
-            FROM {self.coolDB}.config cc, {self.bcpvsDB}.batch b, {self.coolDB}.plate p
-            where cc.notebook_ref = b.notebook_ref
-            and p.config_id = cc.config_id
-            and (loc_id <> 'Sent to User' OR loc_id IS NULL)
-            and p.DISCARDED is NULL
-            and b.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            select b.compound_id as compoundId,
-            cc.notebook_ref as batchId,
-            p.plate_id,
-            cc.well,
-            cc.conc,
-            p.comments,
-            p.loc_id,
-            "Plate" loctype
-            FROM {self.coolDB}.config cc, {self.bcpvsDB}.batch b, {self.coolDB}.plate p
-            where cc.notebook_ref = b.notebook_ref
-            and p.config_id = cc.config_id
-            and (loc_id <> 'Sent to User' OR loc_id IS NULL)
-            and p.DISCARDED is NULL
-            and cc.notebook_ref = '{sId}'
-            '''
-            
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        
-        return tRes
-    
-
-    def get(self, vials, tubes, plates, sBatches):
-        self.glassDB, self.coolDB, self.microtubeDB, self.loctreeDB, self.bcpvsDB = getDatabase(self)
-        
-        sIds = list(OrderedDict.fromkeys(sBatches.split()))
-
-        jRes = []
+def isCompoundId(sId):
+    return sId.startswith('CBK') or sId.startswith('SLL')
 
-        tmpIds = ""
-        for sId in sIds:
-            tmpIds += "'" + sId + "'"
-        stringIds = tmpIds.replace("''", "','")
-        tRes_tot = []
 
-        for sId in sIds:
+def getVialsForIds(glassDB, bcpvsDB, saIds, lCompound):
+    # The compound and batch searches return their columns in different order
+    if lCompound:
+        sSql = f'''
+        SELECT c.compound_id as compoundId,
+        v.notebook_ref as batchId,
+        v.vial_id vialId,
+        v.pos,
+        l.name as boxDescription,
+        l.path,
+        v.location as boxId,
+        'Vial' loctype,
+        c.compound_id
+        FROM {glassDB}.vial v,
+        {bcpvsDB}.batch c,
+        loctree.v_all_locations l
+        where
+        v.notebook_ref = c.notebook_ref and
+        l.loc_id = v.location and
+        l.name != 'Discarded' and
+        c.compound_id in ({{ids}})
+        '''
+    else:
+        sSql = f'''
+        SELECT c.compound_id as compoundId,
+        v.notebook_ref as batchId,
+        v.vial_id vialId,
+        v.pos,
+        v.conc,
+        l.path,
+        l.name as boxDescription,
+        'Vial' loctype,
+        v.notebook_ref
+        FROM {glassDB}.vial v,
+        {bcpvsDB}.batch c,
+        loctree.v_all_locations l
+        where
+        v.notebook_ref = c.notebook_ref and
+        l.loc_id = v.location and
+        l.name != 'Discarded' and
+        v.notebook_ref in ({{ids}})
+        '''
+    return cur.fetchallIn(sSql, saIds)
 
-            tRes1 = self.getMicrotubes(sId) if tubes == 'yes' else ()
-            tRes2 = self.getPlates(sId) if plates == 'yes' else ()
-            tRes3 = self.getVials(sId) if vials == 'yes' else ()
 
-            tRes1 = tRes1 if tRes1 is not None else []
-            tRes2 = tRes2 if tRes2 is not None else []
-            tRes3 = tRes3 if tRes3 is not None else []
-            tRes_tot += tRes1 + tRes2 + tRes3
+def getMicrotubesForIds(microtubeDB, bcpvsDB, saIds, lCompound):
+    sKey = 'b.compound_id' if lCompound else 't.notebook_ref'
+    sSql = f'''
+    select b.compound_id,
+    t.notebook_ref,
+    t.tube_id,
+    mt.position,
+    t.conc,
+    m.location,
+    l.name,
+    CONCAT('Microtube ', mt.matrix_id) loctype,
+    {sKey}
+    from {microtubeDB}.matrix_tube mt, {microtubeDB}.tube t,
+    {microtubeDB}.matrix m, {bcpvsDB}.batch b, loctree.locations l
+    where mt.matrix_id = m.matrix_id and t.tube_id = mt.tube_id
+    and l.loc_id = m.location
+    and t.notebook_ref = b.notebook_ref and {sKey} in ({{ids}})
+    '''
+    return cur.fetchallIn(sSql, saIds)
 
-        self.finish(json.dumps(tRes_tot))
 
+def getPlatesForIds(coolDB, bcpvsDB, saIds, lCompound):
+    sKey = 'b.compound_id' if lCompound else 'cc.notebook_ref'
+    sSql = f'''
+    select b.compound_id as compoundId,
+    cc.notebook_ref as batchId,
+    p.plate_id,
+    cc.well,
+    cc.conc,
+    p.comments,
+    p.loc_id,
+    "Plate" loctype,
+    {sKey}
+    FROM {coolDB}.config cc, {bcpvsDB}.batch b, {coolDB}.plate p
+    where cc.notebook_ref = b.notebook_ref
+    and p.config_id = cc.config_id
+    and (loc_id <> 'Sent to User' OR loc_id IS NULL)
+    and p.DISCARDED is NULL
+    and {sKey} in ({{ids}})
+    '''
+    return cur.fetchallIn(sSql, saIds)
 
-@jwtauth
-class searchBatchess(tornado.web.RequestHandler):
 
-    def getVials(self, sId, present):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            SELECT c.compound_id as compoundId,
-            v.notebook_ref as batchId,
-            v.vial_id vialId,
-            v.pos,
-            l.name as boxDescription,
-            l.path,
-            v.location as boxId,
-            'Vial' loctype
-            FROM {self.glassDB}.vial v,
-            {self.bcpvsDB}.batch c,
-            loctree.v_all_locations l
-            where
-            v.notebook_ref = c.notebook_ref and
-            l.loc_id = v.location and
-            l.name != 'Discarded' and
-            c.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            SELECT c.compound_id as compoundId,
-            v.notebook_ref as batchId,
-            v.vial_id vialId,
-            v.pos,
-            v.conc,
-            l.path,
-            l.name as boxDescription,
-            'Vial' loctype
-            FROM {self.glassDB}.vial v,
-            {self.bcpvsDB}.batch c,
-            loctree.v_all_locations l
-            where
-            v.notebook_ref = c.notebook_ref and
-            l.loc_id = v.location and
-            l.name != 'Discarded' and
-            v.notebook_ref = '{sId}'
-            '''
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
+def searchContainers(self, saIds, present, vials, tubes, plates):
+    '''Find the tubes, plates and vials holding any of saIds.
 
-        if present == 'no':
-            if len(tRes) == 0:
-                tRes = ((sId, '', '', '', '', '', '', ''),)
+    saIds mixes compound ids and batch ids. Each container type costs one
+    set query per id kind (chunked IN lists), the rows are then grouped
+    back by id. Rows come out per id in input order, tubes before plates
+    before vials. With present == 'no' only a placeholder row is returned
+    for every id and container type that has no hits.
+    '''
+    glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+    saCompounds = [sId for sId in saIds if isCompoundId(sId)]
+    saBatches = [sId for sId in saIds if not isCompoundId(sId)]
+
+    def groupById(getRows):
+        # Matching in MySQL is case insensitive so group on lower case keys
+        dRows = dict()
+        for saPart, lCompound in ((saCompounds, True), (saBatches, False)):
+            if len(saPart) == 0:
+                continue
+            for row in getRows(saPart, lCompound):
+                dRows.setdefault(str(row[-1]).lower(), []).append(tuple(row[:-1]))
+        return dRows
+
+    lookups = []
+    if tubes == 'yes':
+        lookups.append(groupById(lambda ids, lCmp: getMicrotubesForIds(microtubeDB, bcpvsDB, ids, lCmp)))
+    if plates == 'yes':
+        lookups.append(groupById(lambda ids, lCmp: getPlatesForIds(coolDB, bcpvsDB, ids, lCmp)))
+    if vials == 'yes':
+        lookups.append(groupById(lambda ids, lCmp: getVialsForIds(glassDB, bcpvsDB, ids, lCmp)))
+
+    tRes_tot = []
+    for sId in saIds:
+        for dRows in lookups:
+            tRows = dRows.get(sId.lower(), [])
+            if present == 'no':
+                if len(tRows) == 0:
+                    tRes_tot.append((sId, '', '', '', '', '', '', ''))
             else:
-                return ()
-
-        return tRes
-        
-        
-    def getMicrotubes(self, sId, present):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            select b.compound_id,
-            t.notebook_ref,
-            t.tube_id,
-            mt.position,
-            t.conc,
-            m.location,
-            l.name,
-            CONCAT('Microtube ', mt.matrix_id) loctype
-            from {self.microtubeDB}.matrix_tube mt, {self.microtubeDB}.tube t,
-            {self.microtubeDB}.matrix m, {self.bcpvsDB}.batch b, loctree.locations l
-            where mt.matrix_id = m.matrix_id and t.tube_id = mt.tube_id
-            and l.loc_id = m.location
-            and t.notebook_ref = b.notebook_ref and b.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            select b.compound_id,
-            t.notebook_ref,
-            t.tube_id,
-            mt.position,
-            t.conc,
-            m.location,
-            l.name,
-            CONCAT('Microtube ', mt.matrix_id) loctype
-            from {self.microtubeDB}.matrix_tube mt, {self.microtubeDB}.tube t,
-            {self.microtubeDB}.matrix m, {self.bcpvsDB}.batch b, loctree.locations l
-            where mt.matrix_id = m.matrix_id and t.tube_id = mt.tube_id
-            and l.loc_id = m.location
-            and t.notebook_ref = b.notebook_ref and t.notebook_ref = '{sId}'
-            '''
+                tRes_tot += tRows
+    return tRes_tot
 
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        if present == 'no':
-            if len(tRes) == 0:
-                tRes = ((sId, '', '', '', '', '', '', ''),)
-            else:
-                return ()
-        
-        return tRes
-        
-        
-    def getPlates(self, sId, present):
-        if sId.startswith('CBK') or sId.startswith('SLL'):
-            sSql = f'''
-            select b.compound_id as compoundId,
-            cc.notebook_ref as batchId,
-            p.plate_id,
-            cc.well,
-            cc.conc,
-            p.comments,
-            p.loc_id,
-            "Plate" loctype
-            FROM {self.coolDB}.config cc, {self.bcpvsDB}.batch b, {self.coolDB}.plate p
-            where cc.notebook_ref = b.notebook_ref
-            and p.config_id = cc.config_id
-            and (loc_id <> 'Sent to User' OR loc_id IS NULL)
-            and p.DISCARDED is NULL
-            and b.compound_id = '{sId}'
-            '''
-        else:
-            sSql = f'''
-            select b.compound_id as compoundId,
-            cc.notebook_ref as batchId,
-            p.plate_id,
-            cc.well,
-            cc.conc,
-            p.comments,
-            p.loc_id,
-            "Plate" loctype
-            FROM {self.coolDB}.config cc, {self.bcpvsDB}.batch b, {self.coolDB}.plate p
-            where cc.notebook_ref = b.notebook_ref
-            and p.config_id = cc.config_id
-            and (loc_id <> 'Sent to User' OR loc_id IS NULL)
-            and p.DISCARDED is NULL
-            and cc.notebook_ref = '{sId}'
-            '''
-            
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        if present == 'no':
-            if len(tRes) == 0:
-                tRes = ((sId, '', '', '', '', '', '', ''),)
-            else:
-                return ()
-        
-        return tRes
-    
 
-    def get(self, present, vials, tubes, plates, sBatches):
-        self.glassDB, self.coolDB, self.microtubeDB, self.loctreeDB, self.bcpvsDB = getDatabase(self)
-        
+@jwtauth
+class searchBatches(tornado.web.RequestHandler):
+    @mydb.threaded
+    def get(self, vials, tubes, plates, sBatches):
         sIds = list(OrderedDict.fromkeys(sBatches.split()))
+        tRes_tot = searchContainers(self, sIds, 'yes', vials, tubes, plates)
+        self.finish(json.dumps(tRes_tot))
 
-        jRes = []
 
-        tmpIds = ""
-        for sId in sIds:
-            tmpIds += "'" + sId + "'"
-        stringIds = tmpIds.replace("''", "','")
-        tRes_tot = []
+@jwtauth
+class searchBatchess(tornado.web.RequestHandler):
+    @mydb.threaded
+    def get(self, present, vials, tubes, plates, sBatches):
+        sIds = list(OrderedDict.fromkeys(sBatches.split()))
+        tRes_tot = searchContainers(self, sIds, present, vials, tubes, plates)
+        self.finish(json.dumps(tRes_tot))
 
-        for sId in sIds:
 
-            tRes1 = self.getMicrotubes(sId, present) if tubes == 'yes' else ()
-            tRes2 = self.getPlates(sId, present) if plates == 'yes' else ()
-            tRes3 = self.getVials(sId, present) if vials == 'yes' else ()
+@jwtauth
+class SearchBatchesBulk(tornado.web.RequestHandler):
+    # Number of ids searched between two progress lines
+    iChunkSize = 1000
+
+    def readRequest(self):
+        # JSON body: {"ids": [...], "present": "yes", "vials": "no", ...}
+        # otherwise a plain body of whitespace separated ids with the
+        # flags as query arguments
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            dBody = json.loads(self.request.body)
+            saIds = dBody.get('ids', [])
+            if isinstance(saIds, str):
+                saIds = saIds.split()
+            dFlags = {sFlag: dBody.get(sFlag, sDefault) for sFlag, sDefault in
+                      (('present', 'yes'), ('vials', 'no'), ('tubes', 'no'), ('plates', 'yes'))}
+        else:
+            saIds = tornado.escape.to_unicode(self.request.body).split()
+            dFlags = {sFlag: self.get_argument(sFlag, sDefault) for sFlag, sDefault in
+                      (('present', 'yes'), ('vials', 'no'), ('tubes', 'no'), ('plates', 'yes'))}
+        return list(OrderedDict.fromkeys(saIds)), dFlags
 
-            tRes1 = tRes1 if tRes1 is not None else []
-            tRes2 = tRes2 if tRes2 is not None else []
-            tRes3 = tRes3 if tRes3 is not None else []
-            tRes_tot += tRes1 + tRes2 + tRes3
+    async def post(self):
+        try:
+            saIds, dFlags = self.readRequest()
+        except Exception as e:
+            logging.error(f'Bad batch search request: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
+            return
 
-        self.finish(json.dumps(tRes_tot))
+        # One JSON document per line: result rows are arrays, progress
+        # lines are {"done": n, "total": N} objects
+        self.set_header('Content-Type', 'application/x-ndjson')
+        iTotal = len(saIds)
+        iDone = 0
+        for saChunk in mydb.chunks(saIds, self.iChunkSize):
+            tRows = await mydb.runThreaded(searchContainers, self, saChunk,
+                                           dFlags['present'], dFlags['vials'],
+                                           dFlags['tubes'], dFlags['plates'])
+            for row in tRows:
+                self.write(json.dumps(row) + '\n')
+            iDone += len(saChunk)
+            self.write(json.dumps({'done': iDone, 'total': iTotal}) + '\n')
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                logging.info('Batch search client went away')
+                return
+        self.finish()
 
 
         
 @jwtauth
 class DeleteLocation(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sSlask = cur.execute(f"""
-        select * from {loctreeDB}.locations where parent = '{sLocation}'
-        """)
-        tRes = cur.fetchall()
-        if len(tRes) != 0:
+        if len(loctree.tree(loctreeDB).children(sLocation)) != 0:
             self.set_status(400)
             self.finish(f'{sLocation} not empty, location has sublocations')
             return
@@ -3069,78 +2913,91 @@ class DeleteLocation(tornado.web.RequestHandler):
         sSlask = cur.execute(f"""
         delete from {loctreeDB}.locations where loc_id = '{sLocation}'
         """)
+        loctree.invalidate(loctreeDB)
 
 
 @jwtauth
 class GetFreeBoxes(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
 
         sOwner = getConnectionName(self)
-        
-        sSql = f"""
-        select ll.loc_id location,
-        FORMAT(ll.subpos - IFNULL(v_count, 0), 0) free_positions,
-        ll.path, ll.loc_type, ll.name name
-        from
-        (select location, count(vial_id) v_count
-        from {glassDB}.vial group by location) v
-        right outer join
-        (select l.loc_id, t.subpos, l.name, l.path, t.name loc_type
-        from {loctreeDB}.v_all_locations l, {loctreeDB}.location_type t, {loctreeDB}.locations lowner
-        where l.type_id = t.type_id and lowner.loc_id = l.loc_id and lowner.owner = '{sOwner}'
-        and t.subpos is not null and t.subpos < 300
-        ) ll
-        on v.location = ll.loc_id  order by path, free_positions
-        """
-
 
-        
-        sSlask = cur.execute(sSql)
-        tRes = cur.fetchall()
-        self.write(json.dumps(res_to_json(tRes, cur)))
+        # Boxes with less than 300 positions owned by sOwner, free
+        # positions from the maintained per box vial counts
+        tree = loctree.tree(loctreeDB)
+        dCounts = occupancy.counts(glassDB)
+        laBoxes = []
+        for loc in tree.dIds.values():
+            iPositions = tree.subpos(loc)
+            if loc.owner != sOwner or iPositions is None or iPositions >= 300:
+                continue
+            iFree = int(iPositions) - dCounts.get(str(loc.loc_id).upper(), 0)
+            laBoxes.append((loc.path, iFree, loc))
+        laBoxes.sort(key=lambda t: (t[0] or '', t[1]))
+
+        jRes = [{'location': loc.loc_id,
+                 'free_positions': f'{iFree:,}',
+                 'path': sPath,
+                 'loc_type': tree.typeName(loc),
+                 'name': loc.name} for sPath, iFree, loc in laBoxes]
+        self.write(json.dumps(jRes))
 
 
 @jwtauth
 class CreateMolImage(tornado.web.RequestHandler):
-    def get(self, sId):
+    async def get(self, sId):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        if exists(f'mols/{sId}.png'):
-            self.finish()
+        # Always asked for, the file in mols/ may be of an older structure.
+        # An unchanged structure is a cache hit
+        dPngs = await depict.service.depict([sId], glassDB, bcpvsDB)
+        png = dPngs.get(sId.upper())
+        if png is not None:
+            # The client fetches the image from the /mols/ static route
+            await IOLoop.current().run_in_executor(None, depict.writeMolsFile, sId.upper(), png)
+        self.finish()
+
+
+@jwtauth
+class PrefetchMolImages(tornado.web.RequestHandler):
+    async def post(self):
+        # Body: {"ids": [...]} or whitespace separated ids
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                saIds = json.loads(self.request.body)['ids']
+            else:
+                saIds = tornado.escape.to_unicode(self.request.body).split()
+        except Exception as e:
+            logging.error(f'Bad prefetch request: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
             return
-        sId = sId.lower()
-        m = re.search("v\d\d\d\d\d\d", sId)
-        sSql = ""
-        if m:
-            sSql = f"""select mol
-            from {bcpvsDB}.JCMOL_MOLTABLE m, {glassDB}.vial v, {bcpvsDB}.batch c
-            where v.notebook_ref = c.notebook_ref
-            and c.compound_id = m.compound_id and
-            vial_id = '{sId}'
-            """
-        else:
-            sId = sId.upper()
-            m = re.search("CBK\d\d\d\d\d\d", sId)
-            if m:
-                sSql = f"""select mol
-                from {bcpvsDB}.JCMOL_MOLTABLE m
-                where
-                m.compound_id = '{sId}'
-                """
+        iImages = await depict.service.prefetch(saIds, glassDB, bcpvsDB)
+        self.finish(json.dumps({'images': iImages}))
+
+
+@jwtauth
+class GetMolImages(tornado.web.RequestHandler):
+    async def post(self):
+        # Body: {"ids": [...]} or whitespace separated ids. Answers with a
+        # zip holding <ID>.png for every id that has a structure.
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                saIds = json.loads(self.request.body)['ids']
             else:
-                sSql = f"""
-                select mol
-                from {bcpvsDB}.JCMOL_MOLTABLE m, {bcpvsDB}.batch b
-                where
-                m.compound_id = b.compound_id and
-                b.notebook_ref = '{sId}'
-                """
-        if sSql != "":
-            cur.execute(sSql)
-            molfile = cur.fetchall()
-            if len(molfile) > 0 and molfile[0][0] != None:
-                createPngFromMolfile(sId.upper(), molfile[0][0])
-        self.finish()
+                saIds = tornado.escape.to_unicode(self.request.body).split()
+        except Exception as e:
+            logging.error(f'Bad mol images request: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
+            return
+        dPngs = await depict.service.depict(saIds, glassDB, bcpvsDB)
+        zipped = await IOLoop.current().run_in_executor(None, depict.zipPngs, dPngs)
+        self.set_header('Content-Type', 'application/zip')
+        self.finish(zipped)
 
 
 class GetDatabase(tornado.web.RequestHandler):
@@ -3151,61 +3008,72 @@ class GetDatabase(tornado.web.RequestHandler):
 
 @jwtauth
 class GetLocationByStorage(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sStorage):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         if sStorage == 'Freezer':
-            sSql = f"""select loc_id, path from {loctreeDB}.v_all_locations
-            where type_id in (29, 31, 69, 6, 8, 24, 25, 27) order by type_id, path
-            """
+            saTypes = {29, 31, 69, 6, 8, 24, 25, 27}
         else:
-            sSql = f"""select loc_id, path from {loctreeDB}.v_all_locations
-            where type_id in (7, 9) order by type_id, path"""
-
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        self.write(json.dumps(res_to_json(tRes, cur)))
+            saTypes = {7, 9}
+        tree = loctree.tree(loctreeDB)
+        laLocs = sorted([loc for loc in tree.dIds.values() if loc.type_id in saTypes],
+                        key=lambda loc: (loc.type_id, loc.path))
+        self.write(json.dumps([{'loc_id': loc.loc_id, 'path': loc.path} for loc in laLocs]))
 
 
 @jwtauth
 class GetLocationPath(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        sSql = f'''
-        select l.loc_id, l.path
-        from {loctreeDB}.v_all_locations l
-        where
-        l.loc_id = '{sLocation}'
-        or l.name = '{sLocation}'
-        '''
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        self.write(json.dumps(res_to_json(tRes, cur)))
+        tree = loctree.tree(loctreeDB)
+        laLocs = list(tree.byName(sLocation))
+        loc = tree.get(sLocation)
+        if loc is not None and loc not in laLocs:
+            laLocs.insert(0, loc)
+        self.write(json.dumps([{'LOC_ID': loc.loc_id, 'path': loc.path} for loc in laLocs]))
 
 
 @jwtauth
 class GetLocationChildren(tornado.web.RequestHandler):
+    @mydb.threaded
     def get(self, sLocation):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
-        if sLocation == 'root':
-            sSql = f'''
-            select l.loc_id, l.name, l.path, t.name type, t.use_subpos has_children
-            from {loctreeDB}.v_all_locations l, {loctreeDB}.location_type t
-            where l.type_id = t.type_id and
-            l.parent is null'''
-        else:
-            sSql = f'''
-            select l.loc_id, l.name, l.path, t.name type, t.use_subpos has_children
-            from {loctreeDB}.v_all_locations l, {loctreeDB}.location_type t
-            where l.type_id = t.type_id and
-            l.parent = '{sLocation}'
-            '''
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        self.write(json.dumps(res_to_json(tRes, cur)))
+        tree = loctree.tree(loctreeDB)
+        self.write(json.dumps([tree.nodeJson(loc) for loc in tree.children(sLocation)]))
+
+
+@jwtauth
+class GetLocationTree(tornado.web.RequestHandler):
+    # The locations below sLocation ('root' for the whole tree), ?depth=N
+    # levels down or all levels. The ETag changes whenever the tree does.
+    @mydb.threaded
+    def get(self, sLocation):
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        try:
+            iDepth = max(int(self.get_argument('depth', '0')), 0)
+        except ValueError:
+            self.set_status(400)
+            self.finish('Bad depth')
+            return
+        tree = loctree.tree(loctreeDB)
+        if sLocation != 'root' and tree.get(sLocation) is None:
+            self.set_status(404)
+            self.finish('Unknown location')
+            return
+        self.set_header('Etag', f'"{tree.iVersion}-{sLocation}-{iDepth}"')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        self.finish(json.dumps({'location': sLocation,
+                                'columns': ['loc_id', 'parent', 'name', 'type', 'has_children'],
+                                'locations': tree.subtree(sLocation, iDepth)}))
 
 
 @jwtauth
 class AddBox(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sParent, sBoxName, sBoxSize):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sNewLocId = getNewLocId(loctreeDB)
@@ -3226,10 +3094,12 @@ class AddBox(tornado.web.RequestHandler):
         ('{sNewLocId}', '{sParent}', '{loc_type}', now(), '{sBoxName}', '{sOwner}')
         '''
         cur.execute(sSql)
+        loctree.invalidate(loctreeDB)
 
 
 @jwtauth
 class AddLocation(tornado.web.RequestHandler):
+    @mydb.threaded
     def put(self, sParent, sLocationName, sLocationType):
         glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
         sNewLocId = getNewLocId(loctreeDB)
@@ -3246,4 +3116,5 @@ class AddLocation(tornado.web.RequestHandler):
         ('{sNewLocId}', '{sParent}', '{loc_type}', now(), '{sLocationName}')
         '''
         cur.execute(sSql)
+        loctree.invalidate(loctreeDB)
 
@@ -8,6 +8,7 @@ import os
 import application
 import exportSdf
 import chembl_export
+import refdata
 from tornado.options import define, options
 import logging
 from tornado.log import enable_pretty_logging
@@ -163,16 +164,23 @@ def make_app():
         (r"/getVersionData", getVersionData),
         (r"/initiateSdfDownload", exportSdf.InitiateDownload),
         (r"/addMolfileToSdf/(?P<sTicket>[^\/]+)/(?P<sId>[^\/]+)", exportSdf.AddMolfileToSdf),
+        (r"/submitExport", exportSdf.SubmitExport),
+        (r"/exportJob/(?P<sJob>[0-9a-f]+)", exportSdf.ExportJobStatus),
+        (r"/exportJob/(?P<sJob>[0-9a-f]+)/download", exportSdf.DownloadExport, {"path": "dist/export/"}),
         (r"/uploadVersionNo", application.UploadVersionNo),
         (r"/getCelloBinary/(?P<os_name>[^\/]+)", getCelloBinary),
+        (r"/refreshReferenceData", application.RefreshReferenceData),
         (r"/getDatabase", application.GetDatabase),
         (r"/mols/(.*)", tornado.web.StaticFileHandler, {"path": "mols/"}),
         (r"/dist/(.*)", tornado.web.StaticFileHandler, {"path": "dist/"}),
         (r"/createMolImage/(?P<sId>[^\/]+)", application.CreateMolImage),
+        (r"/prefetchMolImages", application.PrefetchMolImages),
+        (r"/getMolImages", application.GetMolImages),
         (r"/uploadBinary", application.UploadBinary),
         (r"/uploadLauncher", application.UploadLauncher),
         (r"/uploadTaredVials", application.UploadTaredVials),
         (r"/getLocationPath/(?P<sLocation>[^\/]+)", application.GetLocationPath),
+        (r"/getLocationTree/(?P<sLocation>[^\/]+)", application.GetLocationTree),
         (r"/getLocationChildren/(?P<sLocation>[^\/]+)", application.GetLocationChildren),
         (r"/getLocationByStorage/(?P<sStorage>[^\/]+)", application.GetLocationByStorage),
         (r"/createEmptyVials/(?P<sNrOfVials>[^\/]+)", application.CreateEmptyVials),
@@ -219,14 +227,18 @@ def make_app():
         (r"/getListInfoById/(?P<listId>[^\/]+)", application.GetListInfoById),
         (r"/getLists/(?P<listType>[^\/]+)", application.GetLists),
         (r"/getSDFForElements/(?P<joinedIds>[^\/]+)", application.GetSDFForElements),
+        (r"/getSDFForElements", application.GetSDFForElements),
         (r"/checkListName/(?P<userName>[^\/]+)/(?P<listName>[^\/]+)", application.CheckListName),
         (r"/saveListElements/(?P<accuList>[^\/]+)/(?P<listId>[^\/]+)", application.SaveListElements),
+        (r"/saveListElements/(?P<listId>[^\/]+)", application.SaveListElements),
         (r"/searchLists/(?P<plateListId>[^\/]+)/(?P<batchListId>[^\/]+)", application.SearchLists),
         (r"/getEchoData/(?P<plateListId>[^\/]+)/(?P<sCtrlPlate>[^\/]+)/(?P<sDMSOplate>[^\/]+)", application.GetEchoData),
         (r"/validateBatches/(?P<batches>[^\/]+)/(?P<listType>[^\/]+)", application.ValidateBatches),
+        (r"/validateBatches/(?P<listType>[^\/]+)", application.ValidateBatches),
         (r"/searchBatches/(?P<present>[^\/]+)/(?P<vials>[^\/]+)/(?P<tubes>[^\/]+)/(?P<plates>[^\/]+)/(?P<sBatches>[^\/]+)", application.searchBatchess),
         (r"/searchBatches/(?P<vials>[^\/]+)/(?P<tubes>[^\/]+)/(?P<plates>[^\/]+)/(?P<sBatches>[^\/]+)", application.searchBatches),
         (r"/searchBatches/(?P<present>[^\/]+)/(?P<vials>[^\/]+)/(?P<tubes>[^\/]+)/(?P<plates>[^\/]+)/(?P<sBatches>[^\/]+)", application.searchBatchess),
+        (r"/searchBatchesBulk", application.SearchBatchesBulk),
         (r"/searchVials/(?P<sVials>[^\/]+)", application.searchVials),
         (r"/transitVials/(?P<sVials>[^\/]+)", application.TransitVials),
         (r"/printVial/(?P<sVial>[^\/]+)", application.printVial),
@@ -234,6 +246,7 @@ def make_app():
         (r"/discardPlate/(?P<sPlate>[^\/]+)", application.DiscardPlate),
         (r"/verifyLocation/(?P<sLocation>[^\/]+)", application.VerifyLocation),
         (r"/deleteLocation/(?P<sLocation>[^\/]+)", application.DeleteLocation),
+        (r"/getFreePositions/(?P<sBox>[^\/]+)", application.GetFreePositions),
         (r"/updateVialPosition/(?P<sVialId>[^\/]+)/(?P<sBoxId>[^\/]+)/(?P<sPos>[^\/]+)",
          application.UpdateVialPosition),
         (r"/editVial", application.EditVial),
@@ -254,6 +267,7 @@ def make_app():
 
 if __name__ == "__main__":
     app = make_app()
+    refdata.preload()
     app.listen(8082, max_buffer_size=200000000)
     tornado.autoreload.start()
     
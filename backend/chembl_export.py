@@ -9,24 +9,15 @@ import util
 import mydb
 import config
 import zipfile
+import sdf
+import exportjobs
 
-db = mydb.disconnectSafeConnect()
-cur = db.cursor()
+# Per-request cursor on a pooled connection, see mydb.pooled
+cur = mydb.pooledCursor()
 
 
-def getMolfile(sCmpId):
-    sSql = f"""select mol from bcpvs.JCMOL_MOLTABLE where compound_id = '{sCmpId}'"""
-    cur.execute(sSql)
-    res = cur.fetchall()
-    sMol = ''
-    if len(res) == 1:
-        sMol = f'''{res[0][0]}
-> <CIDX>
-{sCmpId}
-
-$$$$
-'''
-    return sMol
+def cidxTags(tItem, sCompound):
+    return [('CIDX', sCompound)]
 
 '''
 Sample data:
@@ -61,15 +52,15 @@ TEOID
 
 
 def exportFromBatches(saBatches, sRIDX, compound_record_file, molfile_file):
+    sSql = f"""select compound_id, "{sRIDX}", notebook_ref, compound_id from bcpvs.batch where notebook_ref in ({{ids}})"""
+    dRes = {str(row[2]).upper(): row for row in cur.fetchallIn(sSql, saBatches)}
+    laItems = []
     for batch in saBatches:
-        sMol = ''
-        sSql = f"""select compound_id, "{sRIDX}", notebook_ref, compound_id from bcpvs.batch where notebook_ref = '{batch}'"""
-        cur.execute(sSql)
-        res = cur.fetchall()
-        if len(res) == 1:
-            sMol = getMolfile(res[0][0])
-            compound_record_file.write('\t'.join(map(str, res[0])) + '\n')
-            molfile_file.write(sMol)
+        row = dRes.get(batch.upper())
+        if row is not None:
+            compound_record_file.write('\t'.join(map(str, row)) + '\n')
+            laItems.append((row[0],))
+    sdf.writeSdf(molfile_file, laItems, cidxTags)
 
 
 
@@ -224,12 +215,7 @@ def exportFromElnProject(saCompounds,
         sMolfile = ''
         
         if len(sMol) > 5 and sPrevCompId != sCmpId:
-            sMolfile = f'''{sMol.decode('utf-8')}
-> <CIDX>
-{sCmpId}
-
-$$$$
-'''
+            sMolfile = sdf.sdfRecord(sMol.decode('utf-8'), cidxTags(row, sCmpId))
             compound_record_file.write(f'''{sCmpId}\t{sRIDX}\t{sBatch}\t{sCmpId}\n''')
             molfile_file.write(sMolfile)
         sPrevCompId = sCmpId
@@ -248,6 +234,7 @@ $$$$
 class ChemblExport(tornado.web.RequestHandler):
     def get(self, sRIDX, sBatches):
         pass
+    @mydb.threaded
     def post(self, *args, **kwargs):
         try:
             sRIDX = self.get_argument("RIDX").strip()
@@ -267,9 +254,7 @@ class ChemblExport(tornado.web.RequestHandler):
         '''
         saBatches = sBatches.split()
         sMol = ''
-        random_number = str(random.randint(0, 1000000))
-        dir_name = f'dist/export/{random_number}'
-        os.makedirs(dir_name, exist_ok=True)
+        dir_name = f'dist/export/{exportjobs.newTicket()}'
         file_path = dir_name + "/COMPOUND_RECORD.tsv"
         molfile_path = dir_name + "/COMPOUND_CTAB.sdf"
         
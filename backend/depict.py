@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from tornado.ioloop import IOLoop
+import mydb
+import depictworker
+
+cur = mydb.pooledCursor()
+
+# Worker processes doing the RDKit drawing
+DEPICT_WORKERS = 2
+# Number of PNGs kept in memory
+DEPICT_CACHE_SIZE = 2000
+# Content addressed PNGs, one file per structure and depiction parameters
+DEPICT_CACHE_DIR = 'mols/cache'
+# Legacy per id PNGs served by the /mols/ static route
+MOLS_DIR = 'mols'
+IMAGE_SIZE = (300, 300)
+
+
+class LruCache(object):
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+
+def compoundIdsFor(saIds, glassDB, bcpvsDB):
+    '''Map vial, batch and compound ids to compound ids, one query per kind.'''
+    saVials = []
+    saBatches = []
+    dCompounds = dict()
+    for sId in saIds:
+        if re.search(r"v\d\d\d\d\d\d", sId.lower()):
+            saVials.append(sId)
+        elif re.search(r"CBK\d\d\d\d\d\d", sId.upper()):
+            dCompounds[sId.upper()] = sId.upper()
+        else:
+            saBatches.append(sId)
+
+    if len(saVials) > 0:
+        sSql = f"""select v.vial_id, c.compound_id
+        from {glassDB}.vial v, {bcpvsDB}.batch c
+        where v.notebook_ref = c.notebook_ref
+        and v.vial_id in ({{ids}})
+        """
+        for row in cur.fetchallIn(sSql, saVials):
+            dCompounds[str(row[0]).upper()] = row[1]
+    if len(saBatches) > 0:
+        sSql = f"""select notebook_ref, compound_id
+        from {bcpvsDB}.batch
+        where notebook_ref in ({{ids}})
+        """
+        for row in cur.fetchallIn(sSql, saBatches):
+            dCompounds[str(row[0]).upper()] = row[1]
+    return dCompounds
+
+
+def structureHashes(saCompounds, bcpvsDB):
+    '''Return {compound_id: md5 of the registered mol}, one query. Part of
+    the cache key, so an edited structure is drawn again.'''
+    sSql = f"""select compound_id, md5(mol)
+    from {bcpvsDB}.JCMOL_MOLTABLE
+    where compound_id in ({{ids}}) and mol is not null
+    """
+    return {str(row[0]).upper(): row[1] for row in cur.fetchallIn(sSql, saCompounds)}
+
+
+def depictionMolfiles(saCompounds, bcpvsDB):
+    '''Return {compound_id: molfile} cleaned up by moldepict, one query.'''
+    sSql = f"""select compound_id, bin2mol(moldepict(mol))
+    from {bcpvsDB}.JCMOL_MOLTABLE
+    where compound_id in ({{ids}}) and mol is not null
+    """
+    dMolfiles = dict()
+    for row in cur.fetchallIn(sSql, saCompounds):
+        if row[1] is not None:
+            dMolfiles[str(row[0]).upper()] = row[1]
+    return dMolfiles
+
+
+class DepictionService(object):
+    '''Structure images for vial, batch and compound ids.
+
+    Images are looked up in a bounded in-memory LRU, then in a content
+    addressed disk cache keyed by compound id, a hash of its molfile and
+    depiction parameters.
+    Misses are fetched from the database in one set query and drawn in
+    a process pool, so rendering never runs on the IOLoop.
+    '''
+
+    def __init__(self, iWorkers=DEPICT_WORKERS, iCacheSize=DEPICT_CACHE_SIZE,
+                 sCacheDir=DEPICT_CACHE_DIR, tSize=IMAGE_SIZE):
+        self.iWorkers = iWorkers
+        self.memory = LruCache(iCacheSize)
+        self.sCacheDir = sCacheDir
+        self.tSize = tSize
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def processPool(self):
+        # Started on first use, spawned so that the workers do not inherit
+        # the server's threads and sockets, see depictworker
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.iWorkers,
+                    mp_context=depictworker.WorkerContext())
+            return self.pool
+
+    def cacheKey(self, sCompound, sHash, tSize):
+        sParams = f'{sCompound.upper()}|{sHash}|{tSize[0]}x{tSize[1]}'
+        return hashlib.sha1(sParams.encode()).hexdigest()
+
+    def cachePath(self, sKey):
+        return os.path.join(self.sCacheDir, sKey[:2], sKey + '.png')
+
+    def readCached(self, saKeys):
+        # Runs on a worker thread, fills the LRU from disk
+        dPngs = dict()
+        for sKey in saKeys:
+            try:
+                with open(self.cachePath(sKey), 'rb') as f:
+                    dPngs[sKey] = f.read()
+                self.memory.put(sKey, dPngs[sKey])
+            except OSError:
+                pass
+        return dPngs
+
+    def writeCached(self, dPngs):
+        for sKey, png in dPngs.items():
+            sPath = self.cachePath(sKey)
+            try:
+                os.makedirs(os.path.dirname(sPath), exist_ok=True)
+                sTmp = f'{sPath}.{os.getpid()}.{threading.get_ident()}'
+                with open(sTmp, 'wb') as f:
+                    f.write(png)
+                os.replace(sTmp, sPath)
+            except OSError as e:
+                logging.error(f'Failed to cache depiction {sKey}: {str(e)}')
+
+    async def depict(self, saIds, glassDB, bcpvsDB, tSize=None):
+        '''Return {id: PNG bytes or None} for saIds.'''
+        tSize = tuple(tSize or self.tSize)
+        saIds = list(OrderedDict.fromkeys(sId.upper() for sId in saIds))
+        dCompounds = await mydb.runThreaded(compoundIdsFor, saIds, glassDB, bcpvsDB)
+        dHashes = dict()
+        if len(dCompounds) > 0:
+            dHashes = await mydb.runThreaded(structureHashes,
+                                             list(set(dCompounds.values())), bcpvsDB)
+        # Compounds without a structure get no key and no image
+        dKeys = {sCompound: self.cacheKey(sCompound, sHash, tSize)
+                 for sCompound, sHash in dHashes.items()}
+
+        dPngs = dict()
+        saMissing = []
+        for sCompound, sKey in dKeys.items():
+            png = self.memory.get(sKey)
+            if png is not None:
+                dPngs[sKey] = png
+            else:
+                saMissing.append(sKey)
+        if len(saMissing) > 0:
+            dPngs.update(await IOLoop.current().run_in_executor(
+                None, self.readCached, saMissing))
+
+        saDraw = [sCompound for sCompound, sKey in dKeys.items() if sKey not in dPngs]
+        if len(saDraw) > 0:
+            dMolfiles = await mydb.runThreaded(depictionMolfiles, saDraw, bcpvsDB)
+            saDraw = [sCompound for sCompound in saDraw if sCompound in dMolfiles]
+            pool = self.processPool()
+            loop = IOLoop.current()
+            laPngs = await asyncio.gather(*[
+                loop.run_in_executor(pool, depictworker.renderPng, dMolfiles[sCompound], tSize)
+                for sCompound in saDraw])
+            dNew = dict()
+            for sCompound, png in zip(saDraw, laPngs):
+                if png is None:
+                    logging.error(f"regno {sCompound} is nostruct")
+                    continue
+                dNew[dKeys[sCompound]] = png
+                self.memory.put(dKeys[sCompound], png)
+            dPngs.update(dNew)
+            if len(dNew) > 0:
+                await loop.run_in_executor(None, self.writeCached, dNew)
+
+        dRes = dict()
+        for sId in saIds:
+            sKey = dKeys.get(str(dCompounds.get(sId)).upper())
+            dRes[sId] = dPngs.get(sKey) if sKey else None
+        return dRes
+
+    async def prefetch(self, saIds, glassDB, bcpvsDB):
+        '''Render saIds into the caches, returns the number of images.'''
+        dRes = await self.depict(saIds, glassDB, bcpvsDB)
+        return len([png for png in dRes.values() if png is not None])
+
+
+def writeMolsFile(sId, png):
+    '''Write the PNG where the /mols/ static route serves it from.'''
+    sPath = os.path.join(MOLS_DIR, f'{sId}.png')
+    sTmp = f'{sPath}.{os.getpid()}.{threading.get_ident()}'
+    with open(sTmp, 'wb') as f:
+        f.write(png)
+    os.replace(sTmp, sPath)
+
+
+def zipPngs(dPngs):
+    '''Pack {id: PNG bytes} into a zip of <id>.png, ids without image are left out.'''
+    buffer = io.BytesIO()
+    # PNGs are already compressed
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:
+        for sId, png in dPngs.items():
+            if png is not None:
+                z.writestr(f'{sId}.png', png)
+    return buffer.getvalue()
+
+
+service = DepictionService()
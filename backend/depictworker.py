@@ -0,0 +1,45 @@
+import io
+import sys
+import threading
+import types
+import multiprocessing.context
+from rdkit import Chem
+from rdkit.Chem import Draw
+
+# Runs in DepictionService's worker processes, so it imports nothing of
+# the server
+
+
+def renderPng(molfile, tSize):
+    '''Draw a molfile as PNG bytes, None if RDKit can not read it.'''
+    try:
+        m = Chem.MolFromMolBlock(molfile)
+        if m is None:
+            return None
+        image = Draw.MolToImage(m, size=tSize)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+    except Exception:
+        return None
+
+
+mainLock = threading.Lock()
+
+
+class WorkerProcess(multiprocessing.context.SpawnProcess):
+    def start(self):
+        # A spawned child runs the parent's __main__ again, which is the
+        # whole server setup. It is hidden while the child is started, so
+        # the worker only imports this module.
+        with mainLock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                super().start()
+            finally:
+                sys.modules['__main__'] = main
+
+
+class WorkerContext(multiprocessing.context.SpawnContext):
+    Process = WorkerProcess
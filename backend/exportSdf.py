@@ -5,137 +5,106 @@ import datetime
 import time
 import os, random, string
 import re
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
 import util
 import mydb
 import config
+import sdf
+import exportjobs
+from application import getDatabase
+
+# Per-request cursor on a pooled connection, see mydb.pooled
+cur = mydb.pooledCursor()
+
+# export.js sends the next addMolfileToSdf without waiting for the last
+# one, the appends run one at a time in the order the requests arrive
+appendExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sdfappend')
 
-db = mydb.disconnectSafeConnect()
-cur = db.cursor()
-
-
-def exportPlates(self, elements, sTicket):
-    sError = dict()
-    sdfile = f'dist/export/{sTicket}/export.sdf'
-    try:
-        file = open(sdfile, 'a')
-    except Exception as e:
-        return
-    
- 
-    for sPlate in elements:
-        sSql = f"""
-        SELECT
-        p.plate_id,
-        compound_id,
-        notebook_ref
-        FROM cool.config c, cool.plate p, cool.plating_sequence ps
-        WHERE p.CONFIG_ID = c.CONFIG_ID
-        and p.TYPE_ID = ps.TYPE_ID
-        and c.WELL = ps.WELL and p.plate_id = '{sPlate}'
-        order by ps.seq"""
-
-        cur.execute(sSql)
-        tRes = cur.fetchall()
-        if len(tRes) == 0:
-            sError[sPlate] = 'Plate not found'
-            continue
-
-        for row in tRes:
-            sSql = f'''select mol, m.compound_id, notebook_ref as batch_id from bcpvs.JCMOL_MOLTABLE m, bcpvs.batch b 
-            where
-            m.compound_id = b.compound_id and 
-            notebook_ref = '{row[2]}'
-            '''
-            cur.execute(sSql)
-            tRes = cur.fetchall()
-            if len(tRes) == 1:
-                sMol = f'''{tRes[0][0]}
-> <COMPOUND_ID>
-{tRes[0][1]}
-
-> <BATCH_ID>
-{tRes[0][2]}
-
-> <PLATE_ID>
-{sPlate}
-
-$$$$
-'''
-                file.write(sMol)
-            else:
-                sError[id] = 'No molfile'
-    self.finish(json.dumps(sError))
-    file.close()
-    
 
 class InitiateDownload(tornado.web.RequestHandler):
     def get(self, *args, **kwargs):
-        random_number = str(random.randint(0, 1000000))
-        self.finish(random_number)
-        dir_name = f'dist/export/{random_number}'
-        os.makedirs(dir_name, exist_ok=True)
+        self.finish(exportjobs.newTicket())
 
 
 class AddMolfileToSdf(tornado.web.RequestHandler):
-    def get(self, sTicket, sId):
+    def appendSdf(self, sTicket, elements):
         sdfile = f'dist/export/{sTicket}/export.sdf'
-        elements = sId.split(',')
-
-        # Add single quotes around each element and join them back together
-        result_string = ','.join(["'" + element + "'" for element in elements])
-
         sError = dict()
-        pattern = re.compile(r'^[Pp]\d{6}$')
-        if bool(pattern.match(elements[0])):
-            exportPlates(self, elements, sTicket)
+        laItems = exportjobs.exportItems(elements, sError)
+        with open(sdfile, 'a') as file:
+            sdf.writeSdf(file, laItems, exportjobs.sdfTags, dErrors=sError)
+        return sError
+
+    async def get(self, sTicket, sId):
+        if not re.match(r'^[0-9a-zA-Z]+$', sTicket):
+            self.set_status(400)
+            self.finish('Bad ticket')
             return
-        
-        sSql = ''
-        if sId[:3].upper() == "CBK":
-            with open(sdfile, 'a') as file:
-                for id in elements:
-                    if id =='':
-                        continue
-                    sSql = f'''
-                    select mol, compound_id from bcpvs.JCMOL_MOLTABLE where compound_id = '{id}'
-                    '''
-                    cur.execute(sSql)
-                    tRes = cur.fetchall()
-                    if len(tRes) == 1:
-                        sMol = f'''{tRes[0][0]}
-> <COMPOUND_ID>
-{tRes[0][1]}
-$$$$
-'''
-                        file.write(sMol)
-                    else:
-                        sError[id] = 'Error'
-        else:
-            with open(sdfile, 'a') as file:
-                for id in elements:
-                    if id =='':
-                        continue
-                    sSql = f'''select mol, m.compound_id, notebook_ref as batch_id from bcpvs.JCMOL_MOLTABLE m, bcpvs.batch b 
-                    where
-                    m.compound_id = b.compound_id and 
-                    notebook_ref = '{id}'
-                    '''
-                    cur.execute(sSql)
-                    tRes = cur.fetchall()
-                    if len(tRes) == 1:
-                        sMol = f'''{tRes[0][0]}
-> <COMPOUND_ID>
-{tRes[0][1]}
-
-> <BATCH_ID>
-{tRes[0][2]}
-$$$$
-'''
-                        file.write(sMol)
-                    else:
-                        sError[id] = 'Error'
+        sError = await IOLoop.current().run_in_executor(
+            appendExecutor, mydb.pooled(self.appendSdf, exportjobs.pool), sTicket, sId.split(','))
         self.finish(json.dumps(sError))
 
+
+class SubmitExport(tornado.web.RequestHandler):
+    # Body: {"ids": [...], "smiles": false}, compound, batch or plate ids.
+    # With "smiles" the records are those of getSDFForElements. The SDF
+    # is written by a background worker, poll exportJob/<job> for progress
+    def post(self):
+        try:
+            dBody = json.loads(self.request.body)
+            saIds = dBody['ids']
+            bSmiles = bool(dBody.get('smiles', False))
+            if isinstance(saIds, str):
+                saIds = saIds.split()
+        except Exception as e:
+            logging.error(f'Bad export request: {str(e)}')
+            self.set_status(400)
+            self.finish('Bad request body')
+            return
+        glassDB, coolDB, microtubeDB, loctreeDB, bcpvsDB = getDatabase(self)
+        if bSmiles:
+            # Read from bcpvs, as getSDFForElements does
+            bcpvsDB = 'bcpvs'
+        job = exportjobs.jobs.submit(saIds, coolDB, bcpvsDB, bSmiles)
+        self.finish(json.dumps(job.status()))
+
+
+class ExportJobStatus(tornado.web.RequestHandler):
+    def get(self, sJob):
+        job = exportjobs.jobs.get(sJob)
+        if job is None:
+            self.set_status(404)
+            self.finish('No such export')
+            return
+        self.finish(json.dumps(job.status()))
+
+    def delete(self, sJob):
+        job = exportjobs.jobs.cancel(sJob)
+        if job is None:
+            self.set_status(404)
+            self.finish('No such export')
+            return
+        self.finish(json.dumps(job.status()))
+
+
+class DownloadExport(tornado.web.StaticFileHandler):
+    # StaticFileHandler answers Range requests, so an interrupted download
+    # can be resumed
+    async def get(self, sJob, include_body=True):
+        job = exportjobs.jobs.get(sJob)
+        if job is None or job.sState != 'done':
+            self.set_status(404)
+            self.finish('Export not ready')
+            return
+        self.set_header('Content-Disposition', f'attachment; filename="{sJob}.sdf"')
+        await super().get(f'{sJob}/export.sdf', include_body)
+
+    def head(self, sJob):
+        # Download clients ask for the size with a HEAD before resuming
+        return self.get(sJob, include_body=False)
+
+
 '''
 https://esox3.scilifelab.se/vialdb/initiateSdfDownload
 https://esox3.scilifelab.se/vialdb/addMolfileToSdf/977775/test
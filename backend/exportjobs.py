@@ -0,0 +1,192 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import mydb
+import sdf
+import refdata
+
+cur = mydb.pooledCursor()
+
+EXPORT_DIR = 'dist/export'
+# Exports running at the same time, the rest wait in the queue
+EXPORT_WORKERS = 2
+# Finished jobs and their files are removed after this many seconds
+EXPORT_KEEP = 24 * 3600
+
+executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+# An export holds its connection until it is done, exports and the
+# addMolfileToSdf appender get connections of their own so handlers on
+# mydb.executor never wait for them
+pool = mydb.ConnectionPool(maxSize=EXPORT_WORKERS + 1)
+
+platePattern = re.compile(r'^[Pp]\d{6}$')
+
+
+def newTicket():
+    '''Return a new unique export id and create its directory.'''
+    sTicket = uuid.uuid4().hex
+    os.makedirs(os.path.join(EXPORT_DIR, sTicket), exist_ok=True)
+    return sTicket
+
+
+def plateWells(saPlates, dErrors, coolDB='cool'):
+    '''Return [(batch_id, plate_id)] for the wells of saPlates in plate
+    and plating order, plates that do not exist are put in dErrors.'''
+    sSql = f"""
+    SELECT
+    p.plate_id,
+    notebook_ref,
+    c.well,
+    p.TYPE_ID
+    FROM {coolDB}.config c, {coolDB}.plate p
+    WHERE p.CONFIG_ID = c.CONFIG_ID
+    and p.plate_id in ({{ids}})"""
+    dRows = dict()
+    for row in cur.fetchallIn(sSql, saPlates):
+        dRows.setdefault(row[0].upper(), []).append(row)
+    refData = refdata.get(coolDB)
+    dWells = dict()
+    for sPlate, laRows in dRows.items():
+        dWells[sPlate] = [(row[1], row[0]) for row in refData.sortWells(laRows[0][3], laRows, 2)]
+
+    laItems = []
+    for sPlate in saPlates:
+        if sPlate.upper() not in dWells:
+            dErrors[sPlate] = 'Plate not found'
+            continue
+        laItems += [tItem for tItem in dWells[sPlate.upper()] if tItem[0]]
+    return laItems
+
+
+def sdfTags(tItem, sCompound):
+    laTags = [('COMPOUND_ID', sCompound)]
+    if not tItem[0].upper().startswith('CBK'):
+        laTags.append(('BATCH_ID', tItem[0]))
+    if len(tItem) > 1:
+        laTags.append(('PLATE_ID', tItem[1]))
+    return laTags
+
+
+def exportItems(saIds, dErrors, coolDB='cool'):
+    '''SDF items for a list of compound and batch ids, or of plate ids.'''
+    saIds = [sId.strip() for sId in saIds if sId.strip() != '']
+    if len(saIds) > 0 and platePattern.match(saIds[0]):
+        return plateWells(saIds, dErrors, coolDB)
+    return [(sId,) for sId in saIds]
+
+
+class ExportJob(object):
+    def __init__(self, saIds, coolDB, bcpvsDB, bSmiles=False):
+        # bSmiles writes the SMILES based records of getSDFForElements
+        # instead of the registered molfiles
+        self.sId = newTicket()
+        self.saIds = saIds
+        self.coolDB = coolDB
+        self.bcpvsDB = bcpvsDB
+        self.bSmiles = bSmiles
+        self.sState = 'queued'
+        self.iDone = 0
+        self.iTotal = 0
+        self.dErrors = dict()
+        self.sMessage = ''
+        self.fFinished = None
+        self.cancelled = threading.Event()
+
+    @property
+    def sPath(self):
+        return os.path.join(EXPORT_DIR, self.sId, 'export.sdf')
+
+    def status(self):
+        return {'job': self.sId,
+                'state': self.sState,
+                'done': self.iDone,
+                'total': self.iTotal,
+                'errors': self.dErrors,
+                'message': self.sMessage}
+
+    def run(self):
+        # Runs on the export executor. The file is written under a
+        # temporary name so a download never sees a half written file
+        if self.cancelled.is_set():
+            self.sState = 'cancelled'
+            self.fFinished = time.time()
+            return
+        self.sState = 'running'
+        sPart = self.sPath + '.part'
+        try:
+            laItems = exportItems(self.saIds, self.dErrors, self.coolDB)
+            self.iTotal = len(laItems)
+            with open(sPart, 'w') as f:
+                for laChunk in mydb.chunks(laItems, sdf.SDF_CHUNK):
+                    if self.cancelled.is_set():
+                        break
+                    tags = sdf.smilesTags if self.bSmiles else sdfTags
+                    for sText in sdf.sdfChunks(laChunk, tags,
+                                               bcpvsDB=self.bcpvsDB,
+                                               bSmiles=self.bSmiles,
+                                               dErrors=self.dErrors):
+                        f.write(sText)
+                    self.iDone += len(laChunk)
+            if self.cancelled.is_set():
+                os.remove(sPart)
+                self.sState = 'cancelled'
+            else:
+                os.replace(sPart, self.sPath)
+                self.sState = 'done'
+        except Exception as e:
+            logging.error(f'Export {self.sId} failed: {str(e)}')
+            try:
+                os.remove(sPart)
+            except OSError:
+                pass
+            self.sMessage = str(e)
+            self.sState = 'failed'
+        finally:
+            self.fFinished = time.time()
+
+
+class ExportJobs(object):
+    '''Export jobs by id, run one at a time per export worker.'''
+
+    def __init__(self):
+        self.dJobs = dict()
+        self.lock = threading.Lock()
+
+    def submit(self, saIds, coolDB, bcpvsDB, bSmiles=False):
+        self.expire()
+        job = ExportJob(saIds, coolDB, bcpvsDB, bSmiles)
+        with self.lock:
+            self.dJobs[job.sId] = job
+        executor.submit(mydb.pooled(job.run, pool))
+        return job
+
+    def get(self, sJob):
+        with self.lock:
+            return self.dJobs.get(sJob)
+
+    def cancel(self, sJob):
+        job = self.get(sJob)
+        if job is None:
+            return None
+        job.cancelled.set()
+        if job.sState == 'queued':
+            job.sState = 'cancelled'
+        return job
+
+    def expire(self):
+        fNow = time.time()
+        with self.lock:
+            saOld = [sJob for sJob, job in self.dJobs.items()
+                     if job.fFinished is not None and fNow - job.fFinished > EXPORT_KEEP]
+            for sJob in saOld:
+                del self.dJobs[sJob]
+        for sJob in saOld:
+            shutil.rmtree(os.path.join(EXPORT_DIR, sJob), ignore_errors=True)
+
+
+jobs = ExportJobs()
@@ -0,0 +1,69 @@
+import mydb
+
+cur = mydb.pooledCursor()
+
+
+class IdSequence(object):
+    '''Hands out ids from a one row sequence table in blocks.
+
+    allocate() locks the sequence row, checks a whole block of candidate
+    ids against the tables the ids live in with one query per table and
+    moves the sequence past the block, all in one transaction. Candidates
+    that are already taken are skipped, like the old one-by-one probing.
+
+    sTable and the collision tables may contain {db}, which is replaced
+    with the database passed to allocate().
+    '''
+
+    def __init__(self, sTable, formatId, taCollisions, iOffset=1):
+        self.sTable = sTable
+        self.formatId = formatId
+        # (table, id column) pairs a new id must not exist in
+        self.taCollisions = taCollisions
+        # First candidate is pkey + iOffset
+        self.iOffset = iOffset
+
+    def takenIds(self, saIds, sDB):
+        setTaken = set()
+        for sTable, sColumn in self.taCollisions:
+            sSql = f"""select {sColumn} from {sTable.format(db=sDB)}
+            where {sColumn} in ({{ids}})"""
+            setTaken.update(str(row[0]).upper() for row in cur.fetchallIn(sSql, saIds))
+        return setTaken
+
+    def allocate(self, iCount, sDB=None):
+        sTable = self.sTable.format(db=sDB)
+        saIds = []
+        with cur.transaction():
+            cur.execute(f"select pkey from {sTable} for update")
+            iNext = cur.fetchall()[0][0] + self.iOffset
+            while len(saIds) < iCount:
+                iNeeded = iCount - len(saIds)
+                saCandidates = [self.formatId(i) for i in range(iNext, iNext + iNeeded)]
+                setTaken = self.takenIds(saCandidates, sDB)
+                saIds += [sId for sId in saCandidates if sId.upper() not in setTaken]
+                iNext += iNeeded
+            # The sequence keeps the last candidate looked at
+            cur.execute(f"update {sTable} set pkey = %s", (iNext - 1, ))
+        return saIds
+
+
+# The plate, rack and vial sequences are shared by the Live and DDD
+# databases so that ids are unique over both
+plateIds = IdSequence('cool.plate_sequence',
+                      lambda i: 'P' + str(i),
+                      [('{db}.plate', 'plate_id')])
+
+rackIds = IdSequence('microtube.matrix_sequence',
+                     lambda i: 'MX' + str(i).zfill(4),
+                     [('{db}.matrix', 'matrix_id')])
+
+# Like the others the vial sequence holds the last id handed out, so two
+# requests never get the same id
+vialIds = IdSequence('glass.vial_id_sequence',
+                     lambda i: 'V' + str(i).zfill(6),
+                     [('glass.vial', 'vial_id'), ('ddd_glass.vial', 'vial_id')])
+
+locIds = IdSequence('{db}.location_id_sequence',
+                    lambda i: 'SL' + str(i),
+                    [('{db}.locations', 'loc_id')])
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+import mydb
+
+cur = mydb.pooledCursor()
+
+# Reload the tree at least this often, in case locations are changed by
+# something else than this server
+LOCTREE_MAX_AGE = 600
+
+
+class Location(object):
+    __slots__ = ('loc_id', 'parent', 'type_id', 'name', 'owner', 'path', 'children')
+
+    def __init__(self, loc_id, parent, type_id, name, owner):
+        self.loc_id = loc_id
+        self.parent = parent
+        self.type_id = type_id
+        self.name = name
+        self.owner = owner
+        self.path = None
+        self.children = []
+
+
+class LocationTree(object):
+    '''All locations of one loctree database, indexed by id, parent and name.
+
+    path is the names from the root down to the location joined by '/',
+    the same as the path column of v_all_locations. The tree is never
+    changed once built, writers invalidate it and the next reader loads
+    a new one.
+    '''
+
+    def __init__(self, tLocations, tTypes, iVersion):
+        self.iVersion = iVersion
+        self.fLoaded = time.time()
+        self.dTypes = dict()
+        for row in tTypes:
+            self.dTypes[row[0]] = {'name': row[1], 'subpos': row[2], 'use_subpos': row[3]}
+
+        self.dIds = dict()
+        for row in tLocations:
+            loc = Location(row[0], row[1], row[2], row[3], row[4])
+            self.dIds[str(loc.loc_id).upper()] = loc
+
+        self.roots = []
+        self.dNames = dict()
+        for loc in self.dIds.values():
+            # Roots are the locations without parent, a location whose
+            # parent is missing is nobody's child, as in the parent queries
+            # the tree replaces
+            if loc.parent is None:
+                self.roots.append(loc)
+            else:
+                parent = self.dIds.get(str(loc.parent).upper())
+                if parent is not None:
+                    parent.children.append(loc)
+            self.dNames.setdefault(str(loc.name).upper(), []).append(loc)
+
+        for loc in self.dIds.values():
+            self.setPath(loc)
+
+    def setPath(self, loc):
+        # Walk up to the first location with a known path, iteratively as
+        # the freezer hierarchy can be deep
+        laChain = []
+        saSeen = set()
+        while loc is not None and loc.path is None:
+            if loc.loc_id in saSeen:
+                logging.error(f'Location cycle at {loc.loc_id}')
+                break
+            saSeen.add(loc.loc_id)
+            laChain.append(loc)
+            loc = self.dIds.get(str(loc.parent).upper()) if loc.parent else None
+        sPath = loc.path if loc is not None and loc.path is not None else None
+        for loc in reversed(laChain):
+            sPath = loc.name if sPath is None else f'{sPath}/{loc.name}'
+            loc.path = sPath
+
+    def get(self, sLocId):
+        return self.dIds.get(str(sLocId).upper())
+
+    def byName(self, sName):
+        return self.dNames.get(str(sName).upper(), [])
+
+    def children(self, sLocId):
+        if sLocId == 'root':
+            return self.roots
+        loc = self.get(sLocId)
+        return loc.children if loc is not None else []
+
+    def typeOf(self, loc):
+        return self.dTypes.get(loc.type_id, {})
+
+    def hasChildren(self, loc):
+        return self.typeOf(loc).get('use_subpos')
+
+    def subpos(self, loc):
+        return self.typeOf(loc).get('subpos')
+
+    def typeName(self, loc):
+        return self.typeOf(loc).get('name')
+
+    def subtree(self, sLocId, iDepth=0):
+        '''Rows [loc_id, parent, name, type, has_children] for the locations
+        below sLocId ('root' for all), iDepth levels down or all levels if
+        iDepth is 0. Parents come before their children.'''
+        laRows = []
+        laLevel = self.children(sLocId)
+        iLevel = 1
+        while len(laLevel) > 0 and (iDepth == 0 or iLevel <= iDepth):
+            laNext = []
+            for loc in laLevel:
+                laRows.append([loc.loc_id, loc.parent, loc.name,
+                               self.typeName(loc), self.hasChildren(loc)])
+                laNext += loc.children
+            laLevel = laNext
+            iLevel += 1
+        return laRows
+
+    def nodeJson(self, loc):
+        # Same keys as the v_all_locations queries it replaces
+        return {'LOC_ID': loc.loc_id,
+                'NAME': loc.name,
+                'path': loc.path,
+                'type': self.typeName(loc),
+                'has_children': self.hasChildren(loc)}
+
+
+class LocationTreeCache(object):
+    def __init__(self):
+        self.dTrees = dict()
+        self.dGenerations = dict()
+        self.iVersion = 0
+        self.lock = threading.Lock()
+
+    def load(self, loctreeDB):
+        sSql = f'''select loc_id, parent, type_id, name, owner
+        from {loctreeDB}.locations order by loc_id'''
+        cur.execute(sSql)
+        tLocations = cur.fetchall()
+        sSql = f'''select type_id, name, subpos, use_subpos
+        from {loctreeDB}.location_type'''
+        cur.execute(sSql)
+        tTypes = cur.fetchall()
+        with self.lock:
+            self.iVersion += 1
+            iVersion = self.iVersion
+        return LocationTree(tLocations, tTypes, iVersion)
+
+    def tree(self, loctreeDB):
+        '''Return the location tree of loctreeDB, loading it if needed.'''
+        with self.lock:
+            tree = self.dTrees.get(loctreeDB)
+            iGeneration = self.dGenerations.get(loctreeDB, 0)
+        if tree is not None and time.time() - tree.fLoaded < LOCTREE_MAX_AGE:
+            return tree
+        tree = self.load(loctreeDB)
+        with self.lock:
+            # A load that raced with an invalidation may miss the write, it
+            # is returned to its caller but not kept
+            current = self.dTrees.get(loctreeDB)
+            if self.dGenerations.get(loctreeDB, 0) == iGeneration and \
+               (current is None or current.iVersion < tree.iVersion):
+                self.dTrees[loctreeDB] = tree
+        return tree
+
+    def invalidate(self, loctreeDB):
+        with self.lock:
+            self.dTrees.pop(loctreeDB, None)
+            self.dGenerations[loctreeDB] = self.dGenerations.get(loctreeDB, 0) + 1
+
+
+cache = LocationTreeCache()
+
+
+def tree(loctreeDB):
+    return cache.tree(loctreeDB)
+
+
+def invalidate(loctreeDB):
+    cache.invalidate(loctreeDB)
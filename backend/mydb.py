@@ -1,12 +1,19 @@
 import MySQLdb 
 import config
 import logging
+import threading
+import time
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
 
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 
 
 def setup_logger(name, log_file, level=logging.INFO):
-    handler = logging.FileHandler(log_file)        
+    # delay: the file is only created when something is logged
+    handler = logging.FileHandler(log_file, delay=True)
     handler.setFormatter(formatter)
 
     logger = logging.getLogger(name)
@@ -17,6 +24,19 @@ def setup_logger(name, log_file, level=logging.INFO):
 
 scarabLogger = setup_logger('scara_logger', 'scarabSqlError.txt')
 
+# MySQL client errors that mean the socket is gone and a reconnect can help:
+# 2006 server has gone away, 2013 lost connection during query
+RECONNECT_ERRORS = (2006, 2013)
+
+POOL_SIZE = config.database.get('pool_size', 10)
+# Seconds a connection may sit unused in the pool before it is replaced
+POOL_IDLE_TIMEOUT = config.database.get('pool_idle_timeout', 3600)
+# Seconds a request waits for a free connection before giving up
+POOL_CHECKOUT_TIMEOUT = config.database.get('pool_checkout_timeout', 30)
+# Max number of values sent in one IN (...) list
+IN_CHUNK_SIZE = 1000
+
+
 class DisconnectSafeCursor(object):
     db = None
     cursor = None
@@ -37,17 +57,31 @@ class DisconnectSafeCursor(object):
 
         return ret
 
+    def reconnect(self):
+        self.db.reconnect()
+        self.cursor = self.db.conn.cursor()
 
     def execute(self, *args, **kwargs):
         try:
             return self.cursor.execute(*args, **kwargs)
-        except MySQLdb.OperationalError:
+        except MySQLdb.OperationalError as e:
+            if e.args[0] in RECONNECT_ERRORS and not self.db.inTransaction:
+                logging.warning(f'Reconnecting after: {str(e)}')
+                self.reconnect()
+                return self.cursor.execute(*args, **kwargs)
             logging.error(args[0])
-            #self.db.reconnect()
-            #self.cursor = self.db.cursor()
-            #return self.cursor.execute(*args, **kwargs)
-            pass
+            raise
 
+    def executemany(self, *args, **kwargs):
+        try:
+            return self.cursor.executemany(*args, **kwargs)
+        except MySQLdb.OperationalError as e:
+            if e.args[0] in RECONNECT_ERRORS and not self.db.inTransaction:
+                logging.warning(f'Reconnecting after: {str(e)}')
+                self.reconnect()
+                return self.cursor.executemany(*args, **kwargs)
+            logging.error(args[0])
+            raise
 
     def fetchone(self):
         return self.cursor.fetchone()
@@ -64,13 +98,16 @@ class DisconnectSafeConnection(object):
     connect_kwargs = None
     conn = None
     cur = None
-    
+    lastUsed = 0
+    inTransaction = False
+
     def __init__(self, *args, **kwargs):
         self.connect_args = args
         self.connect_kwargs = kwargs
         self.reconnect()
 
     def reconnect(self):
+        self.close()
         self.conn = MySQLdb.connect(
             host=config.database['host'],
             user=config.database['user'],
@@ -80,6 +117,8 @@ class DisconnectSafeConnection(object):
             use_unicode=True    # Use Unicode
         )
         self.conn.autocommit(True)
+        self.lastUsed = time.time()
+        self.inTransaction = False
 
 
         '''
@@ -98,13 +137,29 @@ class DisconnectSafeConnection(object):
         '''
 
 
-        
-  
+
+
     def cursor(self, *args, **kwargs):
         self.cur = self.conn.cursor(*args, **kwargs)
         #self.scarabCur = self.scarabConn.cursor(*args, **kwargs)
         return DisconnectSafeCursor(self, self.cur)
 
+    def isAlive(self):
+        try:
+            self.conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.close()
+        except MySQLdb.Error:
+            pass
+        self.conn = None
+
     def commit(self):
         #self.scarabConn.commit()
         self.conn.commit()
@@ -114,3 +169,228 @@ class DisconnectSafeConnection(object):
         self.conn.rollback()
 
 disconnectSafeConnect = DisconnectSafeConnection
+
+
+class ConnectionPool(object):
+    '''Bounded pool of DisconnectSafeConnections.
+
+    Connections are created on demand up to maxSize. A checkout waits for
+    a free connection, replaces connections that have been idle longer
+    than idleTimeout and pings the rest before handing them out.
+    '''
+
+    def __init__(self, maxSize=POOL_SIZE, idleTimeout=POOL_IDLE_TIMEOUT,
+                 checkoutTimeout=POOL_CHECKOUT_TIMEOUT):
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.checkoutTimeout = checkoutTimeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxSize)
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=self.checkoutTimeout):
+            raise MySQLdb.OperationalError(
+                f'No free database connection after {self.checkoutTimeout}s')
+        try:
+            with self.lock:
+                db = self.idle.pop() if self.idle else None
+            if db is None:
+                return DisconnectSafeConnection()
+            if time.time() - db.lastUsed > self.idleTimeout or not db.isAlive():
+                db.reconnect()
+            return db
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, db):
+        if db.inTransaction:
+            # Never hand out a connection with a half finished transaction
+            try:
+                db.rollback()
+            except MySQLdb.Error:
+                db.close()
+            db.inTransaction = False
+        db.lastUsed = time.time()
+        with self.lock:
+            if db.conn is not None:
+                self.idle.append(db)
+        self.slots.release()
+
+
+pool = ConnectionPool()
+
+
+def chunks(saValues, iSize=IN_CHUNK_SIZE):
+    for i in range(0, len(saValues), iSize):
+        yield saValues[i:i + iSize]
+
+
+def placeholders(saValues):
+    return ', '.join(['%s'] * len(saValues))
+
+# The connection checked out by the request running on this thread
+local = threading.local()
+
+
+def bind(connectionPool=None):
+    if getattr(local, 'db', None) is not None:
+        return False
+    connectionPool = connectionPool or pool
+    db = connectionPool.checkout()
+    local.db = db
+    local.pool = connectionPool
+    local.cursor = db.cursor()
+    return True
+
+
+def bindUnpooled():
+    # A connection of the thread's own, never returned to the pool
+    db = DisconnectSafeConnection()
+    local.db = db
+    local.pool = None
+    local.cursor = db.cursor()
+
+
+def release():
+    db = getattr(local, 'db', None)
+    if db is None or local.pool is None:
+        return
+    try:
+        local.cursor.close()
+    except Exception:
+        pass
+    connectionPool = local.pool
+    local.db = None
+    local.cursor = None
+    local.pool = None
+    connectionPool.checkin(db)
+
+
+class PooledCursor(object):
+    '''Cursor for the pooled connection bound to the current thread.
+
+    Modules keep a single module level `cur` and use it as before, but
+    every request gets its own connection from the pool (see pooled).
+    Code running outside a request, on the IOLoop or at startup, gets a
+    connection of its own that is kept for the thread and does not hold
+    a pool slot.
+    '''
+
+    def current(self):
+        if getattr(local, 'db', None) is None:
+            if getattr(local, 'requestPool', None) is not None:
+                bind(local.requestPool)
+            else:
+                bindUnpooled()
+        local.db.lastUsed = time.time()
+        return local.cursor
+
+    @contextmanager
+    def transaction(self):
+        '''Run the enclosed statements as one transaction.
+
+        A nested transaction() joins the one already open, which commits
+        or rolls back everything when the outermost block ends.
+        '''
+        cursor = self.current()
+        db = cursor.db
+        if db.inTransaction:
+            yield self
+            return
+        cursor.execute('START TRANSACTION')
+        db.inTransaction = True
+        try:
+            yield self
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.inTransaction = False
+
+    def fetchallIn(self, sSql, saValues, tArgs=()):
+        '''Run sSql for saValues in chunks and return all rows.
+
+        sSql contains {ids} where the IN list placeholders go, tArgs are
+        bound before the chunk values. When {ids} occurs more than once
+        the chunk values are bound once for every occurrence.
+        '''
+        tRes = ()
+        iLists = sSql.count('{ids}')
+        for saChunk in chunks(list(saValues)):
+            self.execute(sSql.replace('{ids}', placeholders(saChunk)),
+                         tuple(tArgs) + tuple(saChunk) * iLists)
+            tRes += tuple(self.fetchall())
+        return tRes
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+sharedCursor = PooledCursor()
+
+
+def pooledCursor():
+    return sharedCursor
+
+
+def pooled(method, connectionPool=None):
+    '''Return the connection a handler method used to the pool when it is done.
+
+    The connection is checked out lazily on the first query, so handlers
+    that never touch the database do not take one. Background workers
+    pass a connectionPool of their own so they never hold connections
+    the handler executor needs.
+    '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        lWasBound = getattr(local, 'db', None) is not None
+        outerPool = getattr(local, 'requestPool', None)
+        local.requestPool = outerPool or connectionPool or pool
+        try:
+            return method(*args, **kwargs)
+        finally:
+            local.requestPool = outerPool
+            if not lWasBound:
+                release()
+    return wrapper
+
+
+# Worker threads for blocking database work, one pooled connection each
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='mydb')
+
+
+async def runThreaded(fn, *args, **kwargs):
+    '''Run fn on the database executor with its own pooled connection.'''
+    return await IOLoop.current().run_in_executor(
+        executor, functools.partial(pooled(fn), *args, **kwargs))
+
+
+def threaded(method):
+    '''Run a blocking handler method on the database executor.
+
+    The handler becomes a coroutine, so the IOLoop keeps serving other
+    clients while the query runs. The IOLoop thread waits for the method,
+    so the handler is only ever used by one thread at a time; finish() is
+    the one call that must happen on the IOLoop, so calls to it from the
+    worker are recorded and replayed when the method returns.
+    '''
+    @functools.wraps(method)
+    async def wrapper(handler, *args, **kwargs):
+        lFinish = []
+
+        def deferredFinish(chunk=None):
+            if chunk is not None:
+                handler.write(chunk)
+            lFinish.append(True)
+
+        handler.finish = deferredFinish
+        try:
+            ret = await runThreaded(method, handler, *args, **kwargs)
+        finally:
+            del handler.finish
+        if lFinish and not handler._finished:
+            handler.finish()
+        return ret
+    return wrapper
@@ -0,0 +1,244 @@
+import threading
+from collections import OrderedDict
+import time
+import mydb
+
+cur = mydb.pooledCursor()
+
+# Reload the counts and box maps at least this often, in case vials are
+# moved by something else than this server
+OCCUPANCY_MAX_AGE = 600
+# Box maps kept in memory
+BOX_CACHE_SIZE = 5000
+
+
+class BoxCounts(object):
+    '''Number of vials per location for one glass database.
+
+    Loaded with one aggregate over the vial table, then kept up to date by
+    the handlers that move vials, so reading it never touches the vial
+    table.
+    '''
+
+    def __init__(self, glassDB):
+        self.glassDB = glassDB
+        self.dCounts = None
+        self.fLoaded = 0
+        self.iGeneration = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            iGeneration = self.iGeneration
+        sSql = f"""select location, count(vial_id)
+        from {self.glassDB}.vial
+        where location is not null
+        group by location"""
+        cur.execute(sSql)
+        dCounts = dict()
+        for row in cur.fetchall():
+            dCounts[str(row[0]).upper()] = int(row[1])
+        with self.lock:
+            # A move during the load may be missing from it, such counts
+            # are used once but not kept
+            if self.iGeneration == iGeneration:
+                self.dCounts = dCounts
+                self.fLoaded = time.time()
+        return dCounts
+
+    def counts(self):
+        '''Return a copy of {location: number of vials}.'''
+        with self.lock:
+            if self.dCounts is not None and \
+               time.time() - self.fLoaded <= OCCUPANCY_MAX_AGE:
+                return dict(self.dCounts)
+        return dict(self.load())
+
+    def moved(self, laMoves):
+        '''Apply committed moves, laMoves is [(vial, old box, new box)].'''
+        with self.lock:
+            self.iGeneration += 1
+            if self.dCounts is None:
+                return
+            for sVial, sOldBox, sNewBox in laMoves:
+                sOldBox = str(sOldBox or '').upper()
+                sNewBox = str(sNewBox or '').upper()
+                if sOldBox == sNewBox:
+                    continue
+                if sOldBox != '' and self.dCounts.get(sOldBox, 0) > 0:
+                    self.dCounts[sOldBox] -= 1
+                if sNewBox != '':
+                    self.dCounts[sNewBox] = self.dCounts.get(sNewBox, 0) + 1
+
+
+class BoxMap(object):
+    '''Which coordinates of one box hold a vial.
+
+    iBits has bit i set when saCoordinates[i] is taken, saVials[i] is the
+    vial there. dInfo caches (batch, compound) for the vials in the box.
+    '''
+
+    def __init__(self, saCoordinates, dIndex):
+        self.saCoordinates = saCoordinates
+        self.dIndex = dIndex
+        self.iBits = 0
+        self.saVials = [None] * len(saCoordinates)
+        self.dInfo = dict()
+        self.fLoaded = time.time()
+
+    def place(self, sVial, sPos, tInfo=None):
+        i = self.dIndex.get(str(sPos or '').upper())
+        if i is None or self.iBits >> i & 1:
+            return False
+        self.iBits |= 1 << i
+        self.saVials[i] = sVial
+        if tInfo is not None:
+            self.dInfo[sVial.upper()] = tInfo
+        return True
+
+    def remove(self, sVial):
+        for i, sOther in enumerate(self.saVials):
+            if sOther is not None and sOther.upper() == sVial.upper():
+                self.iBits &= ~(1 << i)
+                self.saVials[i] = None
+        self.dInfo.pop(sVial.upper(), None)
+
+    def vialAt(self, sPos):
+        i = self.dIndex.get(str(sPos or '').upper())
+        return None if i is None else self.saVials[i]
+
+    def freePositions(self, iCount=1, sAfter=None):
+        '''The first iCount free coordinates, after sAfter if given.'''
+        iStart = 0
+        if sAfter is not None and str(sAfter).upper() in self.dIndex:
+            iStart = self.dIndex[str(sAfter).upper()] + 1
+        saFree = []
+        iFree = ~self.iBits >> iStart
+        i = iStart
+        while len(saFree) < iCount and i < len(self.saCoordinates):
+            # Skip straight to the lowest free position
+            iSkip = (iFree & -iFree).bit_length() - 1
+            i += iSkip
+            if i >= len(self.saCoordinates):
+                break
+            saFree.append(self.saCoordinates[i])
+            iFree >>= iSkip + 1
+            i += 1
+        return saFree
+
+
+class BoxMaps(object):
+    '''Lazily loaded BoxMaps of one glass database, kept coherent by the
+    handlers that move or edit vials.'''
+
+    def __init__(self, glassDB):
+        self.glassDB = glassDB
+        self.saCoordinates = None
+        self.dBoxes = OrderedDict()
+        self.dGenerations = dict()
+        self.lock = threading.Lock()
+
+    def coordinates(self):
+        if self.saCoordinates is None:
+            sSql = f"""select coordinate from {self.glassDB}.box_sequence
+            order by coordinate"""
+            cur.execute(sSql)
+            self.saCoordinates = [row[0] for row in cur.fetchall()]
+        return self.saCoordinates
+
+    def box(self, sBox, iPositions, bcpvsDB):
+        '''Return the BoxMap of sBox, loading it with one query if needed.'''
+        sKey = sBox.upper()
+        with self.lock:
+            boxMap = self.dBoxes.get(sKey)
+            iGeneration = self.dGenerations.get(sKey, 0)
+            if boxMap is not None and len(boxMap.saCoordinates) == iPositions and \
+               time.time() - boxMap.fLoaded < OCCUPANCY_MAX_AGE:
+                self.dBoxes.move_to_end(sKey)
+                return boxMap
+
+        saCoordinates = self.coordinates()[:iPositions]
+        boxMap = BoxMap(saCoordinates, {str(s).upper(): i for i, s in enumerate(saCoordinates)})
+        sSql = f"""SELECT v.pos, v.vial_id, v.notebook_ref, c.compound_id
+        from {self.glassDB}.vial v
+        left join {bcpvsDB}.batch c on v.notebook_ref = c.notebook_ref
+        where v.location = %s"""
+        cur.execute(sSql, (sBox, ))
+        for row in cur.fetchall():
+            boxMap.place(row[1], row[0], (row[2], row[3]))
+
+        with self.lock:
+            # A move into or out of the box during the load may be missing
+            # from it, such a map is used once but not kept
+            if self.dGenerations.get(sKey, 0) == iGeneration:
+                self.dBoxes[sKey] = boxMap
+                self.dBoxes.move_to_end(sKey)
+                while len(self.dBoxes) > BOX_CACHE_SIZE:
+                    self.dBoxes.popitem(last=False)
+        return boxMap
+
+    def touch(self, sKey):
+        self.dGenerations[sKey] = self.dGenerations.get(sKey, 0) + 1
+
+    def moved(self, laMoves):
+        '''Apply committed moves, laMoves is [(vial, old box, new box, new position)].'''
+        with self.lock:
+            for sVial, sOldBox, sNewBox, sNewPos in laMoves:
+                sOldBox = str(sOldBox or '').upper()
+                sNewBox = str(sNewBox or '').upper()
+                self.touch(sOldBox)
+                self.touch(sNewBox)
+                tInfo = None
+                if sOldBox in self.dBoxes:
+                    tInfo = self.dBoxes[sOldBox].dInfo.get(sVial.upper())
+                    self.dBoxes[sOldBox].remove(sVial)
+                if sNewBox in self.dBoxes:
+                    boxMap = self.dBoxes[sNewBox]
+                    boxMap.remove(sVial)
+                    if not boxMap.place(sVial, sNewPos, tInfo) and \
+                       str(sNewPos or '').upper() in boxMap.dIndex:
+                        # Two vials on one position, reload from the database
+                        del self.dBoxes[sNewBox]
+
+    def edited(self, sVial):
+        '''Forget the cached batch and compound of sVial.'''
+        with self.lock:
+            for boxMap in self.dBoxes.values():
+                boxMap.dInfo.pop(sVial.upper(), None)
+
+
+dBoxCounts = dict()
+dBoxMaps = dict()
+lock = threading.Lock()
+
+
+def boxCounts(glassDB):
+    with lock:
+        if glassDB not in dBoxCounts:
+            dBoxCounts[glassDB] = BoxCounts(glassDB)
+        return dBoxCounts[glassDB]
+
+
+def boxMaps(glassDB):
+    with lock:
+        if glassDB not in dBoxMaps:
+            dBoxMaps[glassDB] = BoxMaps(glassDB)
+        return dBoxMaps[glassDB]
+
+
+def counts(glassDB):
+    return boxCounts(glassDB).counts()
+
+
+def box(glassDB, bcpvsDB, sBox, iPositions):
+    return boxMaps(glassDB).box(sBox, iPositions, bcpvsDB)
+
+
+def moved(glassDB, laMoves):
+    '''Record committed moves, laMoves is [(vial, old box, new box, new position)].'''
+    boxCounts(glassDB).moved([(sVial, sOld, sNew) for sVial, sOld, sNew, sPos in laMoves])
+    boxMaps(glassDB).moved(laMoves)
+
+
+def edited(glassDB, sVial):
+    boxMaps(glassDB).edited(sVial)
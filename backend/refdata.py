@@ -0,0 +1,107 @@
+import logging
+import threading
+import mydb
+
+cur = mydb.pooledCursor()
+
+# The type_id in the db of the standard plate of each size
+PLATE_TYPE_IDS = {96: 1, 384: 16, 1536: 47}
+# Loaded when the server starts, other databases on first use
+COOL_DATABASES = ('cool', 'ddd_cool', 'cool_test')
+
+
+class ReferenceData(object):
+    '''The small static tables of one cool database: plate_type,
+    plating_sequence and the 96 to 384 and 384 to 1536 quadrant maps.'''
+
+    def __init__(self, coolDB):
+        self.coolDB = coolDB
+
+        cur.execute(f"""select type_id, wells from {coolDB}.plate_type""")
+        self.dWells = {int(row[0]): row[1] for row in cur.fetchall()}
+        for iSize, iTypeId in PLATE_TYPE_IDS.items():
+            if iTypeId in self.dWells and str(self.dWells[iTypeId]) != str(iSize):
+                logging.error(f'{coolDB}.plate_type {iTypeId} has {self.dWells[iTypeId]} wells, expected {iSize}')
+
+        cur.execute(f"""select type_id, well, seq from {coolDB}.plating_sequence""")
+        self.dSequences = dict()
+        for row in cur.fetchall():
+            self.dSequences.setdefault(int(row[0]), dict())[str(row[1]).upper()] = row[2]
+
+        # target plate size -> {quadrant: {source well: target well}}
+        self.dQuadrantMaps = dict()
+        for iSize, sSql in ((384, f"""select quadrant, well96, well384 from {coolDB}.map96to384"""),
+                            (1536, f"""select quadrant, well384, well1536 from {coolDB}.map384to1536""")):
+            cur.execute(sSql)
+            dMaps = dict()
+            for row in cur.fetchall():
+                dMaps.setdefault(int(row[0]), dict())[row[1]] = row[2]
+            self.dQuadrantMaps[iSize] = dMaps
+
+    def plateSize(self, iTypeId):
+        '''Number of wells of a plate type, None for unknown types.'''
+        try:
+            return int(self.dWells.get(int(iTypeId)))
+        except (TypeError, ValueError):
+            return None
+
+    def quadrantMaps(self, iPlateSize):
+        '''Return the quadrant maps into a 384 or 1536 plate.'''
+        return self.dQuadrantMaps.get(iPlateSize, dict())
+
+    def sortWells(self, iTypeId, tRows, iWellCol):
+        '''Rows in plating order of the plate type. Wells that are not in
+        its plating sequence are left out, as the join on plating_sequence
+        did.'''
+        try:
+            dSequence = self.dSequences.get(int(iTypeId), dict())
+        except (TypeError, ValueError):
+            return []
+        laRows = [row for row in tRows if str(row[iWellCol]).upper() in dSequence]
+        laRows.sort(key=lambda row: dSequence[str(row[iWellCol]).upper()])
+        return laRows
+
+    def wellsOf(self, iTypeId):
+        '''The wells in the plating sequence of a plate type.'''
+        try:
+            return list(self.dSequences.get(int(iTypeId), dict()).keys())
+        except (TypeError, ValueError):
+            return []
+
+
+dReferenceData = dict()
+lock = threading.Lock()
+
+
+def get(coolDB):
+    '''The reference data of coolDB, read from the database on first use.'''
+    with lock:
+        refData = dReferenceData.get(coolDB)
+    if refData is None:
+        refData = refresh(coolDB)
+    return refData
+
+
+def refresh(coolDB):
+    refData = ReferenceData(coolDB)
+    with lock:
+        dReferenceData[coolDB] = refData
+    logging.info(f'Loaded reference data from {coolDB}')
+    return refData
+
+
+@mydb.pooled
+def preload():
+    for coolDB in COOL_DATABASES:
+        try:
+            refresh(coolDB)
+        except Exception as e:
+            logging.error(f'Could not load reference data from {coolDB}: {str(e)}')
+
+
+def plateTypeId(sPlateSize):
+    '''The type_id of a standard '96', '384' or '1536' plate, None otherwise.'''
+    try:
+        return PLATE_TYPE_IDS.get(int(sPlateSize))
+    except (TypeError, ValueError):
+        return None
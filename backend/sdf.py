@@ -0,0 +1,125 @@
+from rdkit import Chem
+from rdkit.Chem import AllChem
+import mydb
+from depict import LruCache
+
+cur = mydb.pooledCursor()
+
+# Ids looked up per query, also the amount of SDF text produced per yield
+SDF_CHUNK = 1000
+# SMILES with computed 2D coordinates kept in memory
+COORD_CACHE_SIZE = 20000
+
+coordCache = LruCache(COORD_CACHE_SIZE)
+
+
+def molblockFromSmiles(sSmiles):
+    '''Return a molblock with 2D coordinates for sSmiles, None if RDKit
+    can not parse it. Coordinates are computed once per SMILES.'''
+    sBlock = coordCache.get(sSmiles)
+    if sBlock is None:
+        mol = Chem.MolFromSmiles(sSmiles)
+        if mol is None:
+            return None
+        AllChem.Compute2DCoords(mol)
+        sBlock = Chem.MolToMolBlock(mol)
+        coordCache.put(sSmiles, sBlock)
+    return sBlock
+
+
+def setTitle(sMol, sTitle):
+    iEnd = sMol.find('\n')
+    if iEnd < 0:
+        return sMol
+    return sTitle + sMol[iEnd:]
+
+
+def sdfRecord(sMol, laTags):
+    '''One SDF record from a molfile and a list of (tag, value).'''
+    saLines = [sMol.rstrip('\n')]
+    for sTag, value in laTags:
+        saLines.append(f'> <{sTag}>\n{value}\n')
+    saLines.append('$$$$\n')
+    return '\n'.join(saLines)
+
+
+def smilesTags(tItem, sCompound):
+    '''Tags of the SMILES based SDF written for the client's batch lists.'''
+    sId = tItem[0]
+    if sId.upper().startswith('CBK'):
+        return [('Compound id', sId)]
+    return [('Compound id', sCompound), ('Batch id', sId)]
+
+
+def structureRows(saIds, bcpvsDB, bSmiles=False):
+    '''Return {ID: (compound_id, structure)} for compound and batch ids.
+
+    The structure is the registered molfile, or smiles_std if bSmiles.
+    One query per kind of id.
+    '''
+    if bSmiles:
+        sStructure = 's.smiles_std'
+        sTable = f'{bcpvsDB}.compound'
+    else:
+        sStructure = 's.mol'
+        sTable = f'{bcpvsDB}.JCMOL_MOLTABLE'
+    saCompounds = [sId for sId in saIds if sId.upper().startswith('CBK')]
+    saBatches = [sId for sId in saIds if not sId.upper().startswith('CBK')]
+
+    dRows = dict()
+    if len(saCompounds) > 0:
+        sSql = f"""select s.compound_id, s.compound_id, {sStructure}
+        from {sTable} s
+        where s.compound_id in ({{ids}})
+        """
+        for row in cur.fetchallIn(sSql, saCompounds):
+            dRows[str(row[0]).upper()] = (row[1], row[2])
+    if len(saBatches) > 0:
+        sSql = f"""select b.notebook_ref, b.compound_id, {sStructure}
+        from {bcpvsDB}.batch b, {sTable} s
+        where b.compound_id = s.compound_id
+        and b.notebook_ref in ({{ids}})
+        """
+        for row in cur.fetchallIn(sSql, saBatches):
+            dRows[str(row[0]).upper()] = (row[1], row[2])
+    return dRows
+
+
+def sdfChunks(laItems, tags, bcpvsDB='bcpvs', bSmiles=False, dErrors=None,
+              iChunk=SDF_CHUNK):
+    '''Yield the SDF for laItems as one string per chunk of iChunk items.
+
+    laItems are tuples starting with a compound or batch id, the rest is
+    passed on to tags(tItem, sCompound) which returns the (tag, value)
+    list of the record. Items are written in the order given, ids without
+    a structure are left out and put in dErrors. With bSmiles the
+    structure is smiles_std with cached 2D coordinates, titled by the id.
+    '''
+    for laChunk in mydb.chunks(laItems, iChunk):
+        dRows = structureRows(list({str(tItem[0]) for tItem in laChunk}),
+                              bcpvsDB, bSmiles)
+        saRecords = []
+        for tItem in laChunk:
+            sId = str(tItem[0])
+            tRow = dRows.get(sId.upper())
+            sMol = None
+            if tRow is not None and tRow[1]:
+                sMol = tRow[1]
+                if isinstance(sMol, bytes):
+                    sMol = sMol.decode('utf-8')
+                if bSmiles:
+                    sMol = molblockFromSmiles(sMol)
+                    if sMol is not None:
+                        sMol = setTitle(sMol, sId)
+            if sMol is None:
+                if dErrors is not None:
+                    dErrors[sId] = 'No molfile'
+                continue
+            saRecords.append(sdfRecord(sMol, tags(tItem, tRow[0])))
+        yield ''.join(saRecords)
+
+
+def writeSdf(file, laItems, tags, **kwargs):
+    '''Write the SDF for laItems to an open file, chunk by chunk.'''
+    for sText in sdfChunks(laItems, tags, **kwargs):
+        file.write(sText)
@@ -0,0 +1,85 @@
+import importlib
+import os
+import sys
+import types
+from contextlib import contextmanager
+
+# The backend modules import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def stubModule(sName, **kwargs):
+    '''Install a stand-in for sName unless the real module can be imported.
+
+    config is not in the repository and the tests never touch MySQL,
+    tornado or RDKit, so they run from a plain checkout.
+    '''
+    try:
+        return importlib.import_module(sName)
+    except ImportError:
+        module = types.ModuleType(sName)
+        module.__dict__.update(kwargs)
+        sys.modules[sName] = module
+        sParent, _, sChild = sName.rpartition('.')
+        if sParent:
+            setattr(sys.modules[sParent], sChild, module)
+        return module
+
+
+class MySQLError(Exception):
+    pass
+
+
+class MySQLOperationalError(MySQLError):
+    pass
+
+
+def mysqlConnect(*args, **kwargs):
+    raise MySQLOperationalError('No database in the tests')
+
+
+stubModule('config', database=dict(), secret_key='')
+stubModule('MySQLdb', Error=MySQLError, OperationalError=MySQLOperationalError,
+           connect=mysqlConnect)
+stubModule('tornado')
+stubModule('tornado.ioloop', IOLoop=type('IOLoop', (object, ), {}))
+stubModule('rdkit')
+stubModule('rdkit.Chem')
+stubModule('rdkit.Chem.AllChem')
+stubModule('rdkit.Chem.Draw')
+
+
+class FakeCursor(object):
+    '''Stands in for mydb's pooled cursor.
+
+    laAnswers is [(sql fragment, rows)], execute() answers with the rows
+    of the first fragment found in the statement. Statements and their
+    arguments are kept in laExecuted.
+    '''
+
+    def __init__(self, laAnswers=()):
+        self.laAnswers = list(laAnswers)
+        self.laExecuted = []
+        self.tRows = ()
+        self.onExecute = None
+
+    def execute(self, sSql, tArgs=None):
+        self.laExecuted.append((sSql, tArgs))
+        if self.onExecute is not None:
+            self.onExecute(sSql, tArgs)
+        self.tRows = ()
+        for sFragment, tRows in self.laAnswers:
+            if sFragment in sSql:
+                self.tRows = tuple(tRows)
+                break
+
+    def fetchall(self):
+        return self.tRows
+
+    def fetchallIn(self, sSql, saValues, tArgs=()):
+        self.execute(sSql, tuple(tArgs) + tuple(saValues))
+        return self.fetchall()
+
+    @contextmanager
+    def transaction(self):
+        yield self
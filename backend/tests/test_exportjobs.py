@@ -0,0 +1,64 @@
+import os
+import exportjobs
+import sdf
+from conftest import FakeCursor
+
+
+class FakeReferenceData(object):
+    def sortWells(self, iTypeId, tRows, iWellCol):
+        return sorted(tRows, key=lambda row: row[iWellCol])
+
+
+def test_sdfTags():
+    assert exportjobs.sdfTags(('B1', 'P000001'), 'CBK1') == \
+        [('COMPOUND_ID', 'CBK1'), ('BATCH_ID', 'B1'), ('PLATE_ID', 'P000001')]
+    assert exportjobs.sdfTags(('CBK1', ), 'CBK1') == [('COMPOUND_ID', 'CBK1')]
+
+
+def test_smilesTags():
+    assert sdf.smilesTags(('CBK1', ), 'CBK1') == [('Compound id', 'CBK1')]
+    assert sdf.smilesTags(('B1', ), 'CBK1') == [('Compound id', 'CBK1'), ('Batch id', 'B1')]
+
+
+def test_exportItems():
+    dErrors = dict()
+    assert exportjobs.exportItems([' B1 ', '', 'CBK1\n'], dErrors) == [('B1', ), ('CBK1', )]
+    assert dErrors == {}
+
+
+def test_plateWells(monkeypatch):
+    cur = FakeCursor([('.plate p', [('P000001', 'B2', 'B01', 1),
+                                    ('P000001', None, 'A02', 1),
+                                    ('P000001', 'B1', 'A01', 1)])])
+    monkeypatch.setattr(exportjobs, 'cur', cur)
+    saDatabases = []
+
+    def get(coolDB):
+        saDatabases.append(coolDB)
+        return FakeReferenceData()
+    monkeypatch.setattr(exportjobs.refdata, 'get', get)
+
+    dErrors = dict()
+    laItems = exportjobs.exportItems(['p000001', 'P000002'], dErrors, 'ddd_cool')
+    # Plating order, empty wells left out
+    assert laItems == [('B1', 'P000001'), ('B2', 'P000001')]
+    assert dErrors == {'P000002': 'Plate not found'}
+    assert 'ddd_cool.plate' in cur.laExecuted[0][0]
+    assert ' cool.' not in cur.laExecuted[0][0]
+    assert saDatabases == ['ddd_cool']
+
+
+def test_failedJobRemovesPart(monkeypatch, tmp_path):
+    monkeypatch.setattr(exportjobs, 'EXPORT_DIR', str(tmp_path))
+
+    def sdfChunks(laItems, tags, **kwargs):
+        yield 'partial'
+        raise RuntimeError('Lost connection')
+    monkeypatch.setattr(exportjobs.sdf, 'sdfChunks', sdfChunks)
+
+    job = exportjobs.ExportJob(['CBK1'], 'cool', 'bcpvs')
+    job.run()
+    assert job.sState == 'failed'
+    assert job.sMessage == 'Lost connection'
+    assert not os.path.exists(job.sPath + '.part')
+    assert not os.path.exists(job.sPath)
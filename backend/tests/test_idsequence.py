@@ -0,0 +1,21 @@
+import idsequence
+from conftest import FakeCursor
+
+
+def test_vialIds(monkeypatch):
+    fake = FakeCursor([('for update', [(41, )]),
+                       ('from glass.vial\n', [('v000042', )])])
+    monkeypatch.setattr(idsequence, 'cur', fake)
+
+    # pkey is the last id handed out, taken ids are skipped
+    assert idsequence.vialIds.allocate(3) == ['V000043', 'V000044', 'V000045']
+    assert fake.laExecuted[-1] == ('update glass.vial_id_sequence set pkey = %s', (45, ))
+
+
+def test_locIds(monkeypatch):
+    fake = FakeCursor([('for update', [(7, )])])
+    monkeypatch.setattr(idsequence, 'cur', fake)
+
+    assert idsequence.locIds.allocate(2, 'ddd_loctree') == ['SL8', 'SL9']
+    assert 'ddd_loctree.location_id_sequence' in fake.laExecuted[0][0]
+    assert 'ddd_loctree.locations' in fake.laExecuted[1][0]
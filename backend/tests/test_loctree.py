@@ -0,0 +1,49 @@
+import loctree
+
+TYPES = [(1, 'Room', None, 1), (2, 'Freezer', None, 1), (3, 'Box', 200, 0)]
+LOCATIONS = [('SL1', None, 1, 'Lab', 'me'),
+             ('SL2', 'SL1', 2, 'Freezer A', 'me'),
+             ('SL3', 'SL2', 3, 'Box 1', 'me'),
+             ('SL4', 'SL2', 3, 'Box 2', 'me'),
+             ('SL5', 'SL99', 3, 'Lost box', 'me')]
+
+
+def tree():
+    return loctree.LocationTree(LOCATIONS, TYPES, 1)
+
+
+def test_paths():
+    t = tree()
+    assert t.get('sl1').path == 'Lab'
+    assert t.get('SL3').path == 'Lab/Freezer A/Box 1'
+
+
+def test_roots():
+    # A location whose parent is missing is neither a root nor a child
+    assert [loc.loc_id for loc in tree().children('root')] == ['SL1']
+
+
+def test_lookups():
+    t = tree()
+    assert [loc.loc_id for loc in t.byName('box 2')] == ['SL4']
+    assert [loc.loc_id for loc in t.children('SL2')] == ['SL3', 'SL4']
+    assert t.children('SL404') == []
+    assert t.subpos(t.get('SL3')) == 200
+    assert t.typeName(t.get('SL2')) == 'Freezer'
+
+
+def test_subtree():
+    t = tree()
+    assert t.subtree('root') == [['SL1', None, 'Lab', 'Room', 1],
+                                 ['SL2', 'SL1', 'Freezer A', 'Freezer', 1],
+                                 ['SL3', 'SL2', 'Box 1', 'Box', 0],
+                                 ['SL4', 'SL2', 'Box 2', 'Box', 0]]
+    assert [row[0] for row in t.subtree('SL1', 1)] == ['SL2']
+    assert [row[0] for row in t.subtree('SL1', 2)] == ['SL2', 'SL3', 'SL4']
+    assert t.subtree('SL3') == []
+
+
+def test_cycle():
+    t = loctree.LocationTree([('A', 'B', 3, 'a', 'me'), ('B', 'A', 3, 'b', 'me')], TYPES, 1)
+    assert t.roots == []
+    assert t.get('A').path is not None
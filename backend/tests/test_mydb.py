@@ -0,0 +1,51 @@
+import mydb
+from conftest import FakeCursor
+
+
+class FakePooledCursor(mydb.PooledCursor):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def current(self):
+        return self.cursor
+
+
+def test_chunks():
+    assert list(mydb.chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(mydb.chunks([], 2)) == []
+
+
+def test_placeholders():
+    assert mydb.placeholders(['a', 'b', 'c']) == '%s, %s, %s'
+
+
+def test_fetchallInChunks(monkeypatch):
+    # IN lists of two values
+    monkeypatch.setattr(mydb.chunks, '__defaults__', (2, ))
+    fake = FakeCursor([('in', [('row', )])])
+    cursor = FakePooledCursor(fake)
+
+    tRes = cursor.fetchallIn('select x from t where a = %s and x in ({ids})',
+                             ['v1', 'v2', 'v3'], ('A', ))
+
+    assert tRes == (('row', ), ('row', ))
+    assert fake.laExecuted == [
+        ('select x from t where a = %s and x in (%s, %s)', ('A', 'v1', 'v2')),
+        ('select x from t where a = %s and x in (%s)', ('A', 'v3'))]
+
+
+def test_fetchallInRepeatedList():
+    fake = FakeCursor()
+    cursor = FakePooledCursor(fake)
+
+    cursor.fetchallIn('select 1 where a in ({ids}) or b in ({ids})', ['x', 'y'])
+
+    assert fake.laExecuted == [
+        ('select 1 where a in (%s, %s) or b in (%s, %s)', ('x', 'y', 'x', 'y'))]
+
+
+def test_fetchallInNoValues():
+    fake = FakeCursor()
+    cursor = FakePooledCursor(fake)
+    assert cursor.fetchallIn('select 1 where a in ({ids})', []) == ()
+    assert fake.laExecuted == []
@@ -0,0 +1,92 @@
+import occupancy
+from conftest import FakeCursor
+
+
+def boxMap(saCoordinates):
+    return occupancy.BoxMap(saCoordinates,
+                            {s.upper(): i for i, s in enumerate(saCoordinates)})
+
+
+def test_placeAndRemove():
+    box = boxMap(['A1', 'A2', 'A3'])
+    assert box.place('V1', 'a2', ('B1', 'CBK1'))
+    # Taken and unknown positions
+    assert not box.place('V2', 'A2')
+    assert not box.place('V2', 'Z9')
+    assert box.vialAt('A2') == 'V1'
+    assert box.dInfo['V1'] == ('B1', 'CBK1')
+
+    box.remove('v1')
+    assert box.vialAt('A2') is None
+    assert 'V1' not in box.dInfo
+    assert box.iBits == 0
+
+
+def test_freePositions():
+    box = boxMap(['A1', 'A2', 'A3', 'A4', 'A5'])
+    box.place('V1', 'A1')
+    box.place('V2', 'A3')
+    box.place('V3', 'A4')
+    assert box.freePositions() == ['A2']
+    assert box.freePositions(5) == ['A2', 'A5']
+    assert box.freePositions(2, sAfter='A2') == ['A5']
+    assert box.freePositions(1, sAfter='A5') == []
+    # Unknown coordinates start from the beginning
+    assert box.freePositions(1, sAfter='Z9') == ['A2']
+
+
+def test_freePositionsFullBox():
+    box = boxMap(['A1', 'A2'])
+    box.place('V1', 'A1')
+    box.place('V2', 'A2')
+    assert box.freePositions(3) == []
+
+
+def test_boxCountsMoved():
+    counts = occupancy.BoxCounts('glass')
+    counts.dCounts = {'B1': 2}
+    counts.fLoaded = float('inf')
+    counts.moved([('V1', 'b1', 'b2'), ('V2', 'B2', 'B2'), ('V3', None, 'B3')])
+    assert counts.counts() == {'B1': 1, 'B2': 1, 'B3': 1}
+
+
+def test_boxCountsLoad(monkeypatch):
+    fake = FakeCursor([('count(vial_id)', [('b1', 3), ('B2', 1)])])
+    monkeypatch.setattr(occupancy, 'cur', fake)
+    counts = occupancy.BoxCounts('glass')
+    assert counts.counts() == {'B1': 3, 'B2': 1}
+    # Served from memory until it is too old
+    counts.counts()
+    assert len(fake.laExecuted) == 1
+
+
+def test_boxCountsMoveDuringLoad(monkeypatch):
+    fake = FakeCursor([('count(vial_id)', [('B1', 3)])])
+    monkeypatch.setattr(occupancy, 'cur', fake)
+    counts = occupancy.BoxCounts('glass')
+    fake.onExecute = lambda sSql, tArgs: counts.moved([('V1', 'B1', 'B2')])
+
+    # The racing load is used once but not kept
+    assert counts.counts() == {'B1': 3}
+    assert counts.dCounts is None
+
+    fake.onExecute = None
+    counts.counts()
+    assert counts.dCounts == {'B1': 3}
+
+
+def test_boxMapsMoved(monkeypatch):
+    fake = FakeCursor([('box_sequence', [('A1', ), ('A2', ), ('A3', )]),
+                       ('v.location', [('A1', 'V1', 'B1', 'CBK1')])])
+    monkeypatch.setattr(occupancy, 'cur', fake)
+    maps = occupancy.BoxMaps('glass')
+    box1 = maps.box('BOX1', 3, 'bcpvs')
+    fake.laAnswers[1] = ('v.location', [])
+    box2 = maps.box('BOX2', 2, 'bcpvs')
+    assert box2.saCoordinates == ['A1', 'A2']
+    assert box1.vialAt('A1') == 'V1'
+
+    maps.moved([('V1', 'box1', 'box2', 'A2')])
+    assert box1.vialAt('A1') is None
+    assert box2.vialAt('A2') == 'V1'
+    assert box2.dInfo['V1'] == ('B1', 'CBK1')
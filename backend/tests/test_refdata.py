@@ -0,0 +1,51 @@
+import refdata
+from conftest import FakeCursor
+
+
+def referenceData(monkeypatch):
+    fake = FakeCursor([
+        ('plate_type', [(1, '96'), (16, '384')]),
+        ('plating_sequence', [(1, 'a01', 1), (1, 'B01', 2), (1, 'A02', 9),
+                              (16, 'A01', 1)]),
+        ('map96to384', [(1, 'A01', 'A01'), (2, 'A01', 'A02')]),
+        ('map384to1536', [])])
+    monkeypatch.setattr(refdata, 'cur', fake)
+    return refdata.ReferenceData('cool')
+
+
+def test_plateSize(monkeypatch):
+    refData = referenceData(monkeypatch)
+    assert refData.plateSize(1) == 96
+    assert refData.plateSize('16') == 384
+    assert refData.plateSize(99) is None
+    assert refData.plateSize(None) is None
+
+
+def test_sortWells(monkeypatch):
+    refData = referenceData(monkeypatch)
+    tRows = [('P1', 'A02'), ('P1', 'H12'), ('P1', 'A01'), ('P1', 'b01')]
+    # Plating order, wells outside the sequence are left out
+    assert refData.sortWells(1, tRows, 1) == [('P1', 'A01'), ('P1', 'b01'), ('P1', 'A02')]
+    assert refData.sortWells(47, tRows, 1) == []
+    assert refData.sortWells(None, tRows, 1) == []
+
+
+def test_quadrantMaps(monkeypatch):
+    refData = referenceData(monkeypatch)
+    assert refData.quadrantMaps(384) == {1: {'A01': 'A01'}, 2: {'A01': 'A02'}}
+    assert refData.quadrantMaps(1536) == {}
+    assert refData.quadrantMaps(96) == {}
+
+
+def test_wellsOf(monkeypatch):
+    refData = referenceData(monkeypatch)
+    assert sorted(refData.wellsOf(1)) == ['A01', 'A02', 'B01']
+    assert refData.wellsOf('x') == []
+
+
+def test_plateTypeId():
+    assert refdata.plateTypeId('96') == 1
+    assert refdata.plateTypeId(384) == 16
+    assert refdata.plateTypeId('1536') == 47
+    assert refdata.plateTypeId('48') is None
+    assert refdata.plateTypeId('') is None
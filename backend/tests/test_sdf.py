@@ -0,0 +1,41 @@
+import io
+import sdf
+
+MOL = 'title\n  RDKit\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n'
+
+
+def idTags(tItem, sCompound):
+    return [('COMPOUND_ID', sCompound), ('ID', tItem[0])]
+
+
+def test_sdfRecord():
+    assert sdf.sdfRecord(MOL, [('COMPOUND_ID', 'CBK1')]) == \
+        MOL.rstrip('\n') + '\n> <COMPOUND_ID>\nCBK1\n\n$$$$\n'
+
+
+def test_setTitle():
+    assert sdf.setTitle(MOL, 'CBK1').startswith('CBK1\n  RDKit')
+    assert sdf.setTitle('no newline', 'CBK1') == 'no newline'
+
+
+def test_writeSdf(monkeypatch):
+    laQueries = []
+
+    def structureRows(saIds, bcpvsDB, bSmiles=False):
+        laQueries.append((sorted(saIds), bcpvsDB))
+        dRows = {'CBK1': ('CBK1', MOL), 'B1': ('CBK2', MOL.encode())}
+        return {sId.upper(): dRows[sId.upper()] for sId in saIds if sId.upper() in dRows}
+    monkeypatch.setattr(sdf, 'structureRows', structureRows)
+
+    file = io.StringIO()
+    dErrors = dict()
+    sdf.writeSdf(file, [('B1', ), ('nomol', ), ('CBK1', )], idTags,
+                 bcpvsDB='ddd_bcpvs', dErrors=dErrors, iChunk=2)
+
+    # One lookup per chunk, records in the order given
+    assert laQueries == [(['B1', 'nomol'], 'ddd_bcpvs'), (['CBK1'], 'ddd_bcpvs')]
+    assert dErrors == {'nomol': 'No molfile'}
+    saRecords = file.getvalue().split('$$$$\n')
+    assert len(saRecords) == 3 and saRecords[2] == ''
+    assert '> <COMPOUND_ID>\nCBK2\n\n> <ID>\nB1\n' in saRecords[0]
+    assert '> <COMPOUND_ID>\nCBK1\n\n> <ID>\nCBK1\n' in saRecords[1]
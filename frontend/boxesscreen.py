@@ -36,6 +36,11 @@ class BoxesScreen(QMainWindow):
         self.add_location_btn.clicked.connect(self.addLocation)
         self.add_location_btn.setEnabled(False)
 
+        # The whole location tree is kept here, expanding, searching and
+        # seeking in the tree do not go to the server
+        self.locations = dict()
+        self.loc_children = dict()
+        self.tree_etag = None
         self.boxes_tree.clear()
         self.init_boxes_tree()
         self.boxes_tree.itemExpanded.connect(self.get_children)
@@ -110,37 +115,68 @@ class BoxesScreen(QMainWindow):
             self.fetch_free_boxes()
 
 
-    def locationInput(self, js):
-        return [js['NAME'], js['type'], js['LOC_ID']]
+    def locationInput(self, row):
+        # row is [loc_id, parent, name, type, has_children]
+        return [row[2], row[3], row[0]]
+
+    def load_tree(self):
+        rows, etag = dbInterface.getLocationTree(self.token, 'root', 0, self.tree_etag)
+        if rows is None:
+            # Unchanged since the last load
+            return True
+        if rows is False:
+            logging.getLogger(self.mod_name).error("bad response for getLocationTree/root")
+            return False
+        self.tree_etag = etag
+        self.locations = {row[0].upper(): row for row in rows}
+        self.loc_children = {'root': []}
+        for row in rows:
+            parent = row[1].upper() if row[1] else None
+            if parent not in self.locations:
+                parent = 'root'
+            self.loc_children.setdefault(parent, []).append(row[0].upper())
+        return True
+
+    def refresh_children(self, loc):
+        # Reload the direct children of loc after a location was added or
+        # removed there
+        rows, etag = dbInterface.getLocationTree(self.token, loc, 1)
+        if rows is False or rows is None:
+            logging.getLogger(self.mod_name).error(f"bad response for getLocationTree/{loc}")
+            return
+        key = loc if loc == 'root' else loc.upper()
+        keep = {row[0].upper() for row in rows}
+        for child in self.loc_children.get(key, []):
+            if child not in keep:
+                self.drop_location(child)
+        self.loc_children[key] = []
+        for row in rows:
+            self.locations[row[0].upper()] = row
+            self.loc_children[key].append(row[0].upper())
+        # The local tree no longer matches any server version
+        self.tree_etag = None
+
+    def drop_location(self, loc):
+        for child in self.loc_children.pop(loc, []):
+            self.drop_location(child)
+        self.locations.pop(loc, None)
 
     # populate box tree
     def init_boxes_tree(self):
-        #get top level nodes
-        r = dbInterface.getLocationChildren(self.token, "root")
-        try:
-            root_items = json.loads(r)
-        except:
-            logging.getLogger(self.mod_name).error("bad response for getLocationChildren/root")
+        if not self.load_tree():
             return
-
-        for js in root_items:
-            item = QTreeWidgetItem(self.boxes_tree, self.locationInput(js))
+        for loc in self.loc_children.get('root', []):
+            item = QTreeWidgetItem(self.boxes_tree, self.locationInput(self.locations[loc]))
             item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
 
     def get_children(self, item):
         self.delete_location_error_lab.setText('')
         self.take_children(item)
-        loc = item.text(2)
-        r = dbInterface.getLocationChildren(self.token, loc)
-        children = []
-        try:
-            children = json.loads(r)
-        except:
-            logging.getLogger(self.mod_name).error(f"bad response for getLocationChildren/{loc}")
-            return
+        children = self.loc_children.get(item.text(2).upper(), [])
         for child in children:
-            childItem = QTreeWidgetItem(item, self.locationInput(child))
-            if child['has_children'] == -1:
+            row = self.locations[child]
+            childItem = QTreeWidgetItem(item, self.locationInput(row))
+            if row[4] == -1:
                 childItem.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicator)
                 childItem.setData(0, Qt.UserRole, -1)
             else:
@@ -152,23 +188,39 @@ class BoxesScreen(QMainWindow):
         children = item.takeChildren()
         l = [f'({child.text(0)}:{child.text(2)})' for child in children]
 
+    def find_location(self, s):
+        s = s.upper()
+        if s in self.locations:
+            return s
+        for loc, row in self.locations.items():
+            if str(row[2]).upper() == s:
+                return loc
+        return None
+
     def find_in_box_tree(self):
-        path = None
         s = self.box_search_eb.text()
         if s != "":
-            try:
-                res = dbInterface.getLocationPath(self.token, s)
-                path = json.loads(res)
-            except:
-                logging.getLogger(self.mod_name).error(f"getLocationPath returned {res}")
+            loc = self.find_location(s)
+            if loc is None and self.load_tree():
+                # Possibly added since the tree was loaded
+                loc = self.find_location(s)
+            if loc is None:
+                logging.getLogger(self.mod_name).info(f"{s} not found in the box tree")
+                return
+            path = []
+            while loc in self.locations and loc not in path:
+                path.insert(0, loc)
+                parent = self.locations[loc][1]
+                loc = parent.upper() if parent else None
+            self.seek_path(path)
+
+    def seek_path(self, path):
+        # path is the loc_ids from the top level down to the location
+        for loc in path:
+            items = self.boxes_tree.findItems(self.locations[loc][0],
+                                              Qt.MatchExactly | Qt.MatchRecursive, 2)
+            if len(items) == 0:
                 return
-            if len(path) > 0:
-                self.seek_path(path[0]['path'])
-
-    def seek_path(self, path_s):
-        path_l = path_s.split('/')
-        for p in path_l:
-            items = self.boxes_tree.findItems(p, Qt.MatchRecursive)
             self.boxes_tree.setCurrentItem(items[0])
             self.boxes_tree.expandItem(items[0])
 
@@ -264,6 +316,7 @@ class BoxesScreen(QMainWindow):
         r = dbInterface.addBox(self.token, sParent, sBoxName, sBoxSize)
         if r:
             self.resetInput()
+            self.refresh_children(sParent)
             self.boxes_tree.collapseItem(self.boxes_tree.currentItem())
             self.boxes_tree.expandItem(self.boxes_tree.currentItem())
         else:
@@ -287,6 +340,7 @@ class BoxesScreen(QMainWindow):
         r = dbInterface.addLocation(self.token, sParent, sLocationName, sLocationType)
         if r:
             self.resetInput()
+            self.refresh_children(sParent)
             self.boxes_tree.collapseItem(self.boxes_tree.currentItem())
             self.boxes_tree.expandItem(self.boxes_tree.currentItem())
         else:
@@ -316,7 +370,13 @@ class BoxesScreen(QMainWindow):
             return
         #reload parents children
         #select parent
-        self.boxes_tree.setCurrentItem(self.boxes_tree.currentItem().parent())
+        parent = self.boxes_tree.currentItem().parent()
+        if parent is None:
+            self.reload_tree()
+            self.resetInput()
+            return
+        self.refresh_children(parent.text(2))
+        self.boxes_tree.setCurrentItem(parent)
         self.boxes_tree.collapseItem(self.boxes_tree.currentItem())
         self.boxes_tree.expandItem(self.boxes_tree.currentItem())
         self.resetInput()
@@ -1,5 +1,7 @@
 import sys, requests, json, os, subprocess, platform, shutil, datetime, traceback, logging, dbInterface, re
 from unittest import result
+import threading
+from collections import OrderedDict
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtWidgets import QApplication, QMessageBox, QTableWidget, QTableWidgetItem, QWidget
@@ -141,11 +143,51 @@ def resize_window(self, height=800, width=1200):
 
     self.window().resize(windowWidth, windowHeight)
 
+# Structure images by upper case id, None for ids without structure
+molImageCache = OrderedDict()
+molImageLock = threading.Lock()
+MOL_IMAGE_CACHE_SIZE = 5000
+MOL_IMAGE_BATCH = 500
+
+def prefetchMolImages(token, saIds):
+    with molImageLock:
+        saIds = [sId.upper() for sId in dict.fromkeys(saIds)
+                 if sId and sId.upper() not in molImageCache]
+    for i in range(0, len(saIds), MOL_IMAGE_BATCH):
+        saBatch = saIds[i:i + MOL_IMAGE_BATCH]
+        try:
+            images = dbInterface.getMolImages(token, saBatch)
+        except Exception as e:
+            logging.error(f"getMolImages failed: {str(e)}")
+            return
+        if images is None:
+            # Not cached, so the ids are asked for again next time
+            logging.error("getMolImages failed")
+            return
+        with molImageLock:
+            for sId in saBatch:
+                molImageCache[sId] = images.get(sId)
+            while len(molImageCache) > MOL_IMAGE_CACHE_SIZE:
+                molImageCache.popitem(last=False)
+
+def prefetchMolImagesInBackground(token, saIds):
+    # Fill the cache while the user looks at the table
+    threading.Thread(target=prefetchMolImages, args=(token, list(saIds)), daemon=True).start()
+
 def displayMolfile(self, sId):
-    dbInterface.createMolImage(self.token, sId.upper())
+    sId = sId.upper()
+    with molImageLock:
+        lCached = sId in molImageCache
+    if not lCached:
+        prefetchMolImages(self.token, [sId])
+    with molImageLock:
+        png = molImageCache.get(sId)
+    if png is None:
+        self.structure_lab.clear()
+        return
     image = QImage()
     self.structure_lab.setScaledContents(True)
-    image.loadFromData(dbInterface.getMolImage(sId.upper()))
+    image.loadFromData(png)
     self.structure_lab.setPixmap(QPixmap(image))
 
 def export_table(table):
@@ -2,6 +2,9 @@ import requests
 import json
 import ast
 import warnings
+import io
+import os
+import zipfile
 
 warnings.filterwarnings('ignore')
 
@@ -181,12 +184,11 @@ def checkListName(token, listName):
         return False
 
 
-def saveListElements(token, accuElements, listId):
-    unCookedToken = json.loads(token.decode('utf-8'))
-    username = unCookedToken['user']
-
-    r = requests.put(f'{baseUrl}saveListElements/{accuElements}/{listId}',
-                     headers={'token':token}, verify=False)
+def saveListElements(token, elements, listId, dedup=False):
+    r = requests.post(f'{baseUrl}saveListElements/{listId}',
+                      headers={'token':token},
+                      json={'elements': elements, 'dedup': dedup},
+                      verify=False)
     try:
         res = r.content.decode()
         res = json.loads(res)
@@ -198,7 +200,6 @@ def saveListElements(token, accuElements, listId):
     except:
         return False
 
-    
 def createList(token, listName, listType):
     unCookedToken = json.loads(token.decode('utf-8'))
     username = unCookedToken['user']
@@ -274,14 +275,65 @@ def getListById(token, batchIdPk):
         print('Failed decode')
         return False
 
-def getSDFForElements(token, saIds):
-    joinedIds = ','.join(saIds)
-    r = requests.get(f'{baseUrl}getSDFForElements/{joinedIds}',
+def getSDFForElements(token, saIds, file):
+    # The server streams the SDF, it is written to file as it arrives
+    r = requests.post(f'{baseUrl}getSDFForElements',
+            headers={'token':token}, json={'ids': saIds},
+            stream=True, verify=False)
+    if r.status_code != 200:
+        return False
+    r.encoding = 'utf-8'
+    for sText in r.iter_content(chunk_size=65536, decode_unicode=True):
+        file.write(sText)
+    return True
+
+
+def submitExport(token, saIds, smiles=False):
+    # Starts an SDF export job on the server for compound, batch or
+    # plate ids, returns the job status. With smiles the records are the
+    # same as those of getSDFForElements
+    r = requests.post(f'{baseUrl}submitExport',
+            headers={'token':token}, json={'ids': saIds, 'smiles': smiles},
+            verify=False)
+    if r.status_code != 200:
+        return False
+    return json.loads(r.content.decode())
+
+def getExportJob(token, sJob):
+    r = requests.get(f'{baseUrl}exportJob/{sJob}',
             headers={'token':token}, verify=False)
-    try:
-        return json.loads(r.content.decode())
-    except:
-        return ''
+    if r.status_code != 200:
+        return False
+    return json.loads(r.content.decode())
+
+def cancelExportJob(token, sJob):
+    r = requests.delete(f'{baseUrl}exportJob/{sJob}',
+            headers={'token':token}, verify=False)
+    return r.status_code == 200
+
+def downloadExport(token, sJob, sFile, iRetries=3):
+    # Resumes with a Range request if the connection drops
+    for i in range(iRetries):
+        iHave = 0
+        if i > 0 and os.path.exists(sFile):
+            iHave = os.path.getsize(sFile)
+        dHeaders = {'token':token}
+        if iHave > 0:
+            dHeaders['Range'] = f'bytes={iHave}-'
+        try:
+            r = requests.get(f'{baseUrl}exportJob/{sJob}/download',
+                    headers=dHeaders, stream=True, verify=False)
+            if r.status_code == 416:
+                return True
+            if r.status_code not in (200, 206):
+                return False
+            with open(sFile, 'ab' if r.status_code == 206 else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=65536):
+                    f.write(chunk)
+            return True
+        except requests.exceptions.RequestException:
+            continue
+    return False
 
 
 def getListInfoById(token, batchIdPk):
@@ -296,8 +348,9 @@ def getListInfoById(token, batchIdPk):
 
 
 def validateBatch(token, batchIds, listType):
-    r = requests.get(f'{baseUrl}validateBatches/{batchIds}/{listType}',
-            headers={'token':token}, verify=False)
+    # batchIds is a list, sent in the body as it can be too long for a url
+    r = requests.post(f'{baseUrl}validateBatches/{listType}',
+            headers={'token':token}, json={'batches': batchIds}, verify=False)
     try:
         data = ast.literal_eval(r.content.decode())
         return data
@@ -324,6 +377,18 @@ def getBatches(token, batchIds, vials, tubes, plates, present):
     except:
         return r.content
 
+def streamBatches(token, batchIds, vials, tubes, plates, present):
+    # One POST for all ids, the server answers with one JSON document per
+    # line: result rows (lists) and progress objects {"done", "total"}
+    r = requests.post(f'{baseUrl}searchBatchesBulk',
+            headers={'token':token},
+            json={'ids': batchIds, 'vials': vials, 'tubes': tubes,
+                  'plates': plates, 'present': present},
+            stream=True, verify=False)
+    for line in r.iter_lines():
+        if line:
+            yield json.loads(line)
+
 def createEmptyVials(token, iNrVials):
     r = requests.put(f'{baseUrl}createEmptyVials/{iNrVials}',
             headers={'token':token}, verify=False)
@@ -381,6 +446,20 @@ def getMolImage(vialOrCompound):
     res = r.content
     return res
 
+def getMolImages(token, ids):
+    # Returns {ID: PNG bytes} for the ids that have a structure, None if
+    # the request failed
+    r = requests.post(f'{baseUrl}getMolImages',
+                      headers={'token': token},
+                      json={'ids': ids}, verify=False)
+    if r.status_code != 200:
+        return None
+    images = dict()
+    with zipfile.ZipFile(io.BytesIO(r.content)) as z:
+        for name in z.namelist():
+            images[os.path.splitext(name)[0].upper()] = z.read(name)
+    return images
+
 def getBox(token, box):
     r = requests.get(f'{baseUrl}getBox/{box}',
                      headers={'token': token}, verify=False)
@@ -408,6 +487,17 @@ def getLocationPath(token, location):
         res = r.content
     return res
 
+def getFreeBoxPositions(token, box, count=1, after=None):
+    # The next free coordinates in box, for placing vials in bulk
+    params = {'count': count}
+    if after is not None:
+        params['after'] = after
+    r = requests.get(f'{baseUrl}getFreePositions/{box}',
+                     headers={'token': token}, params=params, verify=False)
+    if r.status_code != 200:
+        return []
+    return json.loads(r.content.decode())['positions']
+
 def updateVialPosition(token, vial, box, pos):
     r = requests.put(f'{baseUrl}updateVialPosition/{vial}/{box}/{pos}',
                      headers={'token': token}, verify=False)
@@ -433,6 +523,23 @@ def getLocationChildren(token, location):
         res = r.content
     return res
 
+def getLocationTree(token, location='root', depth=0, etag=None):
+    # Returns (rows, etag), rows is None if the tree is unchanged since etag
+    # and False on errors
+    headers = {'token': token}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    r = requests.get(f'{baseUrl}getLocationTree/{location}',
+                     headers=headers, params={'depth': depth}, verify=False)
+    if r.status_code == 304:
+        return None, etag
+    if r.status_code != 200:
+        return False, None
+    try:
+        return json.loads(r.content.decode())['locations'], r.headers.get('Etag')
+    except:
+        return False, None
+
 def moveBox(token, box, location):
     r = requests.put(f'{baseUrl}moveBox/{box}/{location}',
                      headers={'token': token}, verify=False)
@@ -318,6 +318,7 @@ class MicrotubesScreen(QMainWindow):
             except:
                 logging.error(f"search for {data[n]['batchId']} returned bad response: {data[n]}")
         self.rack_table.setSortingEnabled(True)
+        prefetchMolImagesInBackground(self.token, [f"{row.get('compoundId', '')}" for row in data])
         return
 
     def show_loc_id(self, item):
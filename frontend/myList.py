@@ -165,76 +165,44 @@ class MyListClass(QDialog):  # Inherit from QDialog
 
     def validateValues(self, valueList):
         QApplication.setOverrideCursor(Qt.WaitCursor)
-        accumulated_rows = []
-        iAccumulator_count = 0
-        iRowsBatch = 12
+        iRowsBatch = 1000
         self.popup = PopUpProgress(f'Validating list...')
         self.popup.show()
         iNrOfRows = len(valueList)
-        iTick = 0
-        iCount = 0
-        rProgressSteps = (iRowsBatch/iNrOfRows)*100
-        sAccuBatches = ''
         listType = self.ui.listType_cb.currentText()
         
-        saValidatedData = []
-        for value in valueList:
-            iCount += 1
-            sAccuBatches = sAccuBatches + ' ' + value
-            if iCount == iRowsBatch:
-                res = dbInterface.validateBatch(self.parent.token, sAccuBatches, listType)
-                for row in res:
-                    if row[1] != 'Ok':
-                        saValidatedData = [row] + saValidatedData
-                    else:
-                        saValidatedData.append(row)
-                iCount = 0
-                sAccuBatches = ''
-                iTick += rProgressSteps
-                self.popup.obj.proc_counter(int(iTick))
-                QApplication.processEvents()
-        if sAccuBatches != '':
-            res = dbInterface.validateBatch(self.parent.token, sAccuBatches, listType)
+        # Rows that failed validation are listed first, last failure on top
+        saNotOk = []
+        saOk = []
+        for i in range(0, iNrOfRows, iRowsBatch):
+            res = dbInterface.validateBatch(self.parent.token, valueList[i:i + iRowsBatch], listType)
             for row in res:
                 if row[1] != 'Ok':
-                    saValidatedData = [row] + saValidatedData
+                    saNotOk.append(row)
                 else:
-                    saValidatedData.append(row)
+                    saOk.append(row)
+            self.popup.obj.proc_counter(int(min(i + iRowsBatch, iNrOfRows) / iNrOfRows * 100))
+            QApplication.processEvents()
                     
         self.popup.obj.proc_counter(100)
         self.popup.close()
         QApplication.restoreOverrideCursor()
-        return saValidatedData
+        return saNotOk[::-1] + saOk
 
 
     def saveListValues(self, valueList, listId):
         QApplication.setOverrideCursor(Qt.WaitCursor)
-        accumulated_rows = []
-        iAccumulator_count = 0
-        iRowsBatch = 10
+        iRowsBatch = 10000
         self.popup = PopUpProgress(f'Saving list...')
         self.popup.show()
+        valueList = [value for value in valueList if value.strip() != '']
         iNrOfRows = len(valueList)
-        iTick = 0
-        iCount = 0
-        rProgressSteps = (iRowsBatch/iNrOfRows)*100
-        sAccuBatches = ''
-        listType = self.ui.listType_cb.currentText()
         
-        saValidatedData = []
-        for value in valueList:
-            iCount += 1
-            self.saCurrentTokens.append(value)
-            sAccuBatches = sAccuBatches + ' ' + value
-            if iCount == iRowsBatch:
-                res = dbInterface.saveListElements(self.parent.token, sAccuBatches, listId)
-                iCount = 0
-                sAccuBatches = ''
-                iTick += rProgressSteps
-                self.popup.obj.proc_counter(int(iTick))
-                QApplication.processEvents()
-        if sAccuBatches != '':
-            res = dbInterface.saveListElements(self.parent.token, sAccuBatches, listId)
+        self.saCurrentTokens += valueList
+        for i in range(0, iNrOfRows, iRowsBatch):
+            res = dbInterface.saveListElements(self.parent.token, valueList[i:i + iRowsBatch], listId)
+            self.popup.obj.proc_counter(int(min(i + iRowsBatch, iNrOfRows) / iNrOfRows * 100))
+            QApplication.processEvents()
                     
         QApplication.processEvents()
         self.popup.obj.proc_counter(100)
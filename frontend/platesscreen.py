@@ -685,6 +685,7 @@ class PlatesScreen(QMainWindow):
                 self.plate_table.setItem(n, 5, newItem)
             except:
                 logging.error(f"plate search failed with data row: {data[n]}")
+        prefetchMolImagesInBackground(self.token, [f"{row.get('notebook_ref', '')}" for row in data])
 
     def updatePlate(self):
         new_comment = self.plate_comment_eb.text()
@@ -840,7 +841,7 @@ class PlatesScreen(QMainWindow):
         flush = False
         accumulated_rows = []
         iAccumulator_count = 0
-        iRowsBatch = 6
+        iRowsBatch = 2000
         for row in range(self.upload_plates_table.rowCount()):
             QApplication.processEvents()
             iTickCount += 1
@@ -860,7 +861,10 @@ class PlatesScreen(QMainWindow):
                     
                     if status is False:
                         for ro in retVal:
-                            repopulate_data.append(ro)
+                            # The server appends the error message after the 7 data columns
+                            if len(ro) > 7:
+                                logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                            repopulate_data.append(ro[:7])
 
             well = self.upload_plates_table.item(row, 1).text()
             compound_id = self.upload_plates_table.item(row, 2).text()
@@ -886,7 +890,10 @@ class PlatesScreen(QMainWindow):
                 accumulated_rows = []
                 if status is False:
                     for ro in retVal:
-                        repopulate_data.append(ro)
+                        # The server appends the error message after the 7 data columns
+                        if len(ro) > 7:
+                            logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                        repopulate_data.append(ro[:7])
                     logging.getLogger(self.mod_name).info(f"Failed with uploadWellInformation Plate: {plate_id} Well: {well} Error: {retVal}")
             if iTickCount >= iTicks:
                 progress += 1
@@ -897,7 +904,10 @@ class PlatesScreen(QMainWindow):
             retVal, status = dbInterface.uploadAccumulatedRows(self.token, accumulated_rows)
             if status is False:
                 for ro in retVal:
-                    repopulate_data.append(ro)
+                    # The server appends the error message after the 7 data columns
+                    if len(ro) > 7:
+                        logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                    repopulate_data.append(ro[:7])
 
         self.upload_pbar.setValue(100)
 
@@ -1110,7 +1120,7 @@ class PlatesScreen(QMainWindow):
         flush = False
         accumulated_rows = []
         iAccumulator_count = 0
-        iRowsBatch = 6
+        iRowsBatch = 2000
         
         for row in range(self.load_echo_plates_table.rowCount()):
             QApplication.processEvents()
@@ -1131,7 +1141,10 @@ class PlatesScreen(QMainWindow):
                     
                     if status is False:
                         for ro in retVal:
-                            repopulate_data.append(ro)
+                            # The server appends the error message after the 7 data columns
+                            if len(ro) > 7:
+                                logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                            repopulate_data.append(ro[:7])
 
             well = self.load_echo_plates_table.item(row, 1).text()
             compound_id = self.load_echo_plates_table.item(row, 2).text()
@@ -1152,7 +1165,10 @@ class PlatesScreen(QMainWindow):
                 accumulated_rows = []
                 if status is False:
                     for ro in retVal:
-                        repopulate_data.append(ro)
+                        # The server appends the error message after the 7 data columns
+                        if len(ro) > 7:
+                            logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                        repopulate_data.append(ro[:7])
                     logging.getLogger(self.mod_name).info(f"Failed with uploadWellInformation Plate: {plate_id} Well: {well} Error: {retVal}")
             
             if iTickCount >= iTicks:
@@ -1164,7 +1180,10 @@ class PlatesScreen(QMainWindow):
             retVal, status = dbInterface.uploadAccumulatedRows(self.token, accumulated_rows)
             if status is False:
                 for ro in retVal:
-                    repopulate_data.append(ro)
+                    # The server appends the error message after the 7 data columns
+                    if len(ro) > 7:
+                        logging.getLogger(self.mod_name).info(f"Upload of {ro[0]} {ro[1]} failed: {ro[7]}")
+                    repopulate_data.append(ro[:7])
 
         self.load_echo_pbar.setValue(100)
 
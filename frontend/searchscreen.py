@@ -1,4 +1,4 @@
-import re, sys, os, logging
+import re, sys, os, time, logging
 from PyQt5.uic import loadUi
 from PyQt5.QtWidgets import QMainWindow, QTableWidgetItem, QFileDialog, QListWidget, QDialog, QListWidgetItem
 from PyQt5.QtCore import Qt
@@ -326,29 +326,35 @@ class SearchScreen(QMainWindow):
         if not fname[0].lower().endswith('.sdf'):
             fname = (fname[0] + '.sdf', fname[1])
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        chunkSize = 5
+        # The server builds the file in the background, it is polled for
+        # progress and downloaded when done
+        job = dbInterface.submitExport(self.token, elementIds, smiles=True)
+        if not job:
+            send_msg("Export failed", "Could not start the SDF export")
+            return
         self.popup = PopUpProgress('Exporting SDF...')
         self.popup.show()
-
-        sdfContent = ''
-        for i in range(0, totalElements, chunkSize):
-            chunk = elementIds[i:i + chunkSize]
-            result = dbInterface.getSDFForElements(self.token, chunk)
-            if result:
-                sdfContent += result
-            progress = min(int(((i + len(chunk)) / totalElements) * 100), 99)
-            self.popup.obj.proc_counter(progress)
+        while job and job['state'] in ('queued', 'running'):
+            if not self.popup.isVisible():
+                # Closed by the user
+                dbInterface.cancelExportJob(self.token, job['job'])
+                break
+            if job['total'] > 0:
+                progress = min(int(job['done'] / job['total'] * 100), 99)
+                self.popup.obj.proc_counter(progress)
             QApplication.processEvents()
+            time.sleep(0.5)
+            job = dbInterface.getExportJob(self.token, job['job'])
 
+        lOk = job and job['state'] == 'done' and \
+            dbInterface.downloadExport(self.token, job['job'], fname[0])
         self.popup.obj.finished.emit()
         self.popup.thread.quit()
         self.popup.thread.wait()
         self.popup.close()
-        QApplication.restoreOverrideCursor()
-
-        with open(fname[0], 'w') as f:
-            f.write(sdfContent)
+        if not lOk:
+            send_msg("Export failed", "The SDF export did not finish")
+            return
         logging.getLogger(self.mod_name).info(f'Exported SDF to {fname[0]}')
 
 
@@ -465,53 +471,38 @@ class SearchScreen(QMainWindow):
         plates_checked = 'yes' if self.show_plates_cb.isChecked() else 'no'
         present = 'yes' if notpresent == False else 'no'
         
-        saBatches = batches.split()
-        saBatches = list(set(saBatches))
-        iNrOfRows = len(saBatches)
-        if iNrOfRows == 0:
+        saBatches = list(dict.fromkeys(batches.split()))
+        if len(saBatches) == 0:
             return
 
         QApplication.setOverrideCursor(Qt.WaitCursor)
 
-        accumulated_rows = []
-        iAccumulator_count = 0
-        iRowsBatch = 8
         self.popup = PopUpProgress(f'Searching...')
         self.popup.show()
-        iTick = 0
-        rProgressSteps = (iRowsBatch/iNrOfRows)*100
-        
-        sAccuBatches = ''
-        iCount = 0
+
         self.batches_data = []
-        for batch in saBatches:
-            iCount += 1
-            sAccuBatches = sAccuBatches + ' ' + batch
-            if iCount == iRowsBatch:
-                res = dbInterface.getBatches(self.token, sAccuBatches, vials_checked, tubes_checked, plates_checked, present)
-
-                newRows = json.loads(res)
-                for nRow in newRows:
-                    self.batches_data.append(nRow)
-                iCount = 0
-                sAccuBatches = ''
-                iTick += rProgressSteps
-                self.popup.obj.proc_counter(int(iTick))
-                QApplication.processEvents()
-        
-        if sAccuBatches != '':
-            res = dbInterface.getBatches(self.token, sAccuBatches, vials_checked, tubes_checked, plates_checked, present)
-            newRows = json.loads(res)
-            for nRow in newRows:
-                self.batches_data.append(nRow)
-                  
+        newRows = []
+        try:
+            for line in dbInterface.streamBatches(self.token, saBatches, vials_checked, tubes_checked, plates_checked, present):
+                if isinstance(line, dict):
+                    # Progress line, show the rows received so far
+                    self.addBatchTableRows(newRows)
+                    newRows = []
+                    self.popup.obj.proc_counter(int(100 * line['done'] / max(line['total'], 1)))
+                    QApplication.processEvents()
+                else:
+                    newRows.append(line)
+                    self.batches_data.append(line)
+            self.addBatchTableRows(newRows)
+        except Exception as e:
+            logging.getLogger(self.mod_name).error(f"batches search failed: {str(e)}")
+
         self.popup.obj.proc_counter(100)
         self.popup.close()
         QApplication.restoreOverrideCursor()
         
         logging.getLogger(self.mod_name).info(f"receieved data")
         if len(self.batches_data) > 0:
-            self.setBatchTableData(self.batches_data)
             self.batch_table.setCurrentCell(0,0)
             self.batch_export_btn.setEnabled(True)
 
@@ -520,8 +511,14 @@ class SearchScreen(QMainWindow):
     
     def setBatchTableData(self, data):
         self.batch_table.setRowCount(0)
-        self.batch_table.setRowCount(len(data))
+        self.addBatchTableRows(data)
+
+    def addBatchTableRows(self, data):
+        if len(data) == 0:
+            return
+        iOffset = self.batch_table.rowCount()
         self.batch_table.setSortingEnabled(False)
+        self.batch_table.setRowCount(iOffset + len(data))
 
         keys = ["compound", "batch", "container", "pos", "conc", "loc", "name", "path"]
         # Convert list of tuples to list of dictionaries
@@ -535,47 +532,47 @@ class SearchScreen(QMainWindow):
                 if f"{data[n]['batch']}" == "Not found":
                     newItem = QTableWidgetItem(f"{data[n]['vialId']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 0, newItem)
+                    self.batch_table.setItem(iOffset + n, 0, newItem)
                     newItem = QTableWidgetItem(f"{data[n]['boxId']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 1, newItem)
+                    self.batch_table.setItem(iOffset + n, 1, newItem)
                     for i in range(2, 7):
                         newItem = QTableWidgetItem("")
-                        self.batch_table.setItem(n, i, newItem)
+                        self.batch_table.setItem(iOffset + n, i, newItem)
                         newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
                 else:
                     newItem = QTableWidgetItem(f"{data[n]['compound']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 0, newItem)
+                    self.batch_table.setItem(iOffset + n, 0, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['batch']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 1, newItem)
+                    self.batch_table.setItem(iOffset + n, 1, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['container']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 2, newItem)
+                    self.batch_table.setItem(iOffset + n, 2, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['pos']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
                     newItem.setToolTip(f"{data[n]['pos']}")
-                    self.batch_table.setItem(n, 3, newItem)
+                    self.batch_table.setItem(iOffset + n, 3, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['conc']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 4, newItem)
+                    self.batch_table.setItem(iOffset + n, 4, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['loc']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 5, newItem)
+                    self.batch_table.setItem(iOffset + n, 5, newItem)
                     
                     newItem = QTableWidgetItem(f"{data[n]['name']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 6, newItem)
+                    self.batch_table.setItem(iOffset + n, 6, newItem)
 
                     newItem = QTableWidgetItem(f"{data[n]['path']}")
                     newItem.setFlags(newItem.flags() ^ QtCore.Qt.ItemIsEditable)
-                    self.batch_table.setItem(n, 7, newItem)
+                    self.batch_table.setItem(iOffset + n, 7, newItem)
 
             except Exception as e:
                 logging.error(str(e))